@@ -0,0 +1,276 @@
+import argparse
+import asyncio
+import io
+import json
+import logging
+import multiprocessing
+import sys
+import time
+from typing import Any, Dict, Iterator, List, Optional, Tuple
+from urllib.request import Request, urlopen
+
+from cassette import CassetteStore
+from data_fetchers import AsyncBitrixFetcher, BitrixFetcher, aiohttp
+from dossier_generator import ReportGenerator
+from fake_bitrix import FakeBitrixServer, FakePortal
+from main import build_report_data, parse_deal_ids
+
+try:
+    import resource
+except ImportError:  #Нет на Windows, пиковая память там не измеряется
+    resource = None
+
+#Замер сквозной производительности на локальной замене Битрикс24 (fake_bitrix):
+#загрузка досье, построение ленты и рендеринг обоих отчётов. Каждый сценарий
+#выполняется в отдельном процессе, чтобы пиковая память не смешивалась между сценариями
+MODES = ("sequential", "bulk", "async")
+
+
+def _percentile(values: List[float], percent: float) -> float:
+    if not values:
+        return 0.0
+    ordered = sorted(values)
+    index = min(len(ordered) - 1, max(0, round(percent / 100 * len(ordered)) - 1))
+    return ordered[index]
+
+
+def _peak_rss_mb() -> Optional[float]:
+    if resource is None:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    #Linux отдаёт килобайты, macOS - байты
+    return peak / (1024 * 1024) if sys.platform == "darwin" else peak / 1024
+
+
+def _render(deal_id: int, data: Dict, logger: logging.Logger) -> None:
+    ReportGenerator.render_json(build_report_data(deal_id, data, logger), io.StringIO())
+    ReportGenerator.render_markdown(build_report_data(deal_id, data, logger), io.StringIO())
+
+
+def _timed(deals: Iterator[Tuple[int, Dict]], logger: logging.Logger) -> Tuple[List[float], int]:
+    #Время на досье - от запроса следующей сделки у конвейера до готовых отчётов
+    latencies, errors = [], 0
+    started = time.perf_counter()
+    for deal_id, data in deals:
+        if data.get("error"):
+            errors += 1
+        else:
+            _render(deal_id, data, logger)
+        now = time.perf_counter()
+        latencies.append(now - started)
+        started = now
+    return latencies, errors
+
+
+async def _timed_async(fetcher: AsyncBitrixFetcher, deal_ids: List[int],
+                       logger: logging.Logger) -> Tuple[List[float], int]:
+    latencies, errors = [], 0
+    started = time.perf_counter()
+    async for deal_id, data in fetcher.get_deals_data(deal_ids):
+        if data.get("error"):
+            errors += 1
+        else:
+            _render(deal_id, data, logger)
+        now = time.perf_counter()
+        latencies.append(now - started)
+        started = now
+    return latencies, errors
+
+
+def run_scenario(mode: str, config: Dict[str, Any], deal_ids: List[int], concurrency: int = 10) -> Dict[str, Any]:
+    #Прогон одного сценария в текущем процессе; счётчики запросов снимаются с сервера отдельно
+    logger = logging.getLogger("benchmark")
+    config = {**config, "logger": logger}
+    #Кассета одна на сценарий, чтобы посчитать проигранные запросы
+    cassette = config["cassette"] = CassetteStore.from_config(config)
+    started = time.perf_counter()
+    if mode == "sequential":
+        fetcher = BitrixFetcher(config)
+        latencies, errors = _timed(((deal_id, fetcher.get_deal_data(deal_id)) for deal_id in deal_ids), logger)
+    elif mode == "bulk":
+        latencies, errors = _timed(BitrixFetcher(config).get_deals_data(deal_ids), logger)
+    elif mode == "async":
+        if aiohttp is None:
+            raise ImportError("Для сценария async нужен пакет aiohttp")
+        if cassette is not None:
+            raise ValueError("Кассета работает только с requests, сценарий async недоступен")
+
+        async def run() -> Tuple[List[float], int]:
+            async with AsyncBitrixFetcher(config, concurrency) as fetcher:
+                return await _timed_async(fetcher, deal_ids, logger)
+        latencies, errors = asyncio.run(run())
+    else:
+        raise ValueError(f"Неизвестный сценарий: {mode}")
+    elapsed = time.perf_counter() - started
+
+    report = {
+        "mode": mode,
+        "deals": len(latencies),
+        "errors": errors,
+        "seconds": elapsed,
+        "deals_per_sec": len(latencies) / elapsed if elapsed > 0 else 0.0,
+        "p50_ms": _percentile(latencies, 50) * 1000,
+        "p99_ms": _percentile(latencies, 99) * 1000,
+        "peak_rss_mb": _peak_rss_mb(),
+    }
+    if cassette is not None and latencies:
+        report["requests_per_deal"] = cassette.stats["requests"] / len(latencies)
+    return report
+
+
+def _scenario_process(mode: str, config: Dict, deal_ids: List[int], concurrency: int,
+                      results: "multiprocessing.Queue") -> None:
+    try:
+        results.put(run_scenario(mode, config, deal_ids, concurrency))
+    except Exception as e:
+        results.put({"mode": mode, "error": str(e)})
+
+
+def _server_process(portal: Dict, latency: float, rate: Optional[float], burst: int,
+                    ready: "multiprocessing.Queue") -> None:
+    server = FakeBitrixServer(FakePortal(**portal), latency=latency, rate=rate, burst=burst)
+    ready.put(server.url)
+    server.serve_forever()
+
+
+def _server_call(url: str, path: str, method: str = "GET") -> Dict:
+    with urlopen(Request(f"{url}{path}", method=method, data=b"" if method == "POST" else None), timeout=10) as response:
+        return json.loads(response.read().decode('utf-8'))
+
+
+def deal_ids(args: argparse.Namespace) -> List[int]:
+    #Сделки прогона: явный список (для кассеты - записанные сделки) или 1..deals
+    return list(parse_deal_ids(args.ids)) if args.ids else list(range(1, args.deals + 1))
+
+
+def _run_process(context: Any, mode: str, config: Dict, args: argparse.Namespace) -> Dict[str, Any]:
+    results = context.Queue()
+    process = context.Process(target=_scenario_process,
+                              args=(mode, config, deal_ids(args), args.concurrency, results))
+    process.start()
+    report = results.get()
+    process.join()
+    return report
+
+
+def run_replay(args: argparse.Namespace) -> List[Dict[str, Any]]:
+    #Прогон по кассете: ответы берутся из записи, результат не зависит от сети и нагрузки портала
+    context = multiprocessing.get_context("spawn")
+    config = {"bitrix_url": "http://bitrix.invalid", "bitrix_token": "replay", "rate_limit": 1000.0,
+              "rate_burst": 1000, "cassette_path": args.replay, "cassette_latency": args.replay_latency}
+    return [_run_process(context, mode, config, args) for mode in args.modes]
+
+
+def run_benchmark(args: argparse.Namespace) -> List[Dict[str, Any]]:
+    context = multiprocessing.get_context("spawn")
+    ready = context.Queue()
+    portal = {"deals": args.deals, "comments": args.comments, "activities": args.activities,
+              "messages": args.messages}
+    server = context.Process(target=_server_process, daemon=True,
+                             args=(portal, args.latency, args.server_rate, args.server_burst, ready))
+    server.start()
+    url = ready.get(timeout=30)
+    #Без лимита на сервере лимитер клиента не должен быть узким местом замера
+    client_rate = args.client_rate or args.server_rate or 1000.0
+    config = {"bitrix_url": url, "bitrix_token": "benchmark", "rate_limit": client_rate,
+              "rate_burst": args.server_burst if args.server_rate else 1000}
+
+    reports = []
+    try:
+        for mode in args.modes:
+            _server_call(url, "/_reset", "POST")
+            report = _run_process(context, mode, config, args)
+            stats = _server_call(url, "/_stats")
+            if "error" not in report and report["deals"]:
+                report["requests_per_deal"] = stats.get("requests", 0) / report["deals"]
+                #Методы считаются и в прямых вызовах, и внутри batch
+                report["commands_per_deal"] = sum(
+                    count for key, count in stats.items() if key.startswith("method:")
+                ) / report["deals"]
+                report["limited"] = stats.get("limited", 0)
+            reports.append(report)
+    finally:
+        server.terminate()
+        server.join()
+    return reports
+
+
+def find_regressions(reports: List[Dict[str, Any]], baseline: List[Dict[str, Any]],
+                     tolerance: float = 0.1) -> List[str]:
+    #Сравнение с сохранённым прогоном: новые ошибки, а также падение скорости, рост p99 или
+    #числа запросов на сделку больше чем на tolerance считаются регрессией
+    previous = {report["mode"]: report for report in baseline if "error" not in report}
+    regressions = []
+    for report in reports:
+        before = previous.get(report["mode"])
+        if before is None or "error" in report:
+            continue
+        checks = (
+            ("сделок/с", report["deals_per_sec"], before["deals_per_sec"], -1),
+            ("p99, мс", report["p99_ms"], before["p99_ms"], 1),
+            ("запросов на сделку", report.get("requests_per_deal", 0), before.get("requests_per_deal", 0), 1),
+        )
+        if report["errors"] > before.get("errors", 0):
+            regressions.append(f"{report['mode']}: ошибок {before.get('errors', 0)} -> {report['errors']}")
+        for name, value, old_value, sign in checks:
+            if old_value and (value - old_value) * sign > old_value * tolerance:
+                regressions.append(f"{report['mode']}: {name} {old_value:.2f} -> {value:.2f}")
+    return regressions
+
+
+def format_reports(reports: List[Dict[str, Any]]) -> str:
+    header = f"{'сценарий':<11}{'сделок':>8}{'ошибок':>8}{'сделок/с':>10}{'p50, мс':>10}{'p99, мс':>10}" \
+             f"{'запр./сд.':>11}{'503':>6}{'RSS, МБ':>10}"
+    lines = [header, "-" * len(header)]
+    for report in reports:
+        if "error" in report:
+            lines.append(f"{report['mode']:<11}ошибка: {report['error']}")
+            continue
+        rss = "-" if report["peak_rss_mb"] is None else f"{report['peak_rss_mb']:.1f}"
+        lines.append(
+            f"{report['mode']:<11}{report['deals']:>8}{report['errors']:>8}{report['deals_per_sec']:>10.1f}"
+            f"{report['p50_ms']:>10.1f}{report['p99_ms']:>10.1f}{report.get('requests_per_deal', 0):>11.2f}"
+            f"{report.get('limited', 0):>6}{rss:>10}"
+        )
+    return "\n".join(lines)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Замер производительности выгрузки досье на локальной замене Битрикс24")
+    parser.add_argument('--deals', type=int, default=200, help="Число сделок (по умолчанию: 200)")
+    parser.add_argument('--comments', type=int, default=20, help="Комментариев на сделку")
+    parser.add_argument('--activities', type=int, default=10, help="Активностей на сделку")
+    parser.add_argument('--messages', type=int, default=50, help="Сообщений в диалоге сделки")
+    parser.add_argument('--latency', type=float, default=0.02, help="Задержка ответа сервера, с (по умолчанию: 0.02)")
+    parser.add_argument('--server-rate', type=float, help="Лимит сервера, запросов в секунду (по умолчанию без лимита)")
+    parser.add_argument('--server-burst', type=int, default=50, help="Всплеск запросов для лимита сервера")
+    parser.add_argument('--client-rate', type=float, help="Лимит клиента, запросов в секунду (по умолчанию как у сервера)")
+    parser.add_argument('--modes', nargs='+', choices=MODES, default=list(MODES), help="Сценарии замера")
+    parser.add_argument('-c', '--concurrency', type=int, default=10, help="Параллельность сценария async")
+    parser.add_argument('--ids', nargs='+', help="ID сделок прогона: 5, 1,2,3 или 100-500 (по умолчанию 1..--deals)")
+    parser.add_argument('--replay', metavar='DIR', help="Прогон по кассете (main.py --record) вместо локального сервера")
+    parser.add_argument('--replay-latency', choices=['recorded', 'zero'], default='zero',
+                        help="Задержка ответов кассеты (по умолчанию: zero)")
+    parser.add_argument('--json', help="Сохранить результаты в JSON-файл")
+    parser.add_argument('--baseline', help="JSON прошлого прогона: при регрессии код выхода 1")
+    parser.add_argument('--tolerance', type=float, default=0.1, help="Допустимое ухудшение для --baseline (по умолчанию: 0.1)")
+    args = parser.parse_args()
+    if (aiohttp is None or args.replay) and "async" in args.modes:
+        args.modes = [mode for mode in args.modes if mode != "async"]
+
+    reports = run_replay(args) if args.replay else run_benchmark(args)
+    print(format_reports(reports))
+    if args.json:
+        with open(args.json, 'w', encoding='utf-8') as f:
+            json.dump(reports, f, ensure_ascii=False, indent=2)
+    if args.baseline:
+        with open(args.baseline, encoding='utf-8') as f:
+            regressions = find_regressions(reports, json.load(f), args.tolerance)
+        for regression in regressions:
+            print(f"Регрессия: {regression}")
+        if regressions:
+            sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
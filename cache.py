@@ -0,0 +1,177 @@
+import json
+import sqlite3
+import threading
+import time
+from pathlib import Path
+from typing import Any, Callable, Dict, Optional
+
+#Время жизни записей по методам, в секундах. Методы без TTL не кэшируются.
+#Пользователи и контакты меняются редко, данные сделки - часто, поэтому для них TTL
+#короткий и рассчитан на повторный запуск после сбоя
+DEFAULT_TTLS = {
+    "user.get": 24 * 3600,
+    "crm.contact.get": 6 * 3600,
+    "crm.contact.list": 6 * 3600,
+    "crm.deal.get": 900,
+    "crm.timeline.comment.list": 900,
+    "crm.activity.list": 900,
+    "im.dialog.messages.get": 900,
+    "imopenlines.dialog.get": 900,
+}
+TOUCH_BATCH = 100  #Сколько обращений к записям копится в памяти до записи accessed_at в базу
+
+
+class ResponseCache:
+    #Кэш результатов REST-методов в SQLite: ключ - метод плюс нормализованные параметры,
+    #вытеснение давно не использованных записей при превышении max_entries. Вытеснение
+    #идёт пачкой (до 90% лимита), а время обращения пишется в базу пачками по TOUCH_BATCH,
+    #чтобы попадание в кэш не стоило записи и commit.
+    #Соединение разделяется между потоками, поэтому обращения защищены блокировкой
+    def __init__(self, path: str, ttls: Optional[Dict[str, float]] = None, max_entries: int = 100000,
+                 clock: Callable[[], float] = time.time):
+        self.ttls = {**DEFAULT_TTLS, **(ttls or {})}
+        self.max_entries = max_entries
+        self.hits = 0
+        self.misses = 0
+        self._clock = clock
+        self._lock = threading.Lock()
+        self._touched: Dict[str, float] = {}  #Ключ -> время обращения, ещё не записанное в базу
+
+        if path != ":memory:":
+            Path(path).parent.mkdir(parents=True, exist_ok=True)
+        self._db = sqlite3.connect(path, check_same_thread=False)
+        self._db.execute("PRAGMA journal_mode=WAL")
+        self._db.execute(
+            "CREATE TABLE IF NOT EXISTS responses ("
+            "key TEXT PRIMARY KEY, method TEXT NOT NULL, result TEXT NOT NULL, "
+            "date_modify TEXT, expires_at REAL NOT NULL, accessed_at REAL NOT NULL)"
+        )
+        self._db.execute("CREATE INDEX IF NOT EXISTS responses_accessed ON responses (accessed_at)")
+        self._db.execute("CREATE INDEX IF NOT EXISTS responses_expires ON responses (expires_at)")
+        self._db.commit()
+        #Оценка числа записей сверху: растёт при каждой записи, уточняется при вытеснении
+        self._count = self._db.execute("SELECT COUNT(*) FROM responses").fetchone()[0]
+
+    @classmethod
+    def from_config(cls, config: Dict[str, Any]) -> Optional["ResponseCache"]:
+        #Кэш включается указанием пути к файлу базы (cache_path)
+        if not config.get("cache_path"):
+            return None
+        return cls(config["cache_path"], max_entries=int(config.get("cache_max_entries") or 100000))
+
+    @staticmethod
+    def make_key(method: str, params: Dict) -> str:
+        #Нормализация параметров: порядок ключей и тип значений (5 и "5") не влияют на ключ
+        return f"{method}?{json.dumps(_normalize(params), sort_keys=True, ensure_ascii=False)}"
+
+    def is_cacheable(self, method: str) -> bool:
+        return self.ttls.get(method, 0) > 0
+
+    def get(self, method: str, params: Dict, date_modify: Optional[str] = None) -> Optional[Any]:
+        #Результат из кэша или None. Если передан date_modify (актуальное DATE_MODIFY
+        #сущности), запись с другим DATE_MODIFY считается устаревшей
+        key = self.make_key(method, params)
+        now = self._clock()
+        with self._lock:
+            row = self._db.execute(
+                "SELECT result, date_modify, expires_at FROM responses WHERE key = ?", (key,)
+            ).fetchone()
+            if row is None or row[2] <= now or (date_modify is not None and row[1] != str(date_modify)):
+                if row is not None:
+                    self._touched.pop(key, None)
+                    self._db.execute("DELETE FROM responses WHERE key = ?", (key,))
+                    self._db.commit()
+                self.misses += 1
+                return None
+
+            self._touched[key] = now
+            if len(self._touched) >= TOUCH_BATCH:
+                self._flush_touched()
+                self._db.commit()
+            self.hits += 1
+        return json.loads(row[0])
+
+    def peek(self, method: str, params: Dict) -> Optional[Any]:
+        #Действующая запись без учёта в статистике и времени обращения: по ней решается,
+        #нужно ли проверять актуальность сущности перед выдачей из кэша
+        with self._lock:
+            row = self._db.execute(
+                "SELECT result FROM responses WHERE key = ? AND expires_at > ?",
+                (self.make_key(method, params), self._clock())
+            ).fetchone()
+        return None if row is None else json.loads(row[0])
+
+    def set(self, method: str, params: Dict, result: Any, date_modify: Optional[str] = None) -> None:
+        #Сохранение результата с DATE_MODIFY для проверки актуальности: по умолчанию берётся
+        #из самой сущности CRM, для списков сделки передаётся DATE_MODIFY сделки
+        ttl = self.ttls.get(method, 0)
+        if ttl <= 0 or result is None:
+            return
+        if date_modify is None and isinstance(result, dict):
+            date_modify = result.get("DATE_MODIFY")
+        now = self._clock()
+        key = self.make_key(method, params)
+        with self._lock:
+            self._touched.pop(key, None)
+            self._db.execute(
+                "INSERT OR REPLACE INTO responses (key, method, result, date_modify, expires_at, accessed_at) "
+                "VALUES (?, ?, ?, ?, ?, ?)",
+                (key, method, json.dumps(result, ensure_ascii=False),
+                 None if date_modify is None else str(date_modify), now + ttl, now)
+            )
+            self._count += 1
+            if self._count > self.max_entries:
+                self._evict()
+            self._db.commit()
+
+    def invalidate(self, method: str, params: Dict) -> None:
+        with self._lock:
+            self._db.execute("DELETE FROM responses WHERE key = ?", (self.make_key(method, params),))
+            self._db.commit()
+
+    def stats(self) -> Dict[str, Any]:
+        #Счётчики попаданий для итоговой сводки запуска
+        total = self.hits + self.misses
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": self.hits / total if total else 0.0
+        }
+
+    def close(self) -> None:
+        with self._lock:
+            self._flush_touched()
+            self._db.commit()
+            self._db.close()
+
+    def _flush_touched(self) -> None:
+        if self._touched:
+            self._db.executemany("UPDATE responses SET accessed_at = ? WHERE key = ?",
+                                 [(accessed_at, key) for key, accessed_at in self._touched.items()])
+            self._touched.clear()
+
+    def _evict(self) -> None:
+        #Удаление просроченных записей и самых давно использованных: остаётся 90% max_entries,
+        #так что сортировка по accessed_at выполняется не на каждой записи, а не чаще раза
+        #в max_entries / 10 записей
+        self._flush_touched()
+        self._db.execute("DELETE FROM responses WHERE expires_at <= ?", (self._clock(),))
+        self._count = self._db.execute("SELECT COUNT(*) FROM responses").fetchone()[0]
+        keep = self.max_entries - self.max_entries // 10
+        if self._count <= keep:
+            return
+        self._db.execute(
+            "DELETE FROM responses WHERE key IN ("
+            "SELECT key FROM responses ORDER BY accessed_at DESC LIMIT -1 OFFSET ?)",
+            (keep,)
+        )
+        self._count = keep
+
+
+def _normalize(value: Any) -> Any:
+    #Приведение параметров к строкам с сохранением вложенности
+    if isinstance(value, dict):
+        return {str(k): _normalize(v) for k, v in value.items()}
+    if isinstance(value, (list, tuple)):
+        return [_normalize(v) for v in value]
+    return str(value)
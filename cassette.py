@@ -0,0 +1,197 @@
+import gzip
+import hashlib
+import json
+import os
+import threading
+import time
+from collections import Counter, defaultdict
+from datetime import timedelta
+from pathlib import Path
+from typing import Any, Dict, List, Optional, Tuple
+from urllib.parse import parse_qsl, urlsplit
+
+import requests
+from requests.adapters import HTTPAdapter
+from requests.structures import CaseInsensitiveDict
+
+INDEX_NAME = "index.jsonl"  #Журнал запросов кассеты, по строке на ответ
+OBJECTS_DIR = "objects"  #Тела ответов, сжатые gzip, с именем по SHA-256 содержимого
+KEPT_HEADERS = ("Content-Type", "Retry-After")  #Заголовки, которые влияют на обработку ответа
+MODES = ("record", "replay")
+LATENCIES = ("recorded", "zero")
+
+
+class CassetteMiss(requests.ConnectionError):
+    #Запроса нет в кассете. Наследуется от ConnectionError, поэтому фетчеры обрабатывают
+    #промах так же, как недоступность портала
+    pass
+
+
+class CassetteStore:
+    #Кассета ответов портала в директории: index.jsonl связывает ключ запроса с телом и
+    #статусом ответа, тела лежат в objects/ по хэшу содержимого, поэтому одинаковые ответы
+    #(справочники, пустые страницы, повторные записи) хранятся один раз. Ключ запроса не содержит адреса
+    #портала и токена вебхука: кассету, записанную на проде, можно проигрывать где угодно.
+    #Одинаковые запросы проигрываются в порядке записи, последний ответ повторяется
+    def __init__(self, path: str, mode: str = "replay", latency: str = "zero"):
+        if mode not in MODES:
+            raise ValueError(f"Неизвестный режим кассеты: {mode}")
+        if latency not in LATENCIES:
+            raise ValueError(f"Неизвестный режим задержки кассеты: {latency}")
+        self.path = Path(path)
+        self.mode = mode
+        self.latency = latency
+        self.stats: Counter = Counter()
+        self._lock = threading.Lock()
+        self._entries: Dict[str, List[Dict]] = defaultdict(list)
+        self._positions: Counter = Counter()
+        self._index = None
+
+        if mode == "replay":
+            if not (self.path / INDEX_NAME).exists():
+                raise FileNotFoundError(f"Кассета не найдена: {self.path}")
+            with open(self.path / INDEX_NAME, encoding='utf-8') as f:
+                for line in f:
+                    if line.strip():
+                        entry = json.loads(line)
+                        self._entries[entry["key"]].append(entry)
+        else:
+            (self.path / OBJECTS_DIR).mkdir(parents=True, exist_ok=True)
+            self._index = open(self.path / INDEX_NAME, 'a', encoding='utf-8')
+
+    @classmethod
+    def from_config(cls, config: Dict[str, Any]) -> Optional["CassetteStore"]:
+        #Кассета включается указанием директории (cassette_path)
+        if not config.get("cassette_path"):
+            return None
+        return cls(config["cassette_path"], config.get("cassette_mode") or "replay",
+                   config.get("cassette_latency") or "zero")
+
+    @staticmethod
+    def make_key(request: requests.PreparedRequest) -> str:
+        #Ключ запроса: HTTP-метод, метод REST (последний сегмент пути), отсортированные
+        #параметры строки запроса и тело
+        url = urlsplit(request.url)
+        body = request.body or b""
+        if isinstance(body, str):
+            body = body.encode('utf-8')
+        payload = json.dumps([
+            request.method,
+            url.path.rstrip("/").rsplit("/", 1)[-1],
+            sorted(parse_qsl(url.query, keep_blank_values=True)),
+            hashlib.sha256(body).hexdigest(),
+        ], ensure_ascii=False)
+        return hashlib.sha256(payload.encode('utf-8')).hexdigest()
+
+    def _object_path(self, digest: str) -> Path:
+        return self.path / OBJECTS_DIR / digest[:2] / f"{digest}.gz"
+
+    @staticmethod
+    def _split_timing(body: bytes) -> Tuple[bytes, Optional[Dict]]:
+        #Блоки time и result[result_time] отличаются в каждом ответе, поэтому хранятся в журнале,
+        #а тело без них адресуется по содержимому и повторяется между запросами и записями
+        try:
+            payload = json.loads(body)
+        except ValueError:
+            return body, None
+        if not isinstance(payload, dict):
+            return body, None
+        timing = {}
+        if "time" in payload:
+            timing["time"] = payload.pop("time")
+        result = payload.get("result")
+        if isinstance(result, dict) and "result_time" in result:
+            timing["result_time"] = result.pop("result_time")
+        if not timing:
+            return body, None
+        return json.dumps(payload, ensure_ascii=False, separators=(',', ':')).encode('utf-8'), timing
+
+    @staticmethod
+    def _join_timing(body: bytes, timing: Optional[Dict]) -> bytes:
+        if not timing:
+            return body
+        payload = json.loads(body)
+        if "result_time" in timing:
+            payload["result"]["result_time"] = timing["result_time"]
+        if "time" in timing:
+            payload["time"] = timing["time"]
+        return json.dumps(payload, ensure_ascii=False, separators=(',', ':')).encode('utf-8')
+
+    def record(self, request: requests.PreparedRequest, response: requests.Response, elapsed: float) -> None:
+        body, timing = self._split_timing(response.content)
+        digest = hashlib.sha256(body).hexdigest()
+        entry = {
+            "key": self.make_key(request),
+            "method": urlsplit(request.url).path.rstrip("/").rsplit("/", 1)[-1],
+            "status": response.status_code,
+            "reason": response.reason,
+            "headers": {name: response.headers[name] for name in KEPT_HEADERS if name in response.headers},
+            "body": digest,
+            "timing": timing,
+            "elapsed": round(elapsed, 6),
+        }
+        object_path = self._object_path(digest)
+        with self._lock:
+            if not object_path.exists():
+                object_path.parent.mkdir(exist_ok=True)
+                tmp_path = object_path.with_name(object_path.name + ".tmp")
+                with open(tmp_path, 'wb') as f:
+                    f.write(gzip.compress(body, mtime=0))
+                os.replace(tmp_path, object_path)
+                self.stats["objects"] += 1
+            #Строка журнала дописывается сразу: прерванная запись оставляет рабочую кассету
+            self._index.write(json.dumps(entry, ensure_ascii=False) + "\n")
+            self._index.flush()
+            self.stats["recorded"] += 1
+
+    def replay(self, request: requests.PreparedRequest) -> requests.Response:
+        key = self.make_key(request)
+        with self._lock:
+            self.stats["requests"] += 1
+            entries = self._entries.get(key)
+            if not entries:
+                self.stats["misses"] += 1
+                method = urlsplit(request.url).path.rstrip("/").rsplit("/", 1)[-1]
+                raise CassetteMiss(f"Запроса нет в кассете {self.path}: {request.method} {method}", request=request)
+            entry = entries[min(self._positions[key], len(entries) - 1)]
+            self._positions[key] += 1
+
+        with open(self._object_path(entry["body"]), 'rb') as f:
+            body = self._join_timing(gzip.decompress(f.read()), entry.get("timing"))
+        if self.latency == "recorded":
+            time.sleep(entry["elapsed"])
+
+        response = requests.Response()
+        response.status_code = entry["status"]
+        response.reason = entry.get("reason")
+        response.headers = CaseInsensitiveDict(entry["headers"])
+        response._content = body
+        response.encoding = requests.utils.get_encoding_from_headers(response.headers) or 'utf-8'
+        response.url = request.url
+        response.request = request
+        response.elapsed = timedelta(seconds=entry["elapsed"])
+        return response
+
+    def close(self) -> None:
+        if self._index is not None:
+            self._index.close()
+            self._index = None
+
+
+class CassetteAdapter(HTTPAdapter):
+    #Транспорт сессии requests: при записи запрос уходит на портал и ответ сохраняется
+    #в кассету, при проигрывании ответ берётся из кассеты без сети
+    def __init__(self, store: CassetteStore, **kwargs):
+        super().__init__(**kwargs)
+        self.store = store
+
+    def send(self, request: requests.PreparedRequest, **kwargs) -> requests.Response:
+        if self.store.mode == "replay":
+            return self.store.replay(request)
+        #Session.send выставляет elapsed уже после адаптера, поэтому время замеряется здесь,
+        #включая чтение тела ответа
+        started = time.perf_counter()
+        response = super().send(request, **kwargs)
+        response.content
+        self.store.record(request, response, time.perf_counter() - started)
+        return response
@@ -1,7 +1,241 @@
 import requests
-from typing import Dict, Any, List, Optional
-import time
+from typing import (Dict, Any, AsyncIterable, AsyncIterator, Awaitable, Callable, Iterable, Iterator, List, Optional,
+                    Tuple, Union)
+from itertools import islice
+from urllib.parse import quote
+import asyncio
+import json
 import logging
+import re
+import tempfile
+import time
+from cache import ResponseCache
+from cassette import CassetteStore
+from metrics import Metrics
+from rate_limiter import RateLimiter
+from sync_state import merge_state
+from transport import ACCEPT_ENCODING, Transport
+
+try:
+    import aiohttp
+except ImportError:  #Асинхронный режим необязателен, aiohttp ставится отдельно
+    aiohttp = None
+
+BATCH_LIMIT = 50  #Максимум команд в одном запросе batch
+PAGE_SIZE = 50  #Размер страницы списочных методов Битрикс24
+RESULT_REF = re.compile(r"^\$result\[([^\]]+)\]((?:\[[^\]]*\])*)$")  #Ссылка $result[ключ][поле]... в команде batch
+DEAL_OWNER_TYPE_ID = 2  #Тип владельца "Сделка" в CRM
+USER_FIELDS = ["ID", "NAME", "LAST_NAME", "EMAIL", "WORK_POSITION"]  #Поля ответственного для отчёта
+CONTACT_FIELDS = ["*", "UF_*", "PHONE", "EMAIL"]  #crm.contact.list без select не отдаёт телефоны и почту
+MESSAGES_PAGE_SIZE = 50  #Максимальный LIMIT для im.dialog.messages.get
+DEALS_PER_BATCH = 8  #Сделок в одном batch пакетного режима: по 6 команд на сделку при лимите 50
+#Сущности CRM с DATE_MODIFY: метод получения -> списочный метод для сверки закэшированных записей
+VERSIONED_METHODS = {"crm.deal.get": "crm.deal.list", "crm.contact.get": "crm.contact.list"}
+
+def _flatten_params(params: Any, prefix: str = "") -> List[Tuple[str, str]]:
+    #Разворачивание вложенных параметров в пары в формате PHP: {"select": ["ID"]} -> select[0]=ID.
+    #Уже плоские ключи вида filter[OWNER_ID] проходят без изменений
+    items = params.items() if isinstance(params, dict) else enumerate(params)
+    pairs = []
+    for key, value in items:
+        name = f"{prefix}[{key}]" if prefix else str(key)
+        if isinstance(value, (dict, list, tuple)):
+            pairs.extend(_flatten_params(value, name))
+        else:
+            pairs.append((name, str(value)))
+    return pairs
+
+def _resolve_refs(params: Any, results: Dict, empty: Any = "") -> Tuple[Any, bool]:
+    #Подстановка $result[...] из уже известных результатов. Второй элемент - удалось ли
+    #разрешить все ссылки (иначе команда остаётся зависимой и уходит в batch как есть).
+    #empty подставляется вместо отсутствующих значений
+    if isinstance(params, dict):
+        resolved = {key: _resolve_refs(value, results, empty) for key, value in params.items()}
+        return {key: value for key, (value, _) in resolved.items()}, all(ok for _, ok in resolved.values())
+    if isinstance(params, (list, tuple)):
+        resolved = [_resolve_refs(value, results, empty) for value in params]
+        return [value for value, _ in resolved], all(ok for _, ok in resolved)
+    match = RESULT_REF.match(params) if isinstance(params, str) else None
+    if not match:
+        return params, True
+    if match.group(1) not in results:
+        return params, False
+
+    value = results[match.group(1)]
+    for part in re.findall(r"\[([^\]]*)\]", match.group(2)):
+        if isinstance(value, list) and part.isdigit() and int(part) < len(value):
+            value = value[int(part)]
+        elif isinstance(value, dict):
+            value = value.get(part)
+        else:
+            value = None
+    #Как и Битрикс24, по умолчанию отсутствующее значение подставляем пустой строкой
+    return (empty if value is None or value == "" else value), True
+
+def _rename_refs(params: Any, suffix: str) -> Any:
+    #Ссылки $result[ключ] в командах сделки, ключи которых в общем batch получили суффикс (ключ_15)
+    if isinstance(params, dict):
+        return {key: _rename_refs(value, suffix) for key, value in params.items()}
+    if isinstance(params, (list, tuple)):
+        return [_rename_refs(value, suffix) for value in params]
+    match = RESULT_REF.match(params) if isinstance(params, str) else None
+    if not match:
+        return params
+    return f"$result[{match.group(1)}{suffix}]{match.group(2)}"
+
+def _refers_to(params: Any, keys: Dict) -> bool:
+    #Есть ли в параметрах ссылка $result на одну из команд keys
+    if isinstance(params, dict):
+        return any(_refers_to(value, keys) for value in params.values())
+    if isinstance(params, (list, tuple)):
+        return any(_refers_to(value, keys) for value in params)
+    match = RESULT_REF.match(params) if isinstance(params, str) else None
+    return match is not None and match.group(1) in keys
+
+def _contains(params: Any, marker: Any) -> bool:
+    if isinstance(params, dict):
+        return any(_contains(value, marker) for value in params.values())
+    if isinstance(params, (list, tuple)):
+        return any(_contains(value, marker) for value in params)
+    return params is marker
+
+def _deal_scopes(commands: Dict[str, Tuple[str, Dict]], suffix: str = "") -> Dict[str, str]:
+    #По DATE_MODIFY какой команды проверяется закэшированный ответ: сделка и контакт - по своей
+    #дате, списки, диалог и сообщения - по дате сделки (своей даты изменения у них нет).
+    #user.get без DATE_MODIFY живёт в кэше по TTL
+    return {
+        f"{key}{suffix}": f"{key}{suffix}" if method in VERSIONED_METHODS else f"deal{suffix}"
+        for key, (method, _) in commands.items() if method != "user.get"
+    }
+
+def _versioned_ids(cache: Optional[ResponseCache], commands: Dict[str, Tuple[str, Dict]],
+                   scopes: Optional[Dict[str, str]]) -> Dict[str, List[str]]:
+    #ID закэшированных сделок и контактов, которые нужно сверить с порталом перед выдачей
+    #из кэша. Ссылки (контакт сделки) разрешаются по закэшированным же результатам
+    ids, cached = {}, {}
+    if cache is None or not scopes:
+        return ids
+    for key, (method, params) in commands.items():
+        if scopes.get(key) != key or method not in VERSIONED_METHODS:
+            continue
+        concrete, resolved = _resolve_refs(params, cached)
+        result = cache.peek(method, concrete) if resolved and concrete.get("id") else None
+        if result is not None:
+            cached[key] = result
+            ids.setdefault(method, []).append(str(concrete["id"]))
+    return ids
+
+def _version_commands(ids: Dict[str, List[str]]) -> Dict[str, str]:
+    #Команды batch с выборкой только ID и DATE_MODIFY (ключи вида crm.deal.get_0)
+    cmd = {}
+    for method, entity_ids in ids.items():
+        for start in range(0, len(entity_ids), PAGE_SIZE):
+            params = {"filter": {"ID": entity_ids[start:start + PAGE_SIZE]}, "select": ["ID", "DATE_MODIFY"]}
+            cmd[f"{method}_{start}"] = f"{VERSIONED_METHODS[method]}?{BitrixFetcher._build_query(params)}"
+    return cmd
+
+def _parse_versions(payload: Dict) -> Dict[Tuple[str, str], str]:
+    #{(метод, ID): DATE_MODIFY}; удалённых сущностей в ответе нет, и их записи не выдаются
+    versions = {}
+    for key, items in (payload.get("result") or {}).items():
+        method = key.rsplit("_", 1)[0]
+        for item in items or []:
+            if item.get("DATE_MODIFY"):
+                versions[(method, str(item.get("ID")))] = str(item["DATE_MODIFY"])
+    return versions
+
+def _scope_version(commands: Dict[str, Tuple[str, Dict]], scope: str, results: Dict,
+                   versions: Dict[Tuple[str, str], str]) -> Optional[str]:
+    #Актуальное DATE_MODIFY сущности, по которой проверяется команда, или None, если её не сверяли
+    if scope not in commands:
+        return None
+    method, params = commands[scope]
+    concrete, resolved = _resolve_refs(params, results)
+    return versions.get((method, str(concrete.get("id")))) if resolved else None
+
+def _split_cached(cache: Optional[ResponseCache], commands: Dict[str, Tuple[str, Dict]],
+                  metrics: Optional[Metrics] = None, scopes: Optional[Dict[str, str]] = None,
+                  versions: Optional[Dict[Tuple[str, str], str]] = None) -> Tuple[Dict, Dict]:
+    #Разделение команд batch на найденные в кэше и те, что нужно запросить.
+    #Ссылки на закэшированные результаты подставляются сразу, чтобы зависимые
+    #команды тоже можно было найти в кэше по конкретным параметрам. Пустой список
+    #pending означает, что запрос к порталу не нужен. Команды из scopes берутся из кэша,
+    #только если DATE_MODIFY их сущности совпал с актуальным из versions
+    results, pending = {}, {}
+    missing = object()
+    for key, (method, params) in commands.items():
+        concrete, resolved = _resolve_refs(params, results, missing)
+        if resolved and _contains(concrete, missing):
+            #Ссылка на пустое поле (например, у сделки нет диалога): Битрикс24 всё равно
+            #вернул бы ошибку, поэтому команда не отправляется
+            continue
+        if resolved and cache is not None and cache.is_cacheable(method):
+            cached = None
+            if scopes and key in scopes:
+                date_modify = _scope_version(commands, scopes[key], results, versions or {})
+                if date_modify is not None:
+                    cached = cache.get(method, concrete, date_modify)
+            else:
+                cached = cache.get(method, concrete)
+            if metrics is not None:
+                metrics.cache(method, cached is not None)
+            if cached is not None:
+                results[key] = cached
+                continue
+        pending[key] = (method, concrete if resolved else params)
+    return results, pending
+
+def _store_cached(cache: Optional[ResponseCache], commands: Dict[str, Tuple[str, Dict]],
+                  fetched: Dict, results: Dict, scopes: Optional[Dict[str, str]] = None) -> None:
+    #Сохранение в кэш только что полученных результатов под конкретными параметрами,
+    #команды из scopes - с DATE_MODIFY своей сущности
+    if cache is None:
+        return
+    for key in fetched:
+        method, params = commands[key]
+        if key not in results or not cache.is_cacheable(method):
+            continue
+        date_modify = None
+        if scopes and key in scopes:
+            owner = results.get(scopes[key])
+            if not isinstance(owner, dict) or not owner.get("DATE_MODIFY"):
+                continue  #Запись без даты сущности нельзя было бы сверить
+            date_modify = str(owner["DATE_MODIFY"])
+        concrete, resolved = _resolve_refs(params, results)
+        if resolved:
+            cache.set(method, concrete, results[key], date_modify)
+
+def _retry_after(headers: Any) -> Optional[float]:
+    #Значение заголовка Retry-After в секундах, если сервер его прислал
+    try:
+        return float(headers.get("Retry-After"))
+    except (AttributeError, TypeError, ValueError):
+        return None
+
+def _json_payload(response: requests.Response) -> Any:
+    #Тело ответа как JSON или None, если это не JSON (например, страница ошибки прокси)
+    try:
+        return response.json()
+    except ValueError:
+        return None
+
+def _limited_method(payload: Any, methods: Tuple[str, ...]) -> Optional[str]:
+    #OPERATION_TIME_LIMIT блокирует только вызванный метод, остальные ошибки - весь портал
+    if isinstance(payload, dict) and payload.get("error") == "OPERATION_TIME_LIMIT":
+        return methods[0]
+    return None
+
+def _limited_commands(queue: Dict[str, Tuple[str, Dict]], errors: Dict) -> Dict[str, Optional[str]]:
+    #Команды, отклонённые внутри batch по лимиту (QUERY_LIMIT_EXCEEDED, OPERATION_TIME_LIMIT
+    #в result_error): {ключ: метод для паузы или None - пауза всего портала}
+    return {
+        key: _limited_method(errors[key], (queue[key][0],))
+        for key in queue if key in errors and RateLimiter.is_limit_error(None, errors[key])
+    }
+
+async def _async_iter(items: Iterable[Any]) -> AsyncIterator[Any]:
+    for item in items:
+        yield item
 
 class BaseFetcher:
     def __init__(self, config: Dict[str, Any]):
@@ -10,50 +244,140 @@ class BaseFetcher:
         self.logger = config.get("logger", logging.getLogger(__name__))  #Логгер из конфигурации
         self.session = requests.Session()  #Общая сессия для запросов
         self.session.headers.update({"User-Agent": "DealDossier/1.0"})  #Заголовок User-Agent
+        #Лимитер можно передать в конфиге, чтобы все фетчеры процесса делили один бюджет запросов
+        self.rate_limiter = config.get("rate_limiter") or RateLimiter.from_config(config)
+        self.limit_retries = config.get("limit_retries", 5)  #Повторы после ответа о превышении лимита
+        #Кэш ответов (ResponseCache) включается через cache_path или передаётся готовым
+        self.cache = config.get("cache") or ResponseCache.from_config(config)
+        #Метрики запросов (Metrics); общий экземпляр передаётся в конфиге
+        self.metrics = config.get("metrics") or Metrics()
+        #Кассета (CassetteStore) записывает ответы портала или проигрывает их без сети
+        self.cassette = config.get("cassette") or CassetteStore.from_config(config)
+        #Транспорт: пул соединений, таймауты и повторы при сбоях сети и ответах 5xx
+        self.transport = config.get("transport") or Transport.from_config(config)
+        self.transport.mount(self.session, self.cassette)
+
+    def _request(self, http_method: str, url: str, methods: Tuple[str, ...], **kwargs) -> Dict:
+        #Единая точка отправки запросов к REST API: ожидание лимитера, повтор при
+        #превышении лимитов, при сбоях сети и ответах 5xx и учёт блока time из ответа.
+        #methods[0] - вызываемый метод, остальные - методы внутри batch, которые тоже могут быть на паузе
+        attempt = 0
+        failures = 0  #Повторы после временных сбоев
+        while True:
+            self.metrics.rate_limit_wait(self.rate_limiter.acquire(methods))
+            started = time.perf_counter()
+            try:
+                response = getattr(self.session, http_method)(url, timeout=self.transport.timeout, **kwargs)
+            except requests.RequestException as e:
+                self.metrics.request(methods[0], time.perf_counter() - started, 0, "error")
+                if Transport.is_transient(e) and failures < self.transport.retries:
+                    failures += 1
+                    self._retry_after_failure(methods[0], failures, e)
+                    continue
+                raise
+            self.metrics.request(methods[0], time.perf_counter() - started, len(response.content),
+                                 response.status_code)
+
+            if Transport.is_retry_status(response.status_code) and failures < self.transport.retries:
+                failures += 1
+                self._retry_after_failure(methods[0], failures, f"HTTP {response.status_code}")
+                continue
+
+            payload = _json_payload(response)
+            if RateLimiter.is_limit_error(response.status_code, payload) and attempt < self.limit_retries:
+                attempt += 1
+                self.metrics.retry(methods[0])
+                backoff = self.rate_limiter.penalize(
+                    _limited_method(payload, methods), _retry_after(response.headers)
+                )
+                self.logger.warning("Превышен лимит запросов Битрикс24, повтор через %.1f с", backoff)
+                continue
 
-    def _handle_pagination(self, url: str, params: Dict, max_pages: int = 100) -> List[Dict]:
-        #Обработка пагинации API с ограничением максимального числа страниц
-        results = []
+            response.raise_for_status()  #Проверка на HTTP-ошибки
+            if payload is None:
+                payload = response.json()
+            self.rate_limiter.observe(methods[0], payload.get("time"))
+            return payload
+
+    def _retry_after_failure(self, method: str, failure: int, reason: Any) -> None:
+        delay = self.transport.delay(failure)
+        self.metrics.retry(method)
+        self.logger.warning("Сбой запроса %s к Битрикс24 (%s), повтор %d через %.1f с", method, reason, failure, delay)
+        self.transport.sleep(delay)
+
+    def _handle_pagination(self, url: str, params: Dict, max_pages: Optional[int] = 100) -> List[Dict]:
+        #Обработка пагинации API с ограничением максимального числа страниц.
+        #Собирает всё в список; для потоковой обработки используйте iter_items
+        return list(self.iter_items(url, params, max_pages))
+
+    def iter_items(self, url: str, params: Dict, max_pages: Optional[int] = 100,
+                   keyset: bool = False, key: str = "ID", after: Any = None, strict: bool = False) -> Iterator[Dict]:
+        #Элементы списочного метода по одному, по мере получения страниц
+        for page in self.iter_pages(url, params, max_pages, keyset, key, after, strict):
+            yield from page
+
+    def iter_pages(self, url: str, params: Dict, max_pages: Optional[int] = 100,
+                   keyset: bool = False, key: str = "ID", after: Any = None,
+                   strict: bool = False) -> Iterator[List[Dict]]:
+        #Постраничный обход списочного метода. В режиме keyset вместо смещения start
+        #используется фильтр filter[>ID]=последний ID с сортировкой по ID и start=-1:
+        #Битрикс24 не считает total, и глубокие страницы не замедляются.
+        #after - ключ, после которого начинать (продолжение уже полученного списка),
+        #max_pages=None снимает ограничение на число страниц. strict - ошибка запроса
+        #пробрасывается, а не завершает обход молча
+        params = dict(_flatten_params(params))
+        if keyset:
+            params[f"order[{key}]"] = "ASC"
+            params["start"] = -1
+        method = url.rsplit("/", 1)[-1]
         start = 0  # Смещение для пагинации
+        last_id = after  #Последний полученный ключ для режима keyset
         page_count = 0  #Счетчик обработанных страниц
-        
+
         while True:
             # Защита от бесконечного цикла
-            if page_count >= max_pages:
+            if max_pages is not None and page_count >= max_pages:
                 self.logger.warning(f"Достигнут лимит пагинации ({max_pages} страниц)")
                 break
-            
+
             try:
-                params["start"] = start
-                response = self.session.get(url, params=params)
-                response.raise_for_status()  #Проверка на HTTP-ошибки
-                data = response.json()
-                
-                #Логирование для отладки
-                self.logger.debug(f"Пагинация: start={start}, получено {len(data.get('result', []))} элементов")
-                
-                #Прерываем, если данных нет
-                if not data.get("result"):
-                    break
-                
-                #Сбор результатов
-                results.extend(data["result"])
-                start += len(data["result"])  #Увеличиваем смещение
-                page_count += 1
+                if keyset:
+                    if last_id is not None:
+                        params[f"filter[>{key}]"] = last_id
+                else:
+                    params["start"] = start
+                data = self._request("get", url, (method,), params=params)
+            except Exception as e:
+                if strict:
+                    raise
+                self.logger.error(f"Ошибка пагинации: {str(e)}")
+                break
+
+            page = data.get("result") or []
+            #Логирование для отладки
+            if keyset:
+                self.logger.debug("Пагинация: %s>%s, получено %d элементов", key, last_id, len(page))
+            else:
+                self.logger.debug("Пагинация: start=%d, получено %d элементов", start, len(page))
+
+            #Прерываем, если данных нет
+            if not page:
+                break
 
+            page_count += 1
+            yield page
+
+            if keyset:
+                #Неполная страница - последняя
+                last_id = page[-1].get(key)
+                if len(page) < PAGE_SIZE or last_id is None:
+                    break
+            else:
+                start += len(page)  #Увеличиваем смещение
                 #Остановка, если достигнут общий объем данных
                 if "total" in data and start >= data["total"]:
                     break
 
-                #Задержка для соблюдения лимитов API
-                time.sleep(0.3)
-                
-            except Exception as e:
-                self.logger.error(f"Ошибка пагинации: {str(e)}")
-                break
-        
-        return results
-    
 
 class BitrixFetcher(BaseFetcher):
     def __init__(self, config: Dict[str, Any]):
@@ -61,72 +385,467 @@ class BitrixFetcher(BaseFetcher):
         #Формирование базового URL для Битрикс 24 REST API
         self.base_url = f"{config['bitrix_url']}/rest/1/{config['bitrix_token']}/"
         self.session.params = {}  #Сброс параметров по умолчанию
+        #Справочники на время жизни фетчера: ответственные и контакты по ID, диалоги по ID сделки
+        self._users: Dict[str, Dict] = {}
+        self._contacts: Dict[str, Dict] = {}
+        self._dialog_ids: Dict[int, str] = {}
 
     #Здесь представлен основной метод для получения данных о сделке
     def get_deal_data(self, deal_id: int) -> Dict:
-        #Сначала вызываются базовые методы API, потом зависимые
-        methods_order = [
-            ("deal", "crm.deal.get"),         #Основные данные сделки
-            ("contact", "crm.contact.get"),   #Данные контакта
-            ("user", "user.get"),             #Информация об ответственном
-            ("timeline", "crm.timeline.comment.list"),  #Комментарии
-            ("activities", "crm.activity.list"),        #Активности
-            ("dialog_messages", "im.dialog.messages.get"),  #Сообщения чата
-            ("openline_dialog", "imopenlines.dialog.get")   #Данные диалога
-        ]
+        #Все вызовы упакованы в один запрос batch: независимые методы выполняются
+        #сразу, а зависимые (ответственный, контакт, диалог) ссылаются на результат сделки
+        return self._fetch_deal(deal_id)
 
-        data = {}
+    def get_deal_data_incremental(self, deal_id: int, state: Optional[Dict] = None) -> Dict:
+        #Инкрементальное обновление по сохранённому состоянию (см. sync_state): запрашиваются
+        #только новые комментарии и сообщения и изменённые активности, затем они сливаются
+        #с накопленными данными. Возвращает новое состояние {"deal_id", "data", "watermarks"};
+        #при ошибке в data есть ключ "error", а водяные знаки остаются прежними
+        watermarks = state.get("watermarks", {}) if state else None
+        data = self._fetch_deal(deal_id, watermarks)
+        if data.get("error"):
+            return {"deal_id": deal_id, "data": data, "watermarks": watermarks or {}}
+        return merge_state(deal_id, state, data)
+
+    def get_deals_data(self, deal_ids: Iterable[int], chunk_size: int = DEALS_PER_BATCH) -> Iterator[Tuple[int, Dict]]:
+        #Пакетная загрузка досье с тем же форматом данных, что и get_deal_data. Сделки
+        #обрабатываются группами: один batch на данные группы и один на ответственных
+        #и контакты, которых ещё нет в памяти фетчера. Общие для сделок пользователи
+        #и контакты запрашиваются один раз за всё время работы фетчера
+        deal_ids = iter(deal_ids)
+        while True:
+            chunk = list(islice(deal_ids, chunk_size))
+            if not chunk:
+                return
+            yield from self._fetch_chunk(chunk)
+
+    def iter_deal_ids(self, filters: Optional[Dict] = None, after: Optional[int] = None) -> Iterator[int]:
+        #ID сделок по фильтру crm.deal.list (например STAGE_ID, CATEGORY_ID, >=DATE_MODIFY,
+        #ASSIGNED_BY_ID) в порядке возрастания. Обход в режиме keyset без ограничения
+        #страниц: ID отдаются по мере получения страниц, а сбой запроса прерывает обход ошибкой
+        params = {"filter": filters or {}, "select": ["ID"]}
+        for item in self.iter_items(f"{self.base_url}crm.deal.list", params, max_pages=None,
+                                    keyset=True, after=after, strict=True):
+            yield int(item["ID"])
+
+    def lookup_entities(self, user_ids: Iterable[Any], contact_ids: Iterable[Any]) -> Tuple[Dict[str, Dict], Dict[str, Dict]]:
+        #Ответственные и контакты по ID без повторов. Известные берутся из памяти фетчера
+        #и кэша ответов (контакты - после сверки DATE_MODIFY с порталом), остальные - одним
+        #batch из user.get и crm.contact.list с фильтром по списку ID (по 50 ID на команду).
+        #Возвращает справочники {ID: данные}
+        lookups = {
+            "users": (self._users, user_ids, "user.get", lambda ids: {"FILTER": {"ID": ids}}),
+            "contacts": (self._contacts, contact_ids, "crm.contact.list",
+                         lambda ids: {"filter": {"ID": ids}, "select": CONTACT_FIELDS})
+        }
+        wanted = {name: sorted({str(i) for i in ids if i and str(i) != "0"} - memo.keys())
+                  for name, (memo, ids, _, _) in lookups.items()}
+        versions = {}
+        if self.cache is not None:
+            versions = self._current_versions({"crm.contact.get": [
+                entity_id for entity_id in wanted["contacts"]
+                if self.cache.peek("crm.contact.get", {"id": entity_id}) is not None
+            ]})
+
+        commands = {}
+        for name, (memo, _, method, params) in lookups.items():
+            missing = []
+            for entity_id in wanted[name]:
+                cached = self._cached_entity(name, entity_id, versions)
+                if cached is not None:
+                    memo[entity_id] = cached
+                else:
+                    missing.append(entity_id)
+            for start in range(0, len(missing), PAGE_SIZE):
+                commands[f"{name}_{start}"] = (method, params(missing[start:start + PAGE_SIZE]))
+
+        if commands:
+            results, errors = self.call_batch(commands)
+            for key, items in results.items():
+                name = key.rsplit("_", 1)[0]
+                for item in items or []:
+                    lookups[name][0][str(item.get("ID"))] = item
+                    self._store_entity(name, item)
+            for key, error in errors.items():
+                self.logger.warning(f"Ошибка справочника {key}: {self._batch_error(error)}")
+
+        return self._users, self._contacts
+
+    def _cached_entity(self, name: str, entity_id: str, versions: Dict[Tuple[str, str], str]) -> Optional[Dict]:
+        #Справочники хранятся в кэше под теми же ключами, что и у одиночных user.get/crm.contact.get.
+        #Контакт выдаётся, только если его DATE_MODIFY в versions совпал с закэшированным
+        if self.cache is None:
+            return None
+        if name == "users":
+            users = self.cache.get("user.get", {"id": entity_id, "select": USER_FIELDS})
+            self.metrics.cache("user.get", bool(users))
+            return users[0] if users else None
+        date_modify = versions.get(("crm.contact.get", entity_id))
+        contact = self.cache.get("crm.contact.get", {"id": entity_id}, date_modify) if date_modify else None
+        self.metrics.cache("crm.contact.get", contact is not None)
+        return contact
+
+    def _store_entity(self, name: str, item: Dict) -> None:
+        if self.cache is None:
+            return
+        if name == "users":
+            self.cache.set("user.get", {"id": item.get("ID"), "select": USER_FIELDS}, [item])
+        else:
+            self.cache.set("crm.contact.get", {"id": item.get("ID")}, item)
+
+    def _fetch_chunk(self, chunk: List[int]) -> Iterator[Tuple[int, Dict]]:
+        #Данные группы сделок одним batch (ключи вида deal_15), затем общий запрос справочников
+        commands_by_deal = {
+            deal_id: self._deal_commands(deal_id, dialog_id=self._dialog_ids.get(deal_id), lookups=False)
+            for deal_id in chunk
+        }
+        commands = {
+            f"{key}_{deal_id}": (method, _rename_refs(params, f"_{deal_id}"))
+            for deal_id, deal_commands in commands_by_deal.items()
+            for key, (method, params) in deal_commands.items()
+        }
+        scopes = {
+            key: scope for deal_id, deal_commands in commands_by_deal.items()
+            for key, scope in _deal_scopes(deal_commands, f"_{deal_id}").items()
+        }
         try:
-            #Первый шаг. Получение базовых данных (сделка и контакт)
-            for key, method in methods_order[:2]:
-                url = f"{self.base_url}{method}"
-                response = self.session.get(url, params={"id": deal_id})
-                response.raise_for_status()
-                data[key] = response.json().get("result", {})
-
-            #Второй шаг. Получение зависимых данных
-            for key, method in methods_order[2:]:
-                url = f"{self.base_url}{method}"
-                params = {}
-                
-                #Обработка данных пользователя(ответственное лицо)
-                if method == "user.get":
-                    user_id = data["deal"].get("ASSIGNED_BY_ID")
-                    if not user_id:
-                        data[key] = {"error": "Ответственный не указан"}
-                        continue
-                    #Выборка конкретных полей пользователя
-                    params = {
-                        "id": user_id,
-                        "select": ["ID", "NAME", "LAST_NAME", "EMAIL", "WORK_POSITION"]
-                    }
-
-                #Обработка диалогов
-                elif method in ["im.dialog.messages.get", "imopenlines.dialog.get"]:
-                    dialog_id = self._get_dialog_id(deal_id)
-                    
-                    #Валидация ID диалога
-                    if not dialog_id or dialog_id == "0":
-                        data[key] = {"info": "Диалог отсутствует"}
-                        continue
-                    
-                    params = {"DIALOG_ID": dialog_id}
-                    if method == "im.dialog.messages.get":
-                        params["LIMIT"] = 200  #Лимит поставил 200 для сообщений
-
-                #Выполнение запроса
-                response = self.session.get(url, params=params)
-                response.raise_for_status()
-                data[key] = response.json().get("result", {})
+            results, errors = self.call_batch(commands, scopes=scopes)
+        except Exception as e:
+            self.logger.error(f"Ошибка: {str(e)}")
+            for deal_id in chunk:
+                yield deal_id, {"error": str(e)}
+            return
 
+        per_deal = {}
+        for deal_id, deal_commands in commands_by_deal.items():
+            per_deal[deal_id] = (
+                {key: results[f"{key}_{deal_id}"] for key in deal_commands if f"{key}_{deal_id}" in results},
+                {key: errors[f"{key}_{deal_id}"] for key in deal_commands if f"{key}_{deal_id}" in errors}
+            )
+
+        deals = [deal_results.get("deal") or {} for deal_results, _ in per_deal.values()]
+        lookup_error = None
+        try:
+            users, contacts = self.lookup_entities(
+                [deal.get("ASSIGNED_BY_ID") for deal in deals], [deal.get("CONTACT_ID") for deal in deals]
+            )
+        except Exception as e:
+            self.logger.error(f"Ошибка получения ответственных и контактов: {str(e)}")
+            users, contacts, lookup_error = {}, {}, {"error_description": str(e)}
+
+        for deal_id, (deal_results, deal_errors) in per_deal.items():
+            data = {}
+            try:
+                deal = deal_results.get("deal") or {}
+                #Раздача общих справочников по сделкам в формате ответов user.get/crm.contact.get
+                if lookup_error:
+                    deal_errors["user"] = lookup_error
+                elif str(deal.get("ASSIGNED_BY_ID")) in users:
+                    deal_results["user"] = [users[str(deal.get("ASSIGNED_BY_ID"))]]
+                if str(deal.get("CONTACT_ID")) in contacts:
+                    deal_results["contact"] = contacts[str(deal.get("CONTACT_ID"))]
+                self._remember_dialog(deal_id, deal_results)
+
+                data = self._parse_deal_batch(deal_results, deal_errors)
+                self._fetch_remaining(commands_by_deal[deal_id], data)
+            except Exception as e:
+                self.logger.error(f"Ошибка: {str(e)}")
+                data["error"] = str(e)
+            yield deal_id, data
+
+    def _fetch_deal(self, deal_id: int, watermarks: Optional[Dict] = None) -> Dict:
+        data = {}
+        try:
+            commands = self._deal_commands(deal_id, watermarks, dialog_id=self._dialog_ids.get(deal_id))
+            results, errors = self.call_batch(commands, scopes=_deal_scopes(commands))
+            self._remember_dialog(deal_id, results)
+            data = self._parse_deal_batch(results, errors)
+            self._fetch_remaining(commands, data)
         except Exception as e:
             self.logger.error(f"Ошибка: {str(e)}")
             data["error"] = str(e)
 
         return data
 
+    def _remember_dialog(self, deal_id: int, results: Dict) -> None:
+        #ID диалога сделки не меняется, поэтому найденный ID запоминается, а для известного
+        #подставляется ответ поиска, чтобы разбор batch не отличался
+        if deal_id in self._dialog_ids:
+            results["dialog_activity"] = [{"ASSOCIATED_ENTITY_ID": self._dialog_ids[deal_id]}]
+            return
+        dialog_id = self._dialog_id_from(results.get("dialog_activity"))
+        if dialog_id:
+            self._dialog_ids[deal_id] = dialog_id
+
+    def call_batch(self, commands: Dict[str, Tuple[str, Dict]], halt: bool = False,
+                   scopes: Optional[Dict[str, str]] = None) -> Tuple[Dict, Dict]:
+        #Выполнение набора команд {ключ: (метод, параметры)} через метод batch.
+        #Команды отправляются пачками по BATCH_LIMIT, поэтому ссылки $result[ключ]
+        #работают только между командами одной пачки. scopes ({ключ: ключ команды сделки
+        #или контакта}, см. _deal_scopes) - команды, которые берутся из кэша только после
+        #сверки DATE_MODIFY их сущности с порталом. Команды, отклонённые по лимиту внутри
+        #batch, повторяются после паузы (не больше limit_retries раз)
+        versions = self._current_versions(_versioned_ids(self.cache, commands, scopes))
+        results, pending = _split_cached(self.cache, commands, self.metrics, scopes, versions)
+        errors = {}
+        queue = pending
+        attempt = 0
+        while queue:
+            keys = list(queue)
+            for i in range(0, len(keys), BATCH_LIMIT):
+                cmd = {}
+                for key in keys[i:i + BATCH_LIMIT]:
+                    method, params = queue[key]
+                    cmd[key] = f"{method}?{self._build_query(params)}"
+
+                methods = ("batch", *{queue[key][0] for key in cmd})
+                payload = self._request(
+                    "post", f"{self.base_url}batch", methods, json={"halt": int(halt), "cmd": cmd}
+                ).get("result", {})
+                result_time = payload.get("result_time") or {}
+                for key, time_info in result_time.items():
+                    self.rate_limiter.observe(commands[key][0], time_info)
+                self._count_commands(cmd, queue, result_time)
+
+                #Пустые результаты Битрикс24 возвращает как [] вместо {}
+                results.update(payload.get("result") or {})
+                errors.update(payload.get("result_error") or {})
+
+            limited = _limited_commands(queue, errors)
+            if not limited or attempt >= self.limit_retries:
+                break
+            attempt += 1
+            queue = self._retry_limited(queue, limited, results, errors)
+
+        _store_cached(self.cache, commands, pending, results, scopes)
+        return results, errors
+
+    def _retry_limited(self, queue: Dict[str, Tuple[str, Dict]], limited: Dict[str, Optional[str]],
+                       results: Dict, errors: Dict) -> Dict[str, Tuple[str, Dict]]:
+        #Пауза для методов отклонённых команд и команды для повтора: отклонённые и зависящие
+        #от них (они выполнились с пустой ссылкой). Их результаты и ошибки убираются,
+        #а ссылки на уже полученные результаты подставляются (пачка повтора может их не содержать)
+        backoff = max(self.rate_limiter.penalize(method) for method in set(limited.values()))
+        retry = {}
+        for key, (method, params) in queue.items():
+            if key in limited or _refers_to(params, retry):
+                retry[key] = (method, params)
+                results.pop(key, None)
+                errors.pop(key, None)
+        for key in limited:
+            self.metrics.retry(queue[key][0])
+        self.logger.warning("Превышен лимит для %d команд batch, повтор через %.1f с", len(limited), backoff)
+        return {key: (method, _resolve_refs(params, results)[0]) for key, (method, params) in retry.items()}
+
+    def _current_versions(self, ids: Dict[str, List[str]]) -> Dict[Tuple[str, str], str]:
+        #Актуальные DATE_MODIFY закэшированных сущностей {метод: [ID]}: один batch с выборкой
+        #ID и DATE_MODIFY списочными методами в обход кэша вместо загрузки сущностей целиком
+        ids = {method: entity_ids for method, entity_ids in ids.items() if entity_ids}
+        if not ids:
+            return {}
+        cmd = _version_commands(ids)
+        payload = self._request(
+            "post", f"{self.base_url}batch", ("batch", *{VERSIONED_METHODS[method] for method in ids}),
+            json={"halt": 0, "cmd": cmd}
+        ).get("result", {})
+        for value in cmd.values():
+            self.metrics.command(value.split("?", 1)[0], None)
+        return _parse_versions(payload)
+
+    def _count_commands(self, cmd: Dict[str, str], pending: Dict[str, Tuple[str, Dict]], result_time: Dict) -> None:
+        #Команды пачки по методам; время выполнения на портале - duration из result_time
+        for key in cmd:
+            time_info = result_time.get(key) if isinstance(result_time, dict) else None
+            self.metrics.command(pending[key][0], time_info.get("duration") if isinstance(time_info, dict) else None)
+
+    @staticmethod
+    def _build_query(params: Any) -> str:
+        #Сборка query-строки в формате PHP (select[0]=ID&filter[>ID]=5) для команды batch.
+        #Символы $ и [] не экранируются, чтобы Битрикс24 мог подставить $result[...]
+        return "&".join(
+            f"{quote(name, safe='[]')}={quote(value, safe='[]$')}" for name, value in _flatten_params(params)
+        )
+
+    @staticmethod
+    def _deal_commands(deal_id: int, watermarks: Optional[Dict] = None, dialog_id: Optional[str] = None,
+                       lookups: bool = True) -> Dict[str, Tuple[str, Dict]]:
+        #Команды batch для досье одной сделки. Порядок важен: зависимые команды
+        #должны идти после тех, на чьи результаты они ссылаются.
+        #С водяными знаками списки и сообщения запрашиваются только после них, при известном
+        #dialog_id поиск диалога не нужен, lookups=False убирает запросы ответственного и контакта
+        watermarks = watermarks or {}
+        dialog_ref = dialog_id or "$result[dialog_activity][0][ASSOCIATED_ENTITY_ID]"
+        messages_params = {"DIALOG_ID": dialog_ref, "LIMIT": 200}  #Лимит поставил 200 для сообщений
+        if watermarks.get("message_id"):
+            messages_params["FIRST_ID"] = watermarks["message_id"]
+
+        commands = {"deal": ("crm.deal.get", {"id": deal_id})}  #Основные данные сделки
+        if lookups:
+            commands["contact"] = ("crm.contact.get", {"id": "$result[deal][CONTACT_ID]"})  #Данные контакта
+            commands["user"] = ("user.get", {  #Информация об ответственном
+                "id": "$result[deal][ASSIGNED_BY_ID]",
+                "select": USER_FIELDS
+            })
+        commands.update(BitrixFetcher._list_commands(deal_id, watermarks))  #Комментарии и активности
+        if not dialog_id:
+            commands["dialog_activity"] = ("crm.activity.list", {  #Активность 'Открытая линия' с ID диалога
+                "filter": {
+                    "OWNER_ID": deal_id,
+                    "OWNER_TYPE_ID": DEAL_OWNER_TYPE_ID,
+                    "PROVIDER_ID": "IMOPENLINES_SESSION"
+                },
+                "select": ["ASSOCIATED_ENTITY_ID"]
+            })
+        commands["dialog_messages"] = ("im.dialog.messages.get", messages_params)  #Сообщения чата
+        commands["openline_dialog"] = ("imopenlines.dialog.get", {"DIALOG_ID": dialog_ref})  #Данные диалога
+        return commands
+
+    @staticmethod
+    def _list_commands(deal_id: int, watermarks: Optional[Dict] = None) -> Dict[str, Tuple[str, Dict]]:
+        #Списочные методы досье. Сортировка по ID позволяет дочитать длинные списки
+        #в режиме keyset, начиная с последнего ID первой страницы.
+        #Комментарии берутся после последнего известного ID, активности - изменённые
+        #после последнего LAST_UPDATED (у активностей нет поля DATE_MODIFY)
+        watermarks = watermarks or {}
+        timeline_filter = {"ENTITY_ID": deal_id, "ENTITY_TYPE": "deal"}
+        if watermarks.get("timeline_id"):
+            timeline_filter[">ID"] = watermarks["timeline_id"]
+        activity_filter = {"OWNER_ID": deal_id, "OWNER_TYPE_ID": DEAL_OWNER_TYPE_ID}
+        if watermarks.get("activity_updated"):
+            activity_filter[">LAST_UPDATED"] = watermarks["activity_updated"]
+        return {
+            "timeline": ("crm.timeline.comment.list", {  #Комментарии
+                "filter": timeline_filter,
+                "order": {"ID": "ASC"}
+            }),
+            "activities": ("crm.activity.list", {  #Активности
+                "filter": activity_filter,
+                "order": {"ID": "ASC"}
+            })
+        }
+
+    def _fetch_remaining(self, commands: Dict[str, Tuple[str, Dict]], data: Dict) -> None:
+        #batch возвращает только первую страницу списков; полные страницы дочитываются
+        #постранично через keyset, без пересчёта total на глубоких смещениях
+        for key in ("timeline", "activities"):
+            method, params = commands[key]
+            items = data.get(key)
+            if isinstance(items, list) and len(items) >= PAGE_SIZE:
+                items.extend(self.iter_items(
+                    f"{self.base_url}{method}", params, max_pages=self.config.get("max_pages"),
+                    keyset=True, after=items[-1].get("ID")
+                ))
+
+    @staticmethod
+    def _parse_deal_batch(results: Dict, errors: Dict) -> Dict:
+        #Разбор ответа batch в привычную структуру get_deal_data
+        if "deal" in errors:
+            raise RuntimeError(BitrixFetcher._batch_error(errors["deal"]))
+
+        data = {"deal": results.get("deal") or {}}
+        deal = data["deal"]
+
+        #Контакт может быть не привязан к сделке, тогда ссылка $result пустая
+        data["contact"] = (results.get("contact") or {}) if deal.get("CONTACT_ID") else {}
+
+        #Обработка данных пользователя(ответственное лицо)
+        if not deal.get("ASSIGNED_BY_ID"):
+            data["user"] = {"error": "Ответственный не указан"}
+        elif "user" in errors:
+            data["user"] = {"error": BitrixFetcher._batch_error(errors["user"])}
+        else:
+            users = results.get("user") or []
+            #user.get возвращает список, для отчёта нужен один пользователь
+            data["user"] = users[0] if isinstance(users, list) and users else users or {}
+
+        data["timeline"] = results.get("timeline") or []
+        data["activities"] = results.get("activities") or []
+
+        #Обработка диалогов
+        dialog_id = BitrixFetcher._dialog_id_from(results.get("dialog_activity"))
+        for key in ("dialog_messages", "openline_dialog"):
+            if not dialog_id:
+                data[key] = {"info": "Диалог отсутствует"}
+            elif key in errors:
+                data[key] = {"error": BitrixFetcher._batch_error(errors[key])}
+            else:
+                data[key] = results.get(key) or {}
+
+        return data
+
+    @staticmethod
+    def _dialog_id_from(activities: Optional[List[Dict]]) -> Optional[str]:
+        #Извлечение и проверка ID диалога из активностей 'Открытая линия'
+        if not activities:
+            return None
+        dialog_id = str(activities[0].get("ASSOCIATED_ENTITY_ID", ""))
+        return dialog_id if dialog_id and dialog_id != "0" else None
+
+    @staticmethod
+    def _batch_error(error: Any) -> str:
+        #Текст ошибки отдельной команды batch
+        if isinstance(error, dict):
+            return error.get("error_description") or error.get("error") or str(error)
+        return str(error)
+
+    def iter_dialog_messages(self, dialog_id: str, limit: Optional[int] = None, after_id: int = 0) -> Iterator[Dict]:
+        #Полная история диалога в хронологическом порядке. Страницы читаются курсором
+        #FIRST_ID (сообщения с ID больше последнего полученного), поэтому в памяти
+        #держится одна страница. limit ограничивает общее число сообщений, None - без ограничения
+        url = f"{self.base_url}im.dialog.messages.get"
+        last_id = int(after_id)
+        sent = 0
+        while limit is None or sent < limit:
+            page_size = MESSAGES_PAGE_SIZE if limit is None else min(MESSAGES_PAGE_SIZE, limit - sent)
+            payload = self._request("get", url, ("im.dialog.messages.get",), params={
+                "DIALOG_ID": dialog_id,
+                "FIRST_ID": last_id,
+                "LIMIT": page_size
+            })
+            result = payload.get("result") or {}
+            #Внутри страницы Битрикс24 отдаёт сообщения от новых к старым
+            messages = sorted(
+                (msg for msg in result.get("messages") or [] if int(msg.get("id", 0)) > last_id),
+                key=lambda msg: int(msg["id"])
+            )
+            self.logger.debug("История диалога %s: после %s получено %d сообщений", dialog_id, last_id, len(messages))
+            if not messages:
+                return
+
+            yield from messages
+            sent += len(messages)
+            last_id = int(messages[-1]["id"])
+            if len(messages) < page_size:
+                return
+
+    def invalidate_deal(self, deal_id: int) -> None:
+        #Сброс закэшированных ответов по сделке (данные, списки, сообщения известного диалога),
+        #чтобы следующая загрузка после события Битрикс24 не получила устаревшие данные
+        if self.cache is None:
+            return
+        commands = self._deal_commands(deal_id, dialog_id=self._dialog_ids.get(deal_id), lookups=False)
+        for method, params in commands.values():
+            if _resolve_refs(params, {})[1]:  #Команды со ссылками на другие результаты кэшируются иначе
+                self.cache.invalidate(method, params)
+
+    def find_deal_by_dialog(self, dialog_id: str) -> Optional[int]:
+        #ID сделки по ID диалога среди сделок, уже загруженных этим фетчером
+        for deal_id, known in self._dialog_ids.items():
+            if known == dialog_id:
+                return deal_id
+        return None
+
+    def dialog_history(self, deal_id: int, limit: Optional[int] = None,
+                       last_id: Optional[int] = None) -> Optional["DialogHistory"]:
+        #Ленивая полная история диалога сделки или None, если диалога нет.
+        #last_id - ID последнего известного сообщения, из него строится отпечаток истории
+        dialog_id = self._get_dialog_id(deal_id)
+        return DialogHistory(self, dialog_id, limit, last_id) if dialog_id else None
+
     def _get_dialog_id(self, deal_id: int) -> Optional[str]:
-        #Поиск ID диалога через активность 'Открытая линия'
+        #Поиск ID диалога через активность 'Открытая линия', найденный ID запоминается
+        if deal_id in self._dialog_ids:
+            return self._dialog_ids[deal_id]
         try:
             url = f"{self.base_url}crm.activity.list"
             #Фильтр для активности типа "Чат открытой линии"
@@ -135,18 +854,267 @@ class BitrixFetcher(BaseFetcher):
                 "filter[PROVIDER_ID]": "IMOPENLINES_SESSION",
                 "select": ["ASSOCIATED_ENTITY_ID"]
             }
-            response = self.session.get(url, params=params)
-            response.raise_for_status()
-            activities = response.json().get("result", [])
-            
-            #Собственно, проверка на наличие активностей
-            if not activities:
-                return None
-                
-            #Извлечение и проверка ID диалога    
-            dialog_id = str(activities[0].get("ASSOCIATED_ENTITY_ID", ""))
-            return dialog_id if dialog_id and dialog_id != "0" else None
+            payload = self._request("get", url, ("crm.activity.list",), params=params)
+            dialog_id = self._dialog_id_from(payload.get("result", []))
+            if dialog_id:
+                self._dialog_ids[deal_id] = dialog_id
+            return dialog_id
             
         except Exception as e:
             self.logger.error(f"Ошибка получения диалога: {str(e)}")
-            return None
\ No newline at end of file
+            return None
+
+
+class DialogHistory:
+    #Повторно итерируемая история диалога, которая читается из API один раз: сообщения
+    #по мере получения пишутся во временный файл (строка JSON на сообщение), и следующие
+    #проходы (выгрузка, лента и диалог каждого формата) читают их оттуда. Список целиком
+    #в памяти не хранится. Проходы могут идти одновременно: кто опережает, тот дочитывает API
+    def __init__(self, fetcher: BitrixFetcher, dialog_id: str, limit: Optional[int] = None,
+                 last_id: Optional[int] = None):
+        self.fetcher = fetcher
+        self.dialog_id = dialog_id
+        self.limit = limit
+        self.last_id = last_id
+        self._source: Optional[Iterator[Dict]] = None
+        self._spool = None
+        self._count = 0  #Сообщений во временном файле
+        self._complete = False
+
+    def fingerprint(self) -> Optional[List[Any]]:
+        #Для отпечатка отчёта (report_fingerprint): история без новых сообщений не изменилась
+        if self.last_id is None:
+            return None
+        return [self.dialog_id, self.last_id, self.limit]
+
+    def __iter__(self) -> Iterator[Dict]:
+        if self._spool is None:
+            self._spool = tempfile.TemporaryFile()
+            self._source = self.fetcher.iter_dialog_messages(self.dialog_id, self.limit)
+        index, offset = 0, 0
+        while True:
+            if index < self._count:
+                self._spool.seek(offset)
+                line = self._spool.readline()
+                offset = self._spool.tell()
+            elif self._complete:
+                return
+            else:
+                message = next(self._source, None)
+                if message is None:
+                    self._complete = True
+                    return
+                line = json.dumps(message, ensure_ascii=False).encode('utf-8') + b"\n"
+                self._spool.seek(0, 2)
+                self._spool.write(line)
+                offset = self._spool.tell()
+                self._count += 1
+            index += 1
+            yield json.loads(line)
+
+    def close(self) -> None:
+        if self._spool is not None:
+            self._spool.close()
+
+
+class AsyncBitrixFetcher:
+    #Асинхронный клиент с тем же контрактом get_deal_data, что и у BitrixFetcher.
+    #Одновременно выполняется не больше concurrency HTTP-запросов на все сделки
+    def __init__(self, config: Dict[str, Any], concurrency: int = 10):
+        if aiohttp is None:
+            raise ImportError("Для асинхронного режима нужен пакет aiohttp")
+        self.config = config
+        self.logger = config.get("logger", logging.getLogger(__name__))  #Логгер из конфигурации
+        self.base_url = f"{config['bitrix_url']}/rest/1/{config['bitrix_token']}/"
+        self.concurrency = max(1, concurrency)
+        self.rate_limiter = config.get("rate_limiter") or RateLimiter.from_config(config)
+        self.limit_retries = config.get("limit_retries", 5)
+        self.cache = config.get("cache") or ResponseCache.from_config(config)
+        self.metrics = config.get("metrics") or Metrics()
+        self.transport = config.get("transport") or Transport.from_config(config)
+        self.session = None  #Создаётся в __aenter__, внутри работающего event loop
+        self._semaphore = None
+
+    async def __aenter__(self) -> "AsyncBitrixFetcher":
+        #Размер пула соединений совпадает с лимитом одновременных запросов
+        self._semaphore = asyncio.Semaphore(self.concurrency)
+        connect_timeout, read_timeout = self.transport.timeout
+        self.session = aiohttp.ClientSession(
+            headers={"User-Agent": "DealDossier/1.0", "Accept-Encoding": ACCEPT_ENCODING},
+            connector=aiohttp.TCPConnector(limit=self.concurrency),
+            timeout=aiohttp.ClientTimeout(connect=connect_timeout, sock_read=read_timeout)
+        )
+        return self
+
+    async def __aexit__(self, *exc_info) -> None:
+        await self.session.close()
+        self.session = None
+
+    async def get_deal_data(self, deal_id: int) -> Dict:
+        #Все методы сделки уходят одним запросом batch, как и в BitrixFetcher
+        return await self._fetch_deal(deal_id)
+
+    async def get_deal_data_incremental(self, deal_id: int, state: Optional[Dict] = None) -> Dict:
+        #Асинхронный аналог BitrixFetcher.get_deal_data_incremental
+        watermarks = state.get("watermarks", {}) if state else None
+        data = await self._fetch_deal(deal_id, watermarks)
+        if data.get("error"):
+            return {"deal_id": deal_id, "data": data, "watermarks": watermarks or {}}
+        return merge_state(deal_id, state, data)
+
+    async def _fetch_deal(self, deal_id: int, watermarks: Optional[Dict] = None) -> Dict:
+        data = {}
+        try:
+            commands = BitrixFetcher._deal_commands(deal_id, watermarks)
+            results, errors = await self.call_batch(commands, scopes=_deal_scopes(commands))
+            data = BitrixFetcher._parse_deal_batch(results, errors)
+            await self._fetch_remaining(commands, data)
+        except Exception as e:
+            self.logger.error(f"Ошибка: {str(e)}")
+            data["error"] = str(e)
+
+        return data
+
+    async def _fetch_remaining(self, commands: Dict[str, Tuple[str, Dict]], data: Dict) -> None:
+        #Дочитывание длинных списков в режиме keyset, как в BitrixFetcher._fetch_remaining
+        for key in ("timeline", "activities"):
+            method, params = commands[key]
+            items = data.get(key)
+            page = items
+            while isinstance(page, list) and len(page) >= PAGE_SIZE:
+                page_params = {**params, "start": -1, "filter": {**params["filter"], ">ID": page[-1].get("ID")}}
+                #Сделки в пачке нет, сверить страницу не с чем, поэтому она запрашивается в обход кэша
+                results, errors = await self.call_batch({key: (method, page_params)}, scopes={key: "deal"})
+                if key in errors:
+                    raise RuntimeError(BitrixFetcher._batch_error(errors[key]))
+                page = results.get(key) or []
+                items.extend(page)
+
+    async def get_deals_data(self, deal_ids: Union[Iterable[int], AsyncIterable[int]],
+                             fetch: Optional[Callable[[int], Awaitable[Dict]]] = None) -> AsyncIterator[Tuple[int, Dict]]:
+        #Обработка множества сделок: в работе держится не больше concurrency досье,
+        #результаты отдаются по мере готовности, а не в порядке ID.
+        #fetch заменяет get_deal_data, например для инкрементального режима.
+        #Источник ID с блокирующим чтением (обход crm.deal.list, stdin) передаётся асинхронным
+        #итератором, чтобы ожидание следующего ID не останавливало загрузку уже начатых сделок
+        fetch = fetch or self.get_deal_data
+        deal_ids = deal_ids.__aiter__() if hasattr(deal_ids, "__aiter__") else _async_iter(deal_ids)
+        pending = {}
+
+        async def schedule() -> bool:
+            try:
+                deal_id = await deal_ids.__anext__()
+            except StopAsyncIteration:
+                return False
+            pending[asyncio.ensure_future(fetch(deal_id))] = deal_id
+            return True
+
+        while len(pending) < self.concurrency and await schedule():
+            pass
+
+        while pending:
+            done, _ = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+            for task in done:
+                deal_id = pending.pop(task)
+                await schedule()
+                yield deal_id, task.result()
+
+    async def call_batch(self, commands: Dict[str, Tuple[str, Dict]], halt: bool = False,
+                         scopes: Optional[Dict[str, str]] = None) -> Tuple[Dict, Dict]:
+        #Асинхронный аналог BitrixFetcher.call_batch, пачки одной сделки отправляются параллельно
+        versions = await self._current_versions(_versioned_ids(self.cache, commands, scopes))
+        results, pending = _split_cached(self.cache, commands, self.metrics, scopes, versions)
+        errors = {}
+        queue = pending
+        attempt = 0
+        while queue:
+            keys = list(queue)
+            chunks = [keys[i:i + BATCH_LIMIT] for i in range(0, len(keys), BATCH_LIMIT)]
+            payloads = await asyncio.gather(*(
+                self._post_batch({key: f"{queue[key][0]}?{BitrixFetcher._build_query(queue[key][1])}"
+                                  for key in chunk}, halt)
+                for chunk in chunks
+            ))
+
+            for payload in payloads:
+                for key, time_info in (payload.get("result_time") or {}).items():
+                    self.rate_limiter.observe(commands[key][0], time_info)
+                #Пустые результаты Битрикс24 возвращает как [] вместо {}
+                results.update(payload.get("result") or {})
+                errors.update(payload.get("result_error") or {})
+
+            limited = _limited_commands(queue, errors)
+            if not limited or attempt >= self.limit_retries:
+                break
+            attempt += 1
+            queue = self._retry_limited(queue, limited, results, errors)
+
+        _store_cached(self.cache, commands, pending, results, scopes)
+        return results, errors
+
+    #Пауза и повтор команд, отклонённых по лимиту внутри batch, - как в BitrixFetcher
+    _retry_limited = BitrixFetcher._retry_limited
+
+    async def _current_versions(self, ids: Dict[str, List[str]]) -> Dict[Tuple[str, str], str]:
+        #Асинхронный аналог BitrixFetcher._current_versions
+        ids = {method: entity_ids for method, entity_ids in ids.items() if entity_ids}
+        if not ids:
+            return {}
+        return _parse_versions(await self._post_batch(_version_commands(ids), False))
+
+    async def _post_batch(self, cmd: Dict[str, str], halt: bool) -> Dict:
+        #Отправка одной пачки через общий лимитер, с повтором при превышении лимита,
+        #сбоях соединения и ответах 5xx (пауза перед повтором - вне семафора)
+        methods = ("batch", *{value.split("?", 1)[0] for value in cmd.values()})
+        attempt = 0
+        failures = 0
+        while True:
+            self.metrics.rate_limit_wait(await self.rate_limiter.acquire_async(methods))
+            failure = None
+            async with self._semaphore:
+                started = time.perf_counter()
+                try:
+                    async with self.session.post(f"{self.base_url}batch", json={"halt": int(halt), "cmd": cmd}) as response:
+                        try:
+                            payload = await response.json(content_type=None)
+                        except ValueError:
+                            payload = None
+                        if RateLimiter.is_limit_error(response.status, payload) and attempt < self.limit_retries:
+                            self.metrics.request("batch", time.perf_counter() - started, 0, response.status)
+                            self.metrics.retry("batch")
+                            attempt += 1
+                            backoff = self.rate_limiter.penalize(_limited_method(payload, methods),
+                                                                 _retry_after(response.headers))
+                            self.logger.warning("Превышен лимит запросов Битрикс24, повтор через %.1f с", backoff)
+                            continue
+                        if Transport.is_retry_status(response.status) and failures < self.transport.retries:
+                            self.metrics.request("batch", time.perf_counter() - started, 0, response.status)
+                            failure = f"HTTP {response.status}"
+                        else:
+                            response.raise_for_status()
+                            if payload is None:
+                                payload = await response.json()
+                            self.metrics.request("batch", time.perf_counter() - started, len(await response.read()),
+                                                 response.status)
+                except (aiohttp.ClientConnectionError, asyncio.TimeoutError) as e:
+                    self.metrics.request("batch", time.perf_counter() - started, 0, "error")
+                    if failures >= self.transport.retries:
+                        raise
+                    failure = e
+
+            if failure is not None:
+                failures += 1
+                delay = self.transport.delay(failures)
+                self.metrics.retry("batch")
+                self.logger.warning("Сбой запроса batch к Битрикс24 (%s), повтор %d через %.1f с", failure, failures, delay)
+                await asyncio.sleep(delay)
+                continue
+
+            self.rate_limiter.observe("batch", payload.get("time"))
+            result = payload.get("result", {})
+            result_time = result.get("result_time") if isinstance(result, dict) else None
+            for key, value in cmd.items():
+                time_info = result_time.get(key) if isinstance(result_time, dict) else None
+                self.metrics.command(value.split("?", 1)[0],
+                                     time_info.get("duration") if isinstance(time_info, dict) else None)
+            return result
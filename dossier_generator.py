@@ -1,52 +1,168 @@
+import io
 import json
-from typing import Dict
+from datetime import date, datetime
+from functools import partial
+from typing import Any, Callable, Dict, Iterator, TextIO, Tuple
+
+from processors import MESSAGE_FIELDS, _first, _message_date
+
+try:
+    import orjson
+except ImportError:  #Быстрый кодировщик необязателен, без него JSON пишется стандартным json
+    orjson = None
+
+def _is_sequence(value: Any) -> bool:
+    #Списки и ленивые последовательности (лента, история диалога), но не строки и словари
+    return hasattr(value, '__iter__') and not isinstance(value, (str, bytes, dict))
+
+def _json_default(value: Any) -> Any:
+    #События ленты (TimelineEvent) выводятся словарём, даты - в ISO 8601, вложенные ленивые
+    #последовательности раскрываются в список (ленту и сообщения _json_chunks пишет по элементам),
+    #остальные типы приводятся к строке
+    if hasattr(value, 'as_dict'):
+        return value.as_dict()
+    if isinstance(value, date):
+        return value.isoformat()
+    if _is_sequence(value):
+        return list(value)
+    return str(value)
+
+def _event_fields(event: Any) -> Tuple[datetime, str, str]:
+    #Дата, тип и описание события: TimelineEvent из merge_timeline или словарь старого формата
+    if isinstance(event, dict):
+        return event['date'], event['type'], event['data'].get('SUBJECT', '')
+    return event.date, event.type, event.subject or ''
+
+#Кодировщики стандартного json для потоковой записи: с отступами и компактный
+_JSON_ENCODERS = {
+    False: json.JSONEncoder(indent=2, ensure_ascii=False, default=_json_default),
+    True: json.JSONEncoder(separators=(',', ':'), ensure_ascii=False, default=_json_default),
+}
+
+def _shift(text: str, depth: int) -> str:
+    #Многострочный вывод вложенного значения сдвигается на уровень вложенности
+    return text.replace("\n", "\n" + "  " * depth) if depth else text
+
+def _orjson_dump(value: Any, depth: int, option: int) -> str:
+    #Кодирование одного значения через orjson
+    text = orjson.dumps(value, default=_json_default, option=option).decode('utf-8')
+    return _shift(text, depth) if option & orjson.OPT_INDENT_2 else text
+
+def _stdlib_dump(value: Any, depth: int, compact: bool) -> str:
+    #Кодирование одного значения стандартным json
+    text = _JSON_ENCODERS[compact].encode(value)
+    return text if compact else _shift(text, depth)
+
+def _json_chunks(value: Any, dump: Callable[[Any, int], str], compact: bool, depth: int = 0) -> Iterator[str]:
+    #Части JSON-отчёта: отчёт и его разделы-словари раскладываются по ключам, списки и итераторы
+    #(события ленты, сообщения) - по элементам, и каждый элемент кодируется отдельным вызовом dump,
+    #поэтому ленивые последовательности не собираются в список. Вывод совпадает с JSONEncoder
+    #с теми же отступами
+    indent = "" if compact else "\n" + "  " * (depth + 1)
+    closing = "" if compact else "\n" + "  " * depth
+    if isinstance(value, dict) and depth < 2:
+        if not value:
+            yield "{}"
+            return
+        for number, (key, item) in enumerate(value.items()):
+            yield ("," if number else "{") + indent + dump(str(key), 0) + (":" if compact else ": ")
+            yield from _json_chunks(item, dump, compact, depth + 1)
+        yield closing + "}"
+    elif _is_sequence(value) and depth < 3:
+        empty = True
+        for element in value:
+            yield ("[" if empty else ",") + indent + dump(element, depth + 1)
+            empty = False
+        yield "[]" if empty else closing + "]"
+    else:
+        yield dump(value, depth)
+
+def _message_fields(message: Dict) -> Tuple[Any, Any, Any]:
+    #Дата, автор и текст сообщения диалога: im.dialog.messages.get отдаёт date, author_id и text,
+    #в старых выгрузках встречаются DATE, AUTHOR и MESSAGE. Отсутствующие поля - None
+    text, author = (_first(message, *names) for names in MESSAGE_FIELDS[:2])
+    try:
+        date = _message_date(message)
+    except KeyError:
+        date = None
+    return date, author, text
 
 class ReportGenerator:
     @staticmethod
     #Создание JSON-отчёта
-    def generate_json(data: Dict) -> str:
-        #Функция преобразует входные данные в формат JSON
-        return json.dumps(data, indent=2, ensure_ascii=False, default=str)
+    def generate_json(data: Dict, compact: bool = False) -> str:
+        #Функция преобразует входные данные в формат JSON (строкой, поверх render_json)
+        buffer = io.StringIO()
+        ReportGenerator.render_json(data, buffer, compact)
+        return buffer.getvalue()
+
+    @staticmethod
+    def render_json(data: Dict, fp: TextIO, compact: bool = False) -> None:
+        #Запись JSON-отчёта в текстовый поток по событиям ленты и сообщениям, не собирая его
+        #в одну строку. Если установлен orjson, части кодируются им (даты он сериализует сам,
+        #события ленты передаются в _json_default); иначе - стандартным json
+        if orjson is not None:
+            option = orjson.OPT_NON_STR_KEYS | orjson.OPT_PASSTHROUGH_DATACLASS
+            if not compact:
+                option |= orjson.OPT_INDENT_2
+            dump = partial(_orjson_dump, option=option)
+        else:
+            dump = partial(_stdlib_dump, compact=compact)
+        fp.writelines(_json_chunks(data, dump, compact))
 
     @staticmethod
     def generate_markdown(data: Dict) -> str:
-        #Функция создаёт Markdown-отчёты по сделке
-        md = f"# Отчёт по сделке {data['deal_id']}\n\n" #Создание заголовка отчёта
+        #Функция создаёт Markdown-отчёты по сделке (строкой, поверх render_markdown)
+        buffer = io.StringIO()
+        ReportGenerator.render_markdown(data, buffer)
+        return buffer.getvalue()
+
+    @staticmethod
+    def render_markdown(data: Dict, fp: TextIO) -> None:
+        #Потоковая запись Markdown-отчёта в текстовый поток: разделы пишутся по мере
+        #формирования, лента и сообщения могут быть итераторами и в памяти не копятся
+        write = fp.write
+        write(f"# Отчёт по сделке {data['deal_id']}\n\n") #Создание заголовка отчёта
         #Добавляется информация о событиях в хронологическом порядке
         for event in data['timeline']:
-            md += f"## {event['date'].strftime('%Y-%m-%d %H:%M')}\n"
-            md += f"- Тип: {event['type']}\n"
-            md += f"- Детали: {event['data'].get('SUBJECT', '')}\n\n"
-        
+            date, event_type, subject = _event_fields(event)
+            write(
+                f"## {date.strftime('%Y-%m-%d %H:%M')}\n"
+                f"- Тип: {event_type}\n"
+                f"- Детали: {subject}\n\n"
+            )
+
         #Вывод информации об ответственном
         user_data = data.get("user", {})
         if isinstance(user_data, dict):
             if user_data.get("ID"):
-                md += "## Ответственный\n"
-                md += f"- Имя: {user_data.get('NAME', 'Не указано')}\n"
-                md += f"- Фамилия: {user_data.get('LAST_NAME', 'Не указана')}\n"
-                md += f"- Должность: {user_data.get('WORK_POSITION', 'Не указана')}\n"
-                md += f"- Email: {user_data.get('EMAIL', 'Не указан')}\n\n"
+                write(
+                    "## Ответственный\n"
+                    f"- Имя: {user_data.get('NAME', 'Не указано')}\n"
+                    f"- Фамилия: {user_data.get('LAST_NAME', 'Не указана')}\n"
+                    f"- Должность: {user_data.get('WORK_POSITION', 'Не указана')}\n"
+                    f"- Email: {user_data.get('EMAIL', 'Не указан')}\n\n"
+                )
             elif user_data.get("error"):
-                md += f"## Ответственный: {user_data['error']}\n\n"
+                write(f"## Ответственный: {user_data['error']}\n\n")
             else:
-                md += "## Ответственный: Данные отсутствуют\n\n"
+                write("## Ответственный: Данные отсутствуют\n\n")
         else:
-            md += "## Ответственный: Некорректный формат данных\n\n"
-            
-       #Вывод истории диалогов
-        dialog = data.get('dialog_messages', {})
+            write("## Ответственный: Некорректный формат данных\n\n")
+
+        #Вывод истории диалогов. Сообщения могут быть ленивым итератором полной истории,
+        #они выводятся по мере чтения
+        dialog = data.get('dialog_messages', data.get('dialog', {}))
         if isinstance(dialog, dict):
             if 'info' in dialog:
-                md += f"## Переписка: {dialog['info']}\n\n"
+                write(f"## Переписка: {dialog['info']}\n\n")
             elif 'messages' in dialog:
-                md += "## История переписки\n"
+                write("## История переписки\n")
                 for msg in dialog['messages']:
-                    md += (
-                        f"**{msg.get('DATE', 'Дата неизвестна')} "
-                        f"{msg.get('AUTHOR', 'Неизвестный автор')}**: "
-                        f"{msg.get('MESSAGE', 'Текст отсутствует')}\n"
+                    date, author, text = _message_fields(msg)
+                    write(
+                        f"**{'Дата неизвестна' if date is None else date} "
+                        f"{'Неизвестный автор' if author is None else author}**: "
+                        f"{'Текст отсутствует' if text is None else text}\n"
                     )
-                md += "\n"
-
-        return md
\ No newline at end of file
+                write("\n")
@@ -0,0 +1,130 @@
+import json
+from pathlib import Path
+from typing import Dict, Iterable, List, Union
+
+from processors import TimelineEvent
+
+try:
+    import orjson
+except ImportError:  #Быстрый кодировщик необязателен, без него строки кодирует стандартный json
+    orjson = None
+
+try:
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+except ImportError:  #Выгрузка в Parquet необязательна, pyarrow ставится отдельно
+    pa = None
+    pq = None
+
+ROW_GROUP_SIZE = 100000  #Событий в одной группе строк Parquet
+
+#Колонки Parquet-выгрузки: по строке на событие merge_timeline (в NDJSON смещение пояса входит в дату)
+EXPORT_FIELDS = ("deal_id", "type", "date", "tz_offset", "subject", "author", "id")
+
+
+def _record(deal_id: int, event: TimelineEvent) -> Dict:
+    return {
+        "deal_id": deal_id,
+        "type": event.type,
+        "date": event.date.isoformat(),
+        "subject": event.subject,
+        "author": event.author,
+        "id": event.source_id
+    }
+
+
+class NdjsonExporter:
+    #Выгрузка лент всех сделок запуска в один NDJSON-файл: по JSON-объекту на строку,
+    #строки сделки дописываются одним вызовом в буферизованный файл
+    def __init__(self, path: Union[str, Path]):
+        self.path = Path(path)
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        self.rows = 0
+        self._file = open(self.path, 'w', encoding='utf-8', buffering=1 << 20)
+
+    def write_deal(self, deal_id: int, events: Iterable[TimelineEvent]) -> int:
+        if orjson is not None:
+            lines = [orjson.dumps(_record(deal_id, event)).decode('utf-8') + "\n" for event in events]
+        else:
+            lines = [json.dumps(_record(deal_id, event), ensure_ascii=False) + "\n" for event in events]
+        self._file.writelines(lines)
+        self.rows += len(lines)
+        return len(lines)
+
+    def close(self) -> None:
+        self._file.close()
+
+    def __enter__(self) -> "NdjsonExporter":
+        return self
+
+    def __exit__(self, *exc_info) -> None:
+        self.close()
+
+
+class ParquetExporter:
+    #Выгрузка лент в колоночный Parquet-файл. События копятся по колонкам и сбрасываются
+    #группами строк по row_group_size, так что в памяти не держится вся выгрузка.
+    #Дата хранится как время без пояса (для дат со смещением - в UTC), смещение - в tz_offset
+    def __init__(self, path: Union[str, Path], row_group_size: int = ROW_GROUP_SIZE):
+        if pa is None:
+            raise ImportError("Для выгрузки в Parquet нужен пакет pyarrow")
+        self.path = Path(path)
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        self.row_group_size = row_group_size
+        self.rows = 0
+        self.schema = pa.schema([
+            ("deal_id", pa.int64()),
+            ("type", pa.string()),
+            ("date", pa.timestamp("s")),
+            ("tz_offset", pa.int16()),
+            ("subject", pa.string()),
+            ("author", pa.string()),
+            ("id", pa.string()),
+        ])
+        self._writer = pq.ParquetWriter(str(self.path), self.schema)
+        self._columns: Dict[str, List] = {name: [] for name in EXPORT_FIELDS}
+
+    def write_deal(self, deal_id: int, events: Iterable[TimelineEvent]) -> int:
+        columns = self._columns
+        count = 0
+        for event in events:
+            columns["deal_id"].append(deal_id)
+            columns["type"].append(event.type)
+            columns["date"].append(event.timestamp)
+            columns["tz_offset"].append(event.tz_offset)
+            columns["subject"].append(event.subject)
+            columns["author"].append(None if event.author is None else str(event.author))
+            columns["id"].append(None if event.source_id is None else str(event.source_id))
+            count += 1
+            if len(columns["deal_id"]) >= self.row_group_size:
+                self._flush()
+        self.rows += count
+        return count
+
+    def _flush(self) -> None:
+        if not self._columns["deal_id"]:
+            return
+        table = pa.Table.from_pydict(self._columns, schema=self.schema)
+        self._writer.write_table(table, row_group_size=self.row_group_size)
+        for column in self._columns.values():
+            column.clear()
+
+    def close(self) -> None:
+        self._flush()
+        self._writer.close()
+
+    def __enter__(self) -> "ParquetExporter":
+        return self
+
+    def __exit__(self, *exc_info) -> None:
+        self.close()
+
+
+TimelineExporter = Union[NdjsonExporter, ParquetExporter]
+
+
+def open_exporter(path: Union[str, Path]) -> TimelineExporter:
+    #Формат выгрузки определяется расширением: .parquet - Parquet, иначе NDJSON
+    if Path(path).suffix.lower() == ".parquet":
+        return ParquetExporter(path)
+    return NdjsonExporter(path)
@@ -0,0 +1,544 @@
+import argparse
+import gzip
+import json
+import operator
+import re
+import threading
+import time
+from collections import Counter
+from datetime import datetime, timedelta, timezone
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Any, Callable, Dict, Iterable, List, Optional, Tuple
+from urllib.parse import parse_qsl, urlsplit
+
+#Локальная замена REST API Битрикс24 для сквозных тестов и замеров производительности.
+#Данные портала синтетические и вычисляются по ID сделки, поэтому размер портала
+#не влияет на память сервера
+
+PAGE_SIZE = 50  #Размер страницы списочных методов, как у Битрикс24
+BATCH_LIMIT = 50
+MESSAGES_LIMIT = 50  #Максимальный LIMIT im.dialog.messages.get
+BASE_DATE = datetime(2025, 1, 1, 9, 0, tzinfo=timezone(timedelta(hours=3)))
+RESULT_REF = re.compile(r"^\$result\[([^\]]+)\]((?:\[[^\]]*\])*)$")
+DEAL_OWNER_TYPE_ID = "2"
+SESSION_PROVIDER = "IMOPENLINES_SESSION"
+DEAL_STAGES = ("NEW", "PREPARATION", "EXECUTING", "WON", "LOSE")
+#Операции сравнения в ключах фильтра; двухсимвольные проверяются раньше односимвольных
+COMPARISONS = {">=": operator.ge, "<=": operator.le, ">": operator.gt, "<": operator.lt}
+
+
+class FakeError(Exception):
+    def __init__(self, status: int, error: str, description: str):
+        super().__init__(description)
+        self.status = status
+        self.payload = {"error": error, "error_description": description}
+
+
+def _date(minutes: int) -> str:
+    return (BASE_DATE + timedelta(minutes=minutes)).isoformat()
+
+
+def _nest(pairs: Iterable[Tuple[str, Any]]) -> Dict:
+    #Параметры в формате PHP (filter[>ID]=5&select[0]=ID) во вложенные словари и списки
+    root: Dict = {}
+    for name, value in pairs:
+        head = name.split("[", 1)[0]
+        keys = [head] + re.findall(r"\[([^\]]*)\]", name[len(head):])
+        node = root
+        for key in keys[:-1]:
+            node = node.setdefault(key, {})
+        node[keys[-1]] = value
+    return _lists(root)
+
+
+def _lists(value: Any) -> Any:
+    if not isinstance(value, dict):
+        return value
+    value = {key: _lists(item) for key, item in value.items()}
+    if value and all(key.isdigit() for key in value):
+        return [value[key] for key in sorted(value, key=int)]
+    return value
+
+
+def _lookup(params: Dict, name: str) -> Any:
+    #Битрикс24 не различает регистр имён параметров (id/ID, filter/FILTER)
+    for key, value in params.items():
+        if key.lower() == name.lower():
+            return value
+    return None
+
+
+def _matches(item: Dict, filters: Dict) -> bool:
+    #Фильтр списочных методов: точное значение, список значений или сравнение с префиксом
+    #(>=, <=, >, <); числа сравниваются как числа, остальное (в том числе даты ISO) - как строки
+    for key, expected in filters.items():
+        prefix = next((prefix for prefix in COMPARISONS if key.startswith(prefix)), None)
+        if prefix is not None:
+            actual = item.get(key[len(prefix):])
+            if actual is None:
+                return False
+            if str(actual).isdigit() and str(expected).isdigit():
+                actual, expected = int(actual), int(expected)
+            else:
+                actual, expected = str(actual), str(expected)
+            if not COMPARISONS[prefix](actual, expected):
+                return False
+        elif isinstance(expected, list):
+            if str(item.get(key)) not in {str(value) for value in expected}:
+                return False
+        elif str(item.get(key)) != str(expected):
+            return False
+    return True
+
+
+class FakePortal:
+    #Синтетический портал: deals сделок, у каждой comments комментариев, activities активностей
+    #и (если messages > 0) диалог открытой линии с messages сообщениями
+    def __init__(self, deals: int = 100, comments: int = 20, activities: int = 10, messages: int = 50,
+                 users: int = 20):
+        self.deals = deals
+        self.comments = comments
+        self.activities = activities
+        self.messages = messages
+        self.users = users
+        self.edits: Counter = Counter()  #Число изменений сделок после генерации, см. touch
+        self.methods: Dict[str, Callable[[Dict], Any]] = {
+            "crm.deal.get": self.deal_get,
+            "crm.deal.list": self.deal_list,
+            "crm.contact.get": self.contact_get,
+            "crm.contact.list": self.contact_list,
+            "user.get": self.user_get,
+            "crm.timeline.comment.list": self.comment_list,
+            "crm.activity.list": self.activity_list,
+            "im.dialog.messages.get": self.messages_get,
+            "imopenlines.dialog.get": self.dialog_get,
+        }
+
+    def call(self, method: str, params: Dict) -> Tuple[Any, Dict]:
+        #Результат метода и дополнительные поля ответа (total, next)
+        handler = self.methods.get(method)
+        if handler is None:
+            raise FakeError(404, "ERROR_METHOD_NOT_FOUND", "Method not found!")
+        result = handler(params)
+        if isinstance(result, tuple):
+            return result
+        return result, {}
+
+    #Сущности
+    def deal(self, deal_id: int) -> Dict:
+        return {
+            "ID": str(deal_id),
+            "TITLE": f"Сделка {deal_id}",
+            "STAGE_ID": DEAL_STAGES[deal_id % len(DEAL_STAGES)],
+            "CATEGORY_ID": str(deal_id % 2),
+            "OPPORTUNITY": f"{deal_id * 1000}.00",
+            "CURRENCY_ID": "RUB",
+            "ASSIGNED_BY_ID": str(1 + deal_id % self.users),
+            "CONTACT_ID": str(deal_id),
+            "DATE_CREATE": _date(deal_id),
+            "DATE_MODIFY": _date(deal_id + 60 + self.edits[deal_id]),
+        }
+
+    def touch(self, deal_id: int) -> None:
+        #Изменение сделки на портале: сдвигается её DATE_MODIFY
+        self.edits[deal_id] += 1
+
+    def contact(self, contact_id: int) -> Dict:
+        return {
+            "ID": str(contact_id),
+            "NAME": f"Клиент {contact_id}",
+            "LAST_NAME": "Тестовый",
+            "PHONE": [{"VALUE": f"+7900{contact_id:07d}", "VALUE_TYPE": "WORK"}],
+            "EMAIL": [{"VALUE": f"client{contact_id}@example.com", "VALUE_TYPE": "WORK"}],
+            "DATE_MODIFY": _date(contact_id),
+        }
+
+    def user(self, user_id: int) -> Dict:
+        return {
+            "ID": str(user_id),
+            "NAME": f"Менеджер {user_id}",
+            "LAST_NAME": "Продажный",
+            "EMAIL": f"manager{user_id}@example.com",
+            "WORK_POSITION": "Менеджер по продажам",
+        }
+
+    def _comments(self, deal_id: int) -> List[Dict]:
+        return [{
+            "ID": str(deal_id * 1000000 + k),
+            "ENTITY_ID": str(deal_id),
+            "ENTITY_TYPE": "deal",
+            "CREATED": _date(deal_id * 60 + k * 3),
+            "AUTHOR_ID": str(1 + (deal_id + k) % self.users),
+            "COMMENT": f"Комментарий {k} по сделке {deal_id}",
+        } for k in range(1, self.comments + 1)]
+
+    def _activities(self, deal_id: int) -> List[Dict]:
+        items = []
+        if self.messages:
+            items.append({
+                "ID": str(deal_id * 1000000),
+                "OWNER_ID": str(deal_id),
+                "OWNER_TYPE_ID": DEAL_OWNER_TYPE_ID,
+                "PROVIDER_ID": SESSION_PROVIDER,
+                "ASSOCIATED_ENTITY_ID": f"chat{deal_id}",
+                "SUBJECT": "Чат открытой линии",
+                "CREATED": _date(deal_id * 60),
+                "LAST_UPDATED": _date(deal_id * 60),
+                "AUTHOR_ID": "1",
+            })
+        for k in range(1, self.activities + 1):
+            created = _date(deal_id * 60 + k * 5)
+            items.append({
+                "ID": str(deal_id * 1000000 + k),
+                "OWNER_ID": str(deal_id),
+                "OWNER_TYPE_ID": DEAL_OWNER_TYPE_ID,
+                "PROVIDER_ID": "CRM_TODO" if k % 2 else "VOXIMPLANT_CALL",
+                "ASSOCIATED_ENTITY_ID": "0",
+                "SUBJECT": f"Дело {k} по сделке {deal_id}",
+                "CREATED": created,
+                "LAST_UPDATED": created,
+                "AUTHOR_ID": str(1 + (deal_id + k) % self.users),
+            })
+        return items
+
+    def _messages(self, dialog_id: str) -> List[Dict]:
+        match = re.fullmatch(r"chat(\d+)", str(dialog_id))
+        if not match or not self.messages or not 1 <= int(match.group(1)) <= self.deals:
+            raise FakeError(400, "DIALOG_ID_EMPTY", "Dialog ID can't be empty")
+        deal_id = int(match.group(1))
+        return [{
+            "id": deal_id * 1000000 + k,
+            "chat_id": deal_id,
+            "author_id": 1 + k % 2,
+            "date": _date(deal_id * 60 + k),
+            "text": f"Сообщение {k}",
+        } for k in range(1, self.messages + 1)]
+
+    def _existing(self, value: Any) -> int:
+        #ID сделки или контакта (у сделки N контакт N)
+        entity_id = int(value) if str(value).isdigit() else 0
+        if not 1 <= entity_id <= self.deals:
+            raise FakeError(400, "", "Not found")
+        return entity_id
+
+    #Методы REST API
+    def deal_get(self, params: Dict) -> Dict:
+        return self.deal(self._existing(_lookup(params, "id")))
+
+    def deal_list(self, params: Dict) -> Tuple[List[Dict], Dict]:
+        #Сделки генерируются по порядку ID, поэтому выборка с фильтром >ID не перебирает весь портал
+        filters = _lookup(params, "filter") or {}
+        first = int(filters.get(">ID", 0)) + 1 if str(filters.get(">ID", "")).isdigit() else 1
+        deals = (self.deal(deal_id) for deal_id in range(first, self.deals + 1))
+        rest = {key: value for key, value in filters.items() if key != ">ID"}
+        return self._page([deal for deal in deals if _matches(deal, rest)], params)
+
+    def contact_get(self, params: Dict) -> Dict:
+        return self.contact(self._existing(_lookup(params, "id")))
+
+    def contact_list(self, params: Dict) -> Tuple[List[Dict], Dict]:
+        ids = (_lookup(params, "filter") or {}).get("ID") or []
+        ids = ids if isinstance(ids, list) else [ids]
+        return self._page([self.contact(int(i)) for i in ids if str(i).isdigit() and 1 <= int(i) <= self.deals],
+                          params)
+
+    def user_get(self, params: Dict) -> List[Dict]:
+        ids = _lookup(params, "id")
+        if ids is None:
+            ids = (_lookup(params, "filter") or {}).get("ID")
+        ids = ids if isinstance(ids, list) else [ids]
+        return [self.user(int(i)) for i in ids if str(i).isdigit() and 1 <= int(i) <= self.users]
+
+    def comment_list(self, params: Dict) -> Tuple[List[Dict], Dict]:
+        filters = _lookup(params, "filter") or {}
+        deal_id = int(filters.get("ENTITY_ID", 0)) if str(filters.get("ENTITY_ID", "")).isdigit() else 0
+        items = self._comments(deal_id) if 1 <= deal_id <= self.deals else []
+        return self._page([item for item in items if _matches(item, filters)], params)
+
+    def activity_list(self, params: Dict) -> Tuple[List[Dict], Dict]:
+        #Без OWNER_ID (поиск сделки по чату) перебираются активности всех сделок
+        filters = _lookup(params, "filter") or {}
+        if "OWNER_ID" in filters:
+            deal_id = int(filters["OWNER_ID"]) if str(filters["OWNER_ID"]).isdigit() else 0
+            items = self._activities(deal_id) if 1 <= deal_id <= self.deals else []
+        else:
+            items = [item for deal_id in range(1, self.deals + 1) for item in self._activities(deal_id)]
+        return self._page([item for item in items if _matches(item, filters)], params)
+
+    def messages_get(self, params: Dict) -> Dict:
+        #Без курсора - последние LIMIT сообщений, FIRST_ID - следующие за ним, LAST_ID - предшествующие.
+        #Внутри страницы сообщения идут от новых к старым, как у Битрикс24
+        messages = self._messages(_lookup(params, "DIALOG_ID"))
+        limit = min(int(_lookup(params, "LIMIT") or 20), MESSAGES_LIMIT)
+        first_id, last_id = _lookup(params, "FIRST_ID"), _lookup(params, "LAST_ID")
+        if first_id not in (None, ""):
+            page = [msg for msg in messages if msg["id"] > int(first_id)][:limit]
+        else:
+            if last_id not in (None, ""):
+                messages = [msg for msg in messages if msg["id"] < int(last_id)]
+            page = messages[-limit:]
+        return {"chat_id": int(str(_lookup(params, "DIALOG_ID"))[4:]), "messages": page[::-1], "users": []}
+
+    def dialog_get(self, params: Dict) -> Dict:
+        messages = self._messages(_lookup(params, "DIALOG_ID"))
+        chat_id = messages[0]["chat_id"] if messages else 0
+        return {"id": chat_id, "dialog_id": f"chat{chat_id}", "entity_type": "LINES", "name": f"Чат {chat_id}"}
+
+    @staticmethod
+    def _page(items: List[Dict], params: Dict) -> Tuple[List[Dict], Dict]:
+        order = _lookup(params, "order") or {}
+        if str(order.get("ID", "")).upper() == "DESC":
+            items = items[::-1]
+        start = int(_lookup(params, "start") or 0)
+        if start < 0:
+            #start=-1: без подсчёта total, как в режиме keyset Битрикс24
+            return items[:PAGE_SIZE], {}
+        page = items[start:start + PAGE_SIZE]
+        extra = {"total": len(items)}
+        if start + PAGE_SIZE < len(items):
+            extra["next"] = start + PAGE_SIZE
+        return page, extra
+
+
+class LeakyBucket:
+    #Лимит запросов как у Битрикс24: rate запросов в секунду со всплеском до burst
+    def __init__(self, rate: float, burst: int, clock: Callable[[], float] = time.monotonic):
+        self.rate = rate
+        self.burst = burst
+        self._clock = clock
+        self._tokens = float(burst)
+        self._updated = clock()
+        self._lock = threading.Lock()
+
+    def allow(self) -> bool:
+        with self._lock:
+            now = self._clock()
+            self._tokens = min(self.burst, self._tokens + (now - self._updated) * self.rate)
+            self._updated = now
+            if self._tokens < 1:
+                return False
+            self._tokens -= 1
+            return True
+
+
+class FakeBitrixServer(ThreadingHTTPServer):
+    #HTTP-сервер с путями /rest/<user>/<token>/<method>. latency - задержка каждого ответа,
+    #rate/burst включают лимит с ответом 503 QUERY_LIMIT_EXCEEDED, fail_every=N - ответ
+    #502 Bad Gateway на каждый N-й запрос (проверка повторов транспорта), limit_every=N -
+    #ошибка QUERY_LIMIT_EXCEEDED в result_error для каждой N-й команды batch.
+    #Служебные пути: GET /_stats - счётчики запросов, POST /_reset - их сброс
+    daemon_threads = True
+
+    def __init__(self, portal: FakePortal, address: Tuple[str, int] = ("127.0.0.1", 0), latency: float = 0.0,
+                 rate: Optional[float] = None, burst: int = 50, fail_every: int = 0, limit_every: int = 0):
+        super().__init__(address, FakeBitrixHandler)
+        self.portal = portal
+        self.latency = latency
+        self.fail_every = fail_every
+        self.limit_every = limit_every
+        self.bucket = LeakyBucket(rate, burst) if rate else None
+        self.stats: Counter = Counter()
+        self._stats_lock = threading.Lock()
+        self._thread: Optional[threading.Thread] = None
+
+    @property
+    def url(self) -> str:
+        #Значение bitrix_url для конфигурации фетчера
+        return f"http://{self.server_address[0]}:{self.server_port}"
+
+    def count(self, *keys: str) -> int:
+        #Возвращает новое значение первого счётчика
+        with self._stats_lock:
+            self.stats.update(keys)
+            return self.stats[keys[0]]
+
+    def snapshot(self) -> Dict[str, int]:
+        with self._stats_lock:
+            return dict(self.stats)
+
+    def reset(self) -> None:
+        with self._stats_lock:
+            self.stats.clear()
+
+    def start(self) -> "FakeBitrixServer":
+        self._thread = threading.Thread(target=self.serve_forever, daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self) -> None:
+        self.shutdown()
+        self.server_close()
+
+    def __enter__(self) -> "FakeBitrixServer":
+        return self.start()
+
+    def __exit__(self, *exc_info) -> None:
+        self.stop()
+
+
+class FakeBitrixHandler(BaseHTTPRequestHandler):
+    server: FakeBitrixServer
+
+    def do_GET(self) -> None:
+        url = urlsplit(self.path)
+        if url.path == "/_stats":
+            self._send(200, self.server.snapshot())
+            return
+        self._handle(url.path, parse_qsl(url.query, keep_blank_values=True))
+
+    def do_POST(self) -> None:
+        url = urlsplit(self.path)
+        if url.path == "/_reset":
+            self.server.reset()
+            self._send(200, {"result": True})
+            return
+        length = int(self.headers.get("Content-Length") or 0)
+        body = self.rfile.read(length).decode('utf-8')
+        if "json" in (self.headers.get("Content-Type") or ""):
+            self._handle(url.path, json.loads(body or "{}"))
+        else:
+            self._handle(url.path, parse_qsl(url.query, keep_blank_values=True)
+                         + parse_qsl(body, keep_blank_values=True))
+
+    def _handle(self, path: str, params: Any) -> None:
+        started = time.time()
+        parts = path.strip("/").split("/")
+        if len(parts) != 4 or parts[0] != "rest":
+            self._send(404, {"error": "NOT_FOUND", "error_description": "Not found"})
+            return
+        method = parts[3][:-5] if parts[3].endswith(".json") else parts[3]
+        number = self.server.count("requests")
+        if self.server.fail_every and number % self.server.fail_every == 0:
+            self.server.count("failed")
+            self._send(502, {"error": "BAD_GATEWAY", "error_description": "Bad gateway"})
+            return
+
+        if self.server.latency:
+            time.sleep(self.server.latency)
+        if self.server.bucket is not None and not self.server.bucket.allow():
+            self.server.count("limited")
+            self._send(503, {"error": "QUERY_LIMIT_EXCEEDED", "error_description": "Too many requests"})
+            return
+
+        if isinstance(params, list):
+            params = _nest(params)
+        try:
+            if method == "batch":
+                self.server.count("batches")
+                payload = {"result": self._batch(params)}
+            else:
+                self.server.count(f"method:{method}")
+                result, extra = self.server.portal.call(method, params)
+                payload = {"result": result, **extra}
+        except FakeError as e:
+            self._send(e.status, e.payload)
+            return
+        payload["time"] = self._time(started)
+        self._send(200, payload)
+
+    def _batch(self, params: Dict) -> Dict:
+        commands = _lookup(params, "cmd") or {}
+        if len(commands) > BATCH_LIMIT:
+            raise FakeError(400, "ERROR_BATCH_LENGTH_EXCEEDED", "Max batch length exceeded")
+        halt = str(_lookup(params, "halt") or 0) not in ("0", "", "False")
+        answer = {"result": {}, "result_error": {}, "result_total": {}, "result_next": {}, "result_time": {}}
+        for key, command in commands.items():
+            started = time.time()
+            method, _, query = command.partition("?")
+            number = self.server.count("commands", f"method:{method}")
+            if self.server.limit_every and number % self.server.limit_every == 0:
+                self.server.count("limited_commands")
+                answer["result_error"][key] = {"error": "QUERY_LIMIT_EXCEEDED", "error_description": "Too many requests"}
+                continue
+            pairs = [(name, self._resolve(value, answer["result"]))
+                     for name, value in parse_qsl(query, keep_blank_values=True)]
+            try:
+                result, extra = self.server.portal.call(method, _nest(pairs))
+            except FakeError as e:
+                answer["result_error"][key] = e.payload
+                if halt:
+                    break
+                continue
+            answer["result"][key] = result
+            if "total" in extra:
+                answer["result_total"][key] = extra["total"]
+            if "next" in extra:
+                answer["result_next"][key] = extra["next"]
+            answer["result_time"][key] = self._time(started)
+        #Как и Битрикс24, пустые словари отдаются пустыми списками
+        return {key: value or [] for key, value in answer.items()}
+
+    @staticmethod
+    def _resolve(value: str, results: Dict) -> Any:
+        #Подстановка $result[ключ][поле] из результатов предыдущих команд batch
+        match = RESULT_REF.match(value)
+        if not match:
+            return value
+        current: Any = results.get(match.group(1))
+        for part in re.findall(r"\[([^\]]*)\]", match.group(2)):
+            if isinstance(current, list) and part.isdigit() and int(part) < len(current):
+                current = current[int(part)]
+            elif isinstance(current, dict):
+                current = current.get(part)
+            else:
+                current = None
+        return "" if current is None else str(current)
+
+    @staticmethod
+    def _time(started: float) -> Dict[str, Any]:
+        finished = time.time()
+        return {
+            "start": started,
+            "finish": finished,
+            "duration": finished - started,
+            "processing": finished - started,
+            "operating": 0,
+            "operating_reset_at": int(started) + 600,
+        }
+
+    def _send(self, status: int, payload: Dict) -> None:
+        body = json.dumps(payload, ensure_ascii=False).encode('utf-8')
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json; charset=utf-8")
+        #Как и портал, сжимает ответ, если клиент это допускает
+        if "gzip" in (self.headers.get("Accept-Encoding") or ""):
+            body = gzip.compress(body, compresslevel=1)
+            self.send_header("Content-Encoding", "gzip")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format: str, *args: Any) -> None:
+        pass
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Локальная замена REST API Битрикс24 с синтетическими данными")
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8900)
+    parser.add_argument('--deals', type=int, default=100, help="Число сделок портала")
+    parser.add_argument('--comments', type=int, default=20, help="Комментариев на сделку")
+    parser.add_argument('--activities', type=int, default=10, help="Активностей на сделку")
+    parser.add_argument('--messages', type=int, default=50, help="Сообщений в диалоге сделки (0 - без диалогов)")
+    parser.add_argument('--latency', type=float, default=0.0, help="Задержка каждого ответа, с")
+    parser.add_argument('--rate', type=float, help="Лимит запросов в секунду (по умолчанию без лимита)")
+    parser.add_argument('--burst', type=int, default=50, help="Допустимый всплеск запросов")
+    parser.add_argument('--fail-every', type=int, default=0, help="Ответ 502 на каждый N-й запрос (0 - без сбоев)")
+    parser.add_argument('--limit-every', type=int, default=0,
+                        help="QUERY_LIMIT_EXCEEDED для каждой N-й команды batch (0 - без ошибок)")
+    args = parser.parse_args()
+
+    portal = FakePortal(args.deals, args.comments, args.activities, args.messages)
+    server = FakeBitrixServer(portal, (args.host, args.port), args.latency, args.rate, args.burst,
+                              args.fail_every, args.limit_every)
+    print(f"Тестовый портал: BITRIX_URL={server.url}, BITRIX_TOKEN - любой")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+
+
+if __name__ == "__main__":
+    main()
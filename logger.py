@@ -1,19 +1,54 @@
+import atexit
+import copy
+import json
 import logging
+import logging.handlers
+import queue
 import sys
 from pathlib import Path
 import os
+from typing import List, Optional
 
-def setup_logger(config: dict) -> logging.Logger:
-    logger = logging.getLogger("deal_dossier")
-    logger.setLevel(config.get("log_level", "INFO"))
+LOGGER_NAME = "deal_dossier"
+TEXT_FORMAT = "%(asctime)s - %(name)s - %(levelname)s - %(message)s"
+
+#Слушатель очереди логов текущей настройки: записи отдаются обработчикам в его потоке
+_listener: Optional[logging.handlers.QueueListener] = None
+
+
+class JsonFormatter(logging.Formatter):
+    #Строка JSON на запись (JSON Lines): время, уровень, логгер, сообщение и трейсбек
+    def format(self, record: logging.LogRecord) -> str:
+        payload = {
+            "time": self.formatTime(record),
+            "level": record.levelname,
+            "logger": record.name,
+            "message": record.getMessage(),
+        }
+        if record.exc_info:
+            payload["exc_info"] = self.formatException(record.exc_info)
+        return json.dumps(payload, ensure_ascii=False)
 
-    formatter = logging.Formatter(
-        "%(asctime)s - %(name)s - %(levelname)s - %(message)s"
-    )
+
+class _QueueHandler(logging.handlers.QueueHandler):
+    #Аргументы подставляются в сообщение в вызывающем потоке (они могут измениться позже),
+    #а формат строки и трейсбек оформляет обработчик в потоке слушателя
+    def prepare(self, record: logging.LogRecord) -> logging.LogRecord:
+        record = copy.copy(record)
+        record.msg = record.getMessage()
+        record.args = None
+        return record
+
+
+def _build_handlers(config: dict, logger: logging.Logger) -> List[logging.Handler]:
+    if config.get("log_format") == "json":
+        formatter = JsonFormatter()
+    else:
+        formatter = logging.Formatter(TEXT_FORMAT)
 
     console_handler = logging.StreamHandler(sys.stdout)
     console_handler.setFormatter(formatter)
-    logger.addHandler(console_handler)
+    handlers = [console_handler]
 
     log_path = config.get("log_path")
     if log_path:
@@ -23,13 +58,48 @@ def setup_logger(config: dict) -> logging.Logger:
 
             # Проверка доступности директории для записи
             if log_dir.is_dir() and os.access(log_dir, os.W_OK):
-                log_file = log_dir / "app.log"
-                file_handler = logging.FileHandler(log_file)
+                log_file = log_dir / ("app.jsonl" if config.get("log_format") == "json" else "app.log")
+                file_handler = logging.FileHandler(log_file, encoding='utf-8')
                 file_handler.setFormatter(formatter)
-                logger.addHandler(file_handler)
+                handlers.append(file_handler)
             else:
-                logger.warning(f"Cannot write to log directory: {log_dir}")
+                logger.warning("Cannot write to log directory: %s", log_dir)
         except Exception as e:
-            logger.warning(f"Failed to setup file logging: {e}")
+            logger.warning("Failed to setup file logging: %s", e)
+    return handlers
+
 
+def stop_logging() -> None:
+    #Остановка слушателя: оставшиеся в очереди записи выводятся, файлы закрываются
+    global _listener
+    if _listener is None:
+        return
+    _listener.stop()
+    for handler in _listener.handlers:
+        handler.close()
+    _listener = None
+
+
+def setup_logger(config: dict) -> logging.Logger:
+    #Логгер пишет записи в очередь, а вывод в консоль и файл выполняет поток QueueListener,
+    #поэтому вызовы логгера не ждут ввода-вывода. Повторный вызов заменяет прежние
+    #обработчики, а не добавляет ещё один набор
+    global _listener
+    logger = logging.getLogger(LOGGER_NAME)
+    logger.setLevel(config.get("log_level", "INFO"))
+
+    stop_logging()
+    for handler in list(logger.handlers):
+        logger.removeHandler(handler)
+        handler.close()
+
+    #Очередь подключается до создания обработчиков, чтобы предупреждения о файле лога
+    #тоже попали в вывод
+    log_queue: queue.SimpleQueue = queue.SimpleQueue()
+    logger.addHandler(_QueueHandler(log_queue))
+    _listener = logging.handlers.QueueListener(log_queue, *_build_handlers(config, logger), respect_handler_level=True)
+    _listener.start()
     return logger
+
+
+atexit.register(stop_logging)
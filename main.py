@@ -1,11 +1,27 @@
 import argparse
+import asyncio
+import hashlib
+import json
 import os
 import sys
+import time
 import logging
-from typing import Dict
-from data_fetchers import BitrixFetcher
+from pathlib import Path
+from typing import AsyncIterator, Dict, Iterable, Iterator, List, Optional, Tuple
+from data_fetchers import AsyncBitrixFetcher, BitrixFetcher
 from processors import DataProcessor
 from dossier_generator import ReportGenerator
+from exporters import TimelineExporter, open_exporter
+from report_store import ReportManifest, report_fingerprint, write_atomic
+from render_pool import Completed, RenderPool
+from service import DossierServer, DossierService
+from webhooks import DealRefresher, WebhookServer
+from cache import ResponseCache
+from rate_limiter import RateLimiter
+from cassette import CassetteStore
+from metrics import STAGES, Metrics
+from run_journal import RunJournal
+from sync_state import DealStateStore
 from logger import setup_logger
 from dotenv import load_dotenv
 load_dotenv()  #загружаем переменные из .env
@@ -15,9 +31,411 @@ def load_config() -> Dict:
         "bitrix_url": os.getenv("BITRIX_URL"),
         "log_level": os.getenv("LOG_LEVEL", "INFO"),
         "log_path": os.getenv("LOG_PATH"),
-        "bitrix_token": os.getenv("BITRIX_TOKEN")  #Теперь только из .env
+        "log_format": os.getenv("LOG_FORMAT", "text"),  #text или json - строка JSON на запись
+        "bitrix_token": os.getenv("BITRIX_TOKEN"),  #Теперь только из .env
+        "rate_limit": os.getenv("BITRIX_RATE_LIMIT"),  #Запросов в секунду по тарифу портала
+        "rate_burst": os.getenv("BITRIX_RATE_BURST"),  #Допустимый всплеск запросов
+        "cache_path": os.getenv("BITRIX_CACHE_PATH"),  #Файл кэша ответов (пусто - без кэша)
+        "application_token": os.getenv("BITRIX_APPLICATION_TOKEN"),  #Токен исходящих событий для --webhooks
+        "timeout": os.getenv("BITRIX_TIMEOUT"),  #Таймаут чтения ответа, с
+        "retries": os.getenv("BITRIX_RETRIES")  #Повторы после сбоя соединения или ответа 5xx
     }
 
+def parse_deal_ids(values: Iterable[str]) -> Iterator[int]:
+    #Разбор ID сделок: отдельные значения, списки через запятую и диапазоны вида 100-500
+    for value in values:
+        for part in value.replace(",", " ").split():
+            if "-" in part:
+                first, last = part.split("-", 1)
+                first, last = int(first), int(last)
+                if first > last:
+                    raise ValueError(f"Некорректный диапазон ID: {part}")
+                yield from range(first, last + 1)
+            else:
+                yield int(part)
+
+def read_id_lines(path: str) -> Iterator[str]:
+    #Построчное чтение файла с ID (или stdin при значении '-'), комментарии после '#' отбрасываются
+    if path == '-':
+        for line in sys.stdin:
+            yield line.split('#', 1)[0]
+        return
+    with open(path, encoding='utf-8') as f:
+        for line in f:
+            yield line.split('#', 1)[0]
+
+def iter_deal_ids(args: argparse.Namespace) -> Iterator[int]:
+    #Источники ID: позиционные аргументы и файл со списком, без повторов
+    seen = set()
+    sources = [parse_deal_ids(args.deal_ids)]
+    if args.ids_file:
+        sources.append(parse_deal_ids(read_id_lines(args.ids_file)))
+
+    for source in sources:
+        for deal_id in source:
+            if deal_id not in seen:
+                seen.add(deal_id)
+                yield deal_id
+
+def crawl_filter(args: argparse.Namespace) -> Dict:
+    #Фильтр crm.deal.list для режима обхода по параметрам командной строки
+    filters = {}
+    if args.stage:
+        filters["STAGE_ID"] = args.stage
+    if args.category is not None:
+        filters["CATEGORY_ID"] = args.category
+    if args.responsible:
+        filters["ASSIGNED_BY_ID"] = args.responsible
+    if args.modified_since:
+        filters[">=DATE_MODIFY"] = args.modified_since
+    if args.modified_until:
+        filters["<=DATE_MODIFY"] = args.modified_until
+    return filters
+
+def crawl_deal_ids(config: Dict, args: argparse.Namespace, logger: logging.Logger) -> Iterator[int]:
+    #Режим обхода: ID сделок по фильтру поступают в конвейер по мере получения страниц
+    #crm.deal.list, поэтому первые отчёты пишутся, пока список ещё не получен целиком
+    filters = crawl_filter(args)
+    logger.info(f"Обход сделок по фильтру: {filters or 'все сделки'}")
+    found = 0
+    for deal_id in BitrixFetcher(config).iter_deal_ids(filters):
+        found += 1
+        yield deal_id
+    logger.info(f"Обход завершён, найдено сделок: {found}")
+
+def journal_fingerprint(args: argparse.Namespace) -> str:
+    #Отпечаток входных данных пакетного запуска для журнала: ID сделок (с содержимым файла
+    #со списком) и параметры, от которых зависят отчёты. stdin учитывается только как источник
+    digest = hashlib.sha256()
+    if args.ids_file and args.ids_file != '-':
+        with open(args.ids_file, 'rb') as f:
+            for chunk in iter(lambda: f.read(1 << 16), b""):
+                digest.update(chunk)
+    options = [args.deal_ids, args.ids_file, digest.hexdigest(), crawl_filter(args) if args.crawl else None,
+               os.path.abspath(args.output), args.format, args.compact_json, args.incremental,
+               args.full_dialog, args.dialog_limit]
+    return hashlib.sha256(json.dumps(options).encode('utf-8')).hexdigest()
+
+def build_report_data(deal_id: int, bitrix_data: Dict, logger: logging.Logger) -> Dict:
+    #Лента событий - одноразовый итератор, поэтому данные собираются заново для каждого формата
+    logger.debug("Формирование временной линии...")
+    return {
+        'deal_id': deal_id,
+        'timeline': DataProcessor.merge_timeline(bitrix_data),
+        'user': bitrix_data.get('user', {}),
+        'dialog': bitrix_data.get('dialog_messages', {})
+    }
+
+REPORT_LABELS = {"json": "JSON", "md": "Markdown"}  #Форматы отчётов и их названия в логе
+
+def report_extensions(args: argparse.Namespace) -> List[str]:
+    return [extension for extension in REPORT_LABELS if args.format in [extension, 'all']]
+
+def prepare_reports(deal_id: int, bitrix_data: Dict, args: argparse.Namespace, logger: logging.Logger,
+                    exporter: Optional[TimelineExporter] = None,
+                    manifest: Optional[ReportManifest] = None) -> Tuple[Optional[str], Dict[str, Optional[str]]]:
+    #Подготовка записи в основном процессе: проверка данных, общая выгрузка и отбор отчётов,
+    #которые нужно рендерить (имя -> прежний хэш содержимого). С манифестом отчёт
+    #не рендерится, если входные данные не изменились
+    if bitrix_data.get("error"):
+        raise RuntimeError(f"Не удалось получить данные сделки {deal_id}: {bitrix_data['error']}")
+
+    if exporter is not None:
+        rows = exporter.write_deal(deal_id, DataProcessor.merge_timeline(bitrix_data))
+        logger.debug("В общую выгрузку добавлено событий сделки %s: %s", deal_id, rows)
+
+    fingerprint = report_fingerprint(bitrix_data, args.compact_json) if manifest is not None else None
+    pending = {}
+    for extension in report_extensions(args):
+        name = f"deal_{deal_id}.{extension}"
+        if manifest is not None and manifest.is_current(name, fingerprint):
+            manifest.skip()
+            logger.info("%s-отчет не изменился: %s/%s", REPORT_LABELS[extension], args.output, name)
+        else:
+            pending[name] = manifest.previous(name) if manifest is not None else None
+    return fingerprint, pending
+
+def render_reports(deal_id: int, bitrix_data: Dict, args: argparse.Namespace,
+                   pending: Dict[str, Optional[str]]) -> Dict[str, Optional[str]]:
+    #Рендеринг и атомарная запись отчётов: имя -> новый хэш или None, если содержимое
+    #не изменилось. Не обращается к манифесту и выгрузке, поэтому выполняется и в процессе-воркере
+    logger = logging.getLogger("deal_dossier")
+    results = {}
+    for name, previous in pending.items():
+        if name.endswith(".json"):
+            render = lambda f: ReportGenerator.render_json(
+                build_report_data(deal_id, bitrix_data, logger), f, args.compact_json
+            )
+        else:
+            render = lambda f: ReportGenerator.render_markdown(build_report_data(deal_id, bitrix_data, logger), f)
+        results[name] = write_atomic(Path(args.output) / name, render, previous)
+    return results
+
+def render_reports_timed(deal_id: int, bitrix_data: Dict, args: argparse.Namespace,
+                         pending: Dict[str, Optional[str]]) -> Tuple[Dict[str, Optional[str]], float]:
+    #render_reports для пула: время рендеринга замеряется в воркере и возвращается вместе с результатом
+    started = time.perf_counter()
+    results = render_reports(deal_id, bitrix_data, args, pending)
+    return results, time.perf_counter() - started
+
+def finish_reports(deal_id: int, results: Dict[str, Optional[str]], fingerprint: Optional[str],
+                   args: argparse.Namespace, logger: logging.Logger,
+                   manifest: Optional[ReportManifest] = None) -> None:
+    for name, digest in results.items():
+        if manifest is not None:
+            manifest.record(name, digest, fingerprint)
+        label = REPORT_LABELS[name.rsplit('.', 1)[1]]
+        if digest is None:
+            logger.info("%s-отчет не изменился: %s/%s", label, args.output, name)
+        else:
+            logger.info("%s-отчет сохранен: %s/%s", label, args.output, name)
+
+def write_reports(deal_id: int, bitrix_data: Dict, args: argparse.Namespace, logger: logging.Logger,
+                  exporter: Optional[TimelineExporter] = None, manifest: Optional[ReportManifest] = None) -> None:
+    #Формирование ленты и запись отчётов по уже полученным данным сделки
+    fingerprint, pending = prepare_reports(deal_id, bitrix_data, args, logger, exporter, manifest)
+    finish_reports(deal_id, render_reports(deal_id, bitrix_data, args, pending), fingerprint, args, logger, manifest)
+
+class ReportStage:
+    #Стадия записи отчётов по загруженным сделкам со счётчиками запуска. С пулом рендеринга
+    #отчёты рендерятся в процессах-воркерах, пока основной процесс загружает следующие сделки
+    def __init__(self, args: argparse.Namespace, logger: logging.Logger,
+                 exporter: Optional[TimelineExporter] = None, manifest: Optional[ReportManifest] = None,
+                 pool: Optional[RenderPool] = None, history_fetcher: Optional[BitrixFetcher] = None,
+                 metrics: Optional[Metrics] = None, journal: Optional[RunJournal] = None):
+        self.args = args
+        self.logger = logger
+        self.exporter = exporter
+        self.manifest = manifest
+        self.pool = pool
+        self.history_fetcher = history_fetcher
+        self.metrics = metrics or Metrics()
+        self.journal = journal
+        self.succeeded = 0
+        self.failed: List[int] = []
+
+    def _prepare(self, deal_id: int, bitrix_data: Dict) -> Optional[Tuple[Dict, Optional[str], Dict[str, Optional[str]]]]:
+        #Отчёты без рендеринга в пуле пишутся сразу; None - сделка уже учтена в счётчиках
+        try:
+            self.logger.info("Обработка сделки ID=%s", deal_id)
+            self._mark(deal_id, "fetched")
+            bitrix_data = with_dialog_history(self.history_fetcher, deal_id, bitrix_data, self.args)
+            with self.metrics.stage("prepare"):
+                fingerprint, pending = prepare_reports(deal_id, bitrix_data, self.args, self.logger,
+                                                       self.exporter, self.manifest)
+            if self.pool is not None and pending:
+                return bitrix_data, fingerprint, pending
+            with self.metrics.stage("render"):
+                results = render_reports(deal_id, bitrix_data, self.args, pending)
+            self._mark(deal_id, "rendered")
+            with self.metrics.stage("write"):
+                finish_reports(deal_id, results, fingerprint, self.args, self.logger, self.manifest)
+            self._written(deal_id, fingerprint)
+        except Exception as e:
+            self._fail(deal_id, e)
+        return None
+
+    def add(self, deal_id: int, bitrix_data: Dict) -> None:
+        prepared = self._prepare(deal_id, bitrix_data)
+        if prepared is not None:
+            bitrix_data, fingerprint, pending = prepared
+            self._collect(self.pool.submit((deal_id, fingerprint), render_reports_timed,
+                                           deal_id, bitrix_data, self.args, pending))
+
+    async def add_async(self, deal_id: int, bitrix_data: Dict) -> None:
+        #Подготовка (с --full-dialog - и чтение истории диалога) и рендеринг без пула блокируют,
+        #поэтому выполняются в потоке: event loop тем временем продолжает загрузку других сделок.
+        #Сделки добавляются по одной, так что счётчики, манифест и выгрузка не меняются параллельно
+        prepared = await asyncio.to_thread(self._prepare, deal_id, bitrix_data)
+        if prepared is not None:
+            bitrix_data, fingerprint, pending = prepared
+            self._collect(await self.pool.submit_async((deal_id, fingerprint), render_reports_timed,
+                                                       deal_id, bitrix_data, self.args, pending))
+
+    def finish(self) -> Tuple[int, List[int]]:
+        #Ожидание отчётов, ещё находящихся в пуле
+        if self.pool is not None:
+            self._collect(self.pool.drain())
+        return self.succeeded, self.failed
+
+    def _collect(self, completed: List[Completed]) -> None:
+        for (deal_id, fingerprint), future in completed:
+            try:
+                results, seconds = future.result()
+                self.metrics.observe_stage("render", seconds)
+                self._mark(deal_id, "rendered")
+                with self.metrics.stage("write"):
+                    finish_reports(deal_id, results, fingerprint, self.args, self.logger, self.manifest)
+                self._written(deal_id, fingerprint)
+            except Exception as e:
+                self._fail(deal_id, e)
+
+    def _fail(self, deal_id: int, error: Exception) -> None:
+        self.logger.error(f"Ошибка обработки сделки {deal_id}: {str(error)}", exc_info=self.args.verbose)
+        self.failed.append(deal_id)
+        self._mark(deal_id, "failed", error=str(error))
+
+    def _written(self, deal_id: int, fingerprint: Optional[str]) -> None:
+        self.succeeded += 1
+        self._mark(deal_id, "written", input=fingerprint)
+
+    def _mark(self, deal_id: int, state: str, **fields) -> None:
+        if self.journal is not None:
+            self.journal.mark(deal_id, state, **fields)
+
+def log_metrics(metrics: Metrics, logger: logging.Logger) -> None:
+    #Сводка метрик в лог: время стадий конвейера и самые медленные методы REST
+    summary = metrics.summary()
+    stages = [f"{name} {summary['stages'][name]['seconds']:.1f} с" for name in STAGES if name in summary["stages"]]
+    if stages:
+        logger.info(f"Стадии: {', '.join(stages)}")
+    slowest = [f"{method} {seconds:.1f} с" for method, seconds in metrics.slowest() if seconds > 0]
+    if slowest:
+        logger.info(f"Самые медленные методы: {', '.join(slowest)}")
+    if summary["rate_limit"]["waits"]:
+        logger.info(f"Ожидание лимитера: {summary['rate_limit']['seconds']:.1f} с")
+
+def render_pool(args: argparse.Namespace, logger: logging.Logger) -> Optional[RenderPool]:
+    #Пул рендеринга для --render-workers больше 1. Полная история диалога читается
+    #фетчером основного процесса во время записи, поэтому с --full-dialog пул не используется
+    if args.render_workers <= 1:
+        return None
+    if args.full_dialog:
+        logger.warning("--render-workers не сочетается с --full-dialog, отчёты рендерятся в основном процессе")
+        return None
+    return RenderPool(args.render_workers)
+
+def with_dialog_history(fetcher: BitrixFetcher, deal_id: int, bitrix_data: Dict,
+                        args: argparse.Namespace) -> Dict:
+    #С --full-dialog первая страница сообщений заменяется ленивой полной историей,
+    #которая читается из API один раз при выводе отчёта. Последнее сообщение первой
+    #страницы - самое новое, по нему манифест узнаёт, что история не изменилась
+    dialog = bitrix_data.get('dialog_messages')
+    if not args.full_dialog or not isinstance(dialog, dict) or 'messages' not in dialog:
+        return bitrix_data
+    last_id = max((int(msg["id"]) for msg in dialog['messages'] if str(msg.get("id", "")).isdigit()), default=0)
+    history = fetcher.dialog_history(deal_id, args.dialog_limit, last_id)
+    if history is None:
+        return bitrix_data
+    return {**bitrix_data, 'dialog_messages': {**dialog, 'messages': history}}
+
+def state_store(args: argparse.Namespace) -> Optional[DealStateStore]:
+    #Хранилище состояния для инкрементального режима (по умолчанию <output>/.state)
+    if not args.incremental:
+        return None
+    return DealStateStore(args.state_dir or os.path.join(args.output, ".state"))
+
+def fetch_deals(fetcher: BitrixFetcher, deal_ids: Iterable[int],
+                store: Optional[DealStateStore]) -> Iterator[Tuple[int, Dict]]:
+    #Обычный режим загружает сделки группами с общими справочниками ответственных
+    #и контактов. В инкрементальном режиме догружаются только изменения, а отчёты
+    #строятся по накопленному состоянию сделки
+    if store is None:
+        yield from fetcher.get_deals_data(deal_ids)
+        return
+    for deal_id in deal_ids:
+        state = fetcher.get_deal_data_incremental(deal_id, store.load(deal_id))
+        if not state["data"].get("error"):
+            store.save(deal_id, state)
+        yield deal_id, state["data"]
+
+def process_deals(config: Dict, deal_ids: Iterable[int], args: argparse.Namespace,
+                  logger: logging.Logger, exporter: Optional[TimelineExporter] = None,
+                  manifest: Optional[ReportManifest] = None,
+                  journal: Optional[RunJournal] = None) -> Tuple[int, List[int]]:
+    #Последовательная обработка: один фетчер на весь запуск, сессия и TLS-соединение
+    #переиспользуются между сделками
+    fetcher = BitrixFetcher(config)
+    store = state_store(args)
+    pool = render_pool(args, logger)
+    stage = ReportStage(args, logger, exporter, manifest, pool, fetcher, config.get("metrics"), journal)
+    try:
+        logger.debug("Запрос данных из Битрикс24...")
+        for deal_id, bitrix_data in stage.metrics.timed(fetch_deals(fetcher, deal_ids, store), "fetch"):
+            stage.add(deal_id, bitrix_data)
+        return stage.finish()
+    finally:
+        if pool is not None:
+            pool.close()
+
+async def iter_in_thread(deal_ids: Iterable[int]) -> AsyncIterator[int]:
+    #ID сделок из источника с блокирующим чтением (обход crm.deal.list, файл, stdin):
+    #каждый следующий ID ждётся в потоке, а event loop тем временем продолжает загрузку
+    items = iter(deal_ids)
+    while True:
+        deal_id = await asyncio.to_thread(next, items, None)
+        if deal_id is None:
+            return
+        yield deal_id
+
+async def process_deals_async(config: Dict, deal_ids: Iterable[int], args: argparse.Namespace,
+                              logger: logging.Logger,
+                              exporter: Optional[TimelineExporter] = None,
+                              manifest: Optional[ReportManifest] = None,
+                              journal: Optional[RunJournal] = None) -> Tuple[int, List[int]]:
+    #Параллельная обработка: до args.concurrency досье запрашиваются одновременно,
+    #отчёты пишутся по мере готовности данных
+    store = state_store(args)
+    #Полная история диалога читается синхронным итератором во время записи отчёта
+    history_fetcher = BitrixFetcher(config) if args.full_dialog else None
+    pool = render_pool(args, logger)
+    stage = ReportStage(args, logger, exporter, manifest, pool, history_fetcher, config.get("metrics"), journal)
+    try:
+        async with AsyncBitrixFetcher(config, args.concurrency) as fetcher:
+            async def fetch_incremental(deal_id: int) -> Dict:
+                state = await fetcher.get_deal_data_incremental(deal_id, store.load(deal_id))
+                if not state["data"].get("error"):
+                    store.save(deal_id, state)
+                return state["data"]
+
+            fetch = fetch_incremental if store is not None else None
+            deals = stage.metrics.timed_async(fetcher.get_deals_data(iter_in_thread(deal_ids), fetch), "fetch")
+            async for deal_id, bitrix_data in deals:
+                await stage.add_async(deal_id, bitrix_data)
+        return stage.finish()
+    finally:
+        if pool is not None:
+            pool.close()
+
+def serve(config: Dict, args: argparse.Namespace, logger: logging.Logger) -> None:
+    #Режим сервиса: фетчер, кэш и логгер создаются один раз, досье формируются по запросу
+    server = DossierServer((args.host, args.port), DossierService(config, build_report_data, logger))
+    logger.info(f"Сервис досье запущен: http://{args.host}:{server.server_port}/deals/<ID>/dossier")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        logger.info("Сервис досье остановлен")
+    finally:
+        server.server_close()
+
+def listen(config: Dict, args: argparse.Namespace, logger: logging.Logger) -> None:
+    #Режим приёма исходящих событий Битрикс24: досье перестраиваются только для сделок,
+    #по которым пришли события, серия событий по сделке даёт одно обновление
+    fetcher = BitrixFetcher(config)
+    store = state_store(args)
+    manifest = ReportManifest(args.output, force=args.force)
+
+    def refresh(deal_ids: List[int]) -> None:
+        stage = ReportStage(args, logger, None, manifest, None, fetcher, config.get("metrics"))
+        for deal_id in deal_ids:
+            fetcher.invalidate_deal(deal_id)
+        for deal_id, bitrix_data in stage.metrics.timed(fetch_deals(fetcher, deal_ids, store), "fetch"):
+            stage.add(deal_id, bitrix_data)
+        manifest.save()
+
+    refresher = DealRefresher(fetcher, refresh, logger, delay=args.debounce)
+    server = WebhookServer((args.host, args.port), refresher, config.get("application_token"))
+    refresher.start()
+    logger.info(f"Приём событий Битрикс24 запущен: http://{args.host}:{server.server_port}/events")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        logger.info("Приём событий остановлен")
+    finally:
+        server.server_close()
+        refresher.stop()
+        manifest.save()
+
 def main():
     # Инициализируем базовый логгер для обработки ошибок до загрузки конфига
     logger = logging.getLogger("deal_dossier")
@@ -34,9 +452,42 @@ def main():
         formatter_class=argparse.RawTextHelpFormatter
     )
     parser.add_argument(
-        'deal_id', 
-        type=int,
-        help="ID сделки в Битрикс24"
+        'deal_ids',
+        nargs='*',
+        help="ID сделок в Битрикс24: 5, 1,2,3 или диапазон 100-500"
+    )
+    parser.add_argument(
+        '-i', '--ids-file',
+        help="Файл со списком ID сделок (по одному или диапазону на строку), '-' для stdin"
+    )
+    parser.add_argument(
+        '--crawl',
+        action='store_true',
+        help="Обойти сделки портала через crm.deal.list (с фильтрами ниже) вместо списка ID"
+    )
+    parser.add_argument(
+        '--stage',
+        action='append',
+        help="Фильтр --crawl: стадия сделки STAGE_ID (можно указать несколько раз)"
+    )
+    parser.add_argument(
+        '--category',
+        help="Фильтр --crawl: направление сделки CATEGORY_ID"
+    )
+    parser.add_argument(
+        '--responsible',
+        action='append',
+        help="Фильтр --crawl: ID ответственного (можно указать несколько раз)"
+    )
+    parser.add_argument(
+        '--modified-since',
+        metavar='DATE',
+        help="Фильтр --crawl: изменённые не раньше даты (2025-01-31 или 2025-01-31T10:00:00+03:00)"
+    )
+    parser.add_argument(
+        '--modified-until',
+        metavar='DATE',
+        help="Фильтр --crawl: изменённые не позже даты"
     )
     parser.add_argument(
         '-o', '--output',
@@ -45,9 +496,107 @@ def main():
     )
     parser.add_argument(
         '-f', '--format',
-        choices=['json', 'md', 'all'],
+        choices=['json', 'md', 'all', 'none'],
         default='all',
-        help="Формат отчетов: json, md или all (по умолчанию: all)"
+        help="Формат отчетов: json, md, all или none - только общая выгрузка (по умолчанию: all)"
+    )
+    parser.add_argument(
+        '--export',
+        help="Общий файл выгрузки лент всех сделок: .parquet (нужен pyarrow) или NDJSON для остальных расширений"
+    )
+    parser.add_argument(
+        '--force',
+        action='store_true',
+        help="Перезаписать все отчёты, даже если данные сделки не изменились"
+    )
+    parser.add_argument(
+        '--compact-json',
+        action='store_true',
+        help="Писать JSON-отчёты без отступов"
+    )
+    parser.add_argument(
+        '--journal',
+        metavar='PATH',
+        help="Журнал запуска: прерванный запуск с теми же ID и параметрами продолжается с места остановки"
+    )
+    parser.add_argument(
+        '-c', '--concurrency',
+        type=int,
+        default=1,
+        help="Число сделок, обрабатываемых одновременно (по умолчанию: 1, больше 1 требует aiohttp)"
+    )
+    parser.add_argument(
+        '--render-workers',
+        type=int,
+        default=1,
+        help="Число процессов рендеринга отчётов (по умолчанию: 1 - рендеринг в основном процессе)"
+    )
+    parser.add_argument(
+        '--incremental',
+        action='store_true',
+        help="Догружать только изменения с прошлого запуска и строить отчёты по накопленному состоянию"
+    )
+    parser.add_argument(
+        '--state-dir',
+        help="Директория состояния для --incremental (по умолчанию: <output>/.state)"
+    )
+    parser.add_argument(
+        '--full-dialog',
+        action='store_true',
+        help="Выгружать всю историю переписки, а не только последние 200 сообщений"
+    )
+    parser.add_argument(
+        '--dialog-limit',
+        type=int,
+        help="Ограничение числа сообщений для --full-dialog (по умолчанию: без ограничения)"
+    )
+    parser.add_argument(
+        '--serve',
+        action='store_true',
+        help="Запустить сервис досье: GET /deals/{id}/dossier?format=json|md"
+    )
+    parser.add_argument(
+        '--webhooks',
+        action='store_true',
+        help="Принимать исходящие события Битрикс24 (POST /events) и обновлять досье затронутых сделок"
+    )
+    parser.add_argument(
+        '--debounce',
+        type=float,
+        default=5.0,
+        help="Задержка обновления досье после последнего события по сделке, с (по умолчанию: 5)"
+    )
+    parser.add_argument(
+        '--host',
+        default='127.0.0.1',
+        help="Адрес сервиса досье или приёма событий (по умолчанию: 127.0.0.1)"
+    )
+    parser.add_argument(
+        '--port',
+        type=int,
+        default=8080,
+        help="Порт сервиса досье или приёма событий (по умолчанию: 8080)"
+    )
+    parser.add_argument(
+        '--metrics',
+        metavar='PATH',
+        help="Сохранить метрики запуска: .prom - формат Prometheus (textfile collector), иначе JSON-сводка"
+    )
+    parser.add_argument(
+        '--record',
+        metavar='DIR',
+        help="Записывать ответы портала в кассету (директорию) для последующего проигрывания"
+    )
+    parser.add_argument(
+        '--replay',
+        metavar='DIR',
+        help="Проигрывать ответы из кассеты вместо запросов к порталу"
+    )
+    parser.add_argument(
+        '--replay-latency',
+        choices=['recorded', 'zero'],
+        default='zero',
+        help="Задержка ответов при --replay: записанная или нулевая (по умолчанию: zero)"
     )
     parser.add_argument(
         '-v', '--verbose',
@@ -55,6 +604,17 @@ def main():
         help="Подробный вывод логов"
     )
     args = parser.parse_args()
+    if args.serve and args.webhooks:
+        parser.error("--serve и --webhooks запускаются отдельными процессами")
+    if args.record and args.replay:
+        parser.error("--record и --replay нельзя использовать вместе")
+    if args.crawl and (args.deal_ids or args.ids_file):
+        parser.error("--crawl получает ID сделок с портала, список ID для него не указывается")
+    if not args.crawl and (args.stage or args.category is not None or args.responsible
+                           or args.modified_since or args.modified_until):
+        parser.error("Фильтры сделок применяются только с --crawl")
+    if not args.deal_ids and not args.ids_file and not args.crawl and not args.serve and not args.webhooks:
+        parser.error("Укажите ID сделок, файл со списком (--ids-file) или --crawl")
 
     try:
         #Загрузка конфига и переопределение логгера
@@ -64,33 +624,99 @@ def main():
         if args.verbose:
             logger.setLevel('DEBUG')
 
-        logger.info(f"Обработка сделки ID={args.deal_id}")
-        
         #Создание выходной директории при необходимости
         os.makedirs(args.output, exist_ok=True)
 
-        logger.debug("Запрос данных из Битрикс24...")
-        bitrix_data = BitrixFetcher(config).get_deal_data(args.deal_id)
-
-        logger.debug("Формирование временной линии...")
-        processed_data = {
-            'deal_id': args.deal_id,
-            'timeline': DataProcessor.merge_timeline(bitrix_data),
-            'user': bitrix_data.get('user', {}),
-            'dialog': bitrix_data.get('dialog_messages', {})
-        }
-        
-        base_path = f"{args.output}/deal_{args.deal_id}"
-
-        if args.format in ['json', 'all']:
-            with open(f"{base_path}.json", 'w', encoding='utf-8') as f:
-                f.write(ReportGenerator.generate_json(processed_data))
-            logger.info(f"JSON-отчет сохранен: {base_path}.json")
-
-        if args.format in ['md', 'all']:
-            with open(f"{base_path}.md", 'w', encoding='utf-8') as f:
-                f.write(ReportGenerator.generate_markdown(processed_data))
-            logger.info(f"Markdown-отчет сохранен: {base_path}.md")
+        #Кэш общий для всех фетчеров запуска, чтобы счётчики попаданий были в одной сводке
+        config["cache"] = ResponseCache.from_config(config)
+        if args.record or args.replay:
+            config.update({
+                "cassette_path": args.record or args.replay,
+                "cassette_mode": "record" if args.record else "replay",
+                "cassette_latency": args.replay_latency,
+            })
+            if args.replay:
+                #Адрес портала и токен не входят в ключ кассеты, для проигрывания они не нужны
+                config["bitrix_url"] = config["bitrix_url"] or "http://bitrix.invalid"
+                config["bitrix_token"] = config["bitrix_token"] or "replay"
+                #Запросы не уходят на портал, поэтому лимит портала не действует: время прогона
+                #задают только записанные задержки, а не ожидание в лимитере
+                config.update({"rate_limit": 1000.0, "rate_burst": 1000})
+        config["cassette"] = CassetteStore.from_config(config)
+        #Лимитер тоже общий: обход сделок, загрузка досье и история диалогов делят один бюджет запросов
+        config["rate_limiter"] = RateLimiter.from_config(config)
+        #Метрики общие для всех фетчеров и стадий запуска, в режимах сервиса доступны на GET /metrics
+        config["metrics"] = Metrics()
+        #Пул соединений не меньше числа одновременных запросов, иначе лишние соединения закрываются
+        config["pool_size"] = args.concurrency
+
+        if args.serve:
+            serve(config, args, logger)
+            return
+        if args.webhooks:
+            listen(config, args, logger)
+            return
+
+        started = time.monotonic()
+        deal_ids = crawl_deal_ids(config, args, logger) if args.crawl else iter_deal_ids(args)
+        journal = RunJournal(args.journal, journal_fingerprint(args)) if args.journal else None
+        if journal is not None and journal.resumed:
+            logger.info(f"Продолжение запуска по журналу {args.journal}: готово сделок {len(journal.done)}")
+            if args.export:
+                logger.warning("Общая выгрузка продолженного запуска содержит только оставшиеся сделки")
+        if journal is not None:
+            deal_ids = journal.remaining(deal_ids)
+        exporter = open_exporter(args.export) if args.export else None
+        manifest = ReportManifest(args.output, force=args.force)
+        try:
+            if args.concurrency > 1 and config["cassette"] is not None:
+                logger.warning("Кассета работает только с requests, сделки обрабатываются последовательно")
+            if args.concurrency > 1 and config["cassette"] is None:
+                succeeded, failed = asyncio.run(
+                    process_deals_async(config, deal_ids, args, logger, exporter, manifest, journal)
+                )
+            else:
+                succeeded, failed = process_deals(config, deal_ids, args, logger, exporter, manifest, journal)
+            if journal is not None and not failed:
+                journal.finish(succeeded)
+        finally:
+            manifest.save()
+            if journal is not None:
+                journal.close()
+            if config["cassette"] is not None:
+                config["cassette"].close()
+            if args.metrics:
+                config["metrics"].write(args.metrics)
+            if exporter is not None:
+                exporter.close()
+                logger.info(f"Общая выгрузка сохранена: {args.export} (событий: {exporter.rows})")
+
+        elapsed = time.monotonic() - started
+        total = succeeded + len(failed)
+        rate = total / elapsed if elapsed > 0 else 0.0
+        logger.info(
+            f"Итого: обработано {total}, успешно {succeeded}, с ошибками {len(failed)} "
+            f"за {elapsed:.1f} с ({rate:.2f} сделок/с)"
+        )
+        logger.info(f"Отчёты: записано {manifest.written}, без изменений {manifest.skipped}")
+        if journal is not None and journal.skipped:
+            logger.info(f"Пропущено сделок, готовых по журналу: {journal.skipped}")
+        if config["cache"] is not None:
+            stats = config["cache"].stats()
+            logger.info(
+                f"Кэш: попаданий {stats['hits']}, промахов {stats['misses']} "
+                f"({stats['hit_rate']:.0%})"
+            )
+        log_metrics(config["metrics"], logger)
+        if config["cassette"] is not None:
+            stats = config["cassette"].stats
+            if args.record:
+                logger.info(f"Кассета {args.record}: записано ответов {stats['recorded']}, новых тел {stats['objects']}")
+            else:
+                logger.info(f"Кассета {args.replay}: проиграно запросов {stats['requests']}, промахов {stats['misses']}")
+        if failed:
+            logger.warning(f"Сделки с ошибками: {', '.join(map(str, failed))}")
+            sys.exit(1)
 
         logger.info("Обработка завершена успешно")
 
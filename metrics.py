@@ -0,0 +1,256 @@
+import json
+import threading
+import time
+from bisect import bisect_left
+from collections import defaultdict
+from contextlib import contextmanager
+from pathlib import Path
+from typing import Any, AsyncIterable, AsyncIterator, Dict, Iterable, Iterator, List, Optional, Tuple
+
+from report_store import write_atomic
+
+#Границы гистограмм времени, в секундах
+LATENCY_BUCKETS = (0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+#Семейства метрик: тип и описание для формата Prometheus
+FAMILIES = {
+    "bitrix_requests_total": ("counter", "HTTP-запросы к REST API по методам и статусам ответа"),
+    "bitrix_request_seconds": ("histogram", "Время HTTP-запроса к REST API, включая чтение ответа"),
+    "bitrix_response_bytes_total": ("counter", "Получено байт в ответах REST API"),
+    "bitrix_commands_total": ("counter", "Команды внутри batch по методам"),
+    "bitrix_command_seconds": ("histogram", "Время выполнения команды batch на портале (result_time)"),
+    "bitrix_retries_total": ("counter", "Повторы запросов после превышения лимита или сбоя"),
+    "bitrix_rate_limit_waits_total": ("counter", "Ожидания лимитера перед запросом"),
+    "bitrix_rate_limit_wait_seconds_total": ("counter", "Суммарное ожидание лимитера, с"),
+    "bitrix_cache_total": ("counter", "Обращения к кэшу ответов по методам"),
+    "dossier_stage_seconds": ("histogram", "Время стадий конвейера досье"),
+}
+#Стадии конвейера main.py. prepare - проверка данных, общая выгрузка и отпечаток для манифеста;
+#лента сливается лениво при записи отчёта, поэтому её слияние входит в render
+STAGES = ("fetch", "prepare", "render", "write")
+PROMETHEUS_CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"  #Для ответа GET /metrics
+
+Labels = Tuple[Tuple[str, str], ...]
+
+
+class Histogram:
+    #Гистограмма с фиксированными границами, как в Prometheus: counts[i] - значения
+    #не больше bounds[i], последний элемент - значения больше всех границ
+    __slots__ = ("bounds", "counts", "sum", "count")
+
+    def __init__(self, bounds: Tuple[float, ...]):
+        self.bounds = bounds
+        self.counts = [0] * (len(bounds) + 1)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value: float) -> None:
+        self.counts[bisect_left(self.bounds, value)] += 1
+        self.sum += value
+        self.count += 1
+
+    def quantile(self, q: float) -> float:
+        #Оценка квантиля линейной интерполяцией внутри корзины (как histogram_quantile)
+        if not self.count:
+            return 0.0
+        rank = q * self.count
+        cumulative = 0
+        for i, count in enumerate(self.counts):
+            if count and cumulative + count >= rank:
+                lower = self.bounds[i - 1] if i > 0 else 0.0
+                if i == len(self.bounds):
+                    return lower
+                return lower + (self.bounds[i] - lower) * (rank - cumulative) / count
+            cumulative += count
+        return self.bounds[-1]
+
+
+def _escape(value: str) -> str:
+    return value.replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+def _format_labels(labels: Labels, extra: Labels = ()) -> str:
+    pairs = labels + extra
+    if not pairs:
+        return ""
+    return "{" + ",".join(f'{name}="{_escape(str(value))}"' for name, value in pairs) + "}"
+
+
+class Metrics:
+    #Метрики запуска: счётчики и гистограммы с метками. Один экземпляр разделяется всеми
+    #фетчерами и стадиями процесса (передаётся в конфиге как metrics), поэтому обращения
+    #защищены блокировкой. Выгружается в текстовом формате Prometheus или сводкой JSON
+    def __init__(self, buckets: Iterable[float] = LATENCY_BUCKETS):
+        self.buckets = tuple(buckets)
+        self._lock = threading.Lock()
+        self._counters: Dict[Tuple[str, Labels], float] = defaultdict(float)
+        self._histograms: Dict[Tuple[str, Labels], Histogram] = {}
+
+    def inc(self, name: str, value: float = 1.0, **labels: str) -> None:
+        key = (name, tuple(sorted(labels.items())))
+        with self._lock:
+            self._counters[key] += value
+
+    def observe(self, name: str, value: float, **labels: str) -> None:
+        key = (name, tuple(sorted(labels.items())))
+        with self._lock:
+            histogram = self._histograms.get(key)
+            if histogram is None:
+                histogram = self._histograms[key] = Histogram(self.buckets)
+            histogram.observe(value)
+
+    #Учёт событий фетчера
+    def request(self, method: str, seconds: float, size: int, status: Any) -> None:
+        self.inc("bitrix_requests_total", method=method, status=str(status))
+        self.observe("bitrix_request_seconds", seconds, method=method)
+        if size:
+            self.inc("bitrix_response_bytes_total", size, method=method)
+
+    def command(self, method: str, seconds: Optional[float] = None) -> None:
+        self.inc("bitrix_commands_total", method=method)
+        if seconds is not None:
+            self.observe("bitrix_command_seconds", float(seconds), method=method)
+
+    def retry(self, method: str) -> None:
+        self.inc("bitrix_retries_total", method=method)
+
+    def rate_limit_wait(self, seconds: float) -> None:
+        if seconds > 0:
+            self.inc("bitrix_rate_limit_waits_total")
+            self.inc("bitrix_rate_limit_wait_seconds_total", seconds)
+
+    def cache(self, method: str, hit: bool) -> None:
+        self.inc("bitrix_cache_total", method=method, result="hit" if hit else "miss")
+
+    #Стадии конвейера
+    def observe_stage(self, stage: str, seconds: float) -> None:
+        self.observe("dossier_stage_seconds", seconds, stage=stage)
+
+    @contextmanager
+    def stage(self, stage: str) -> Iterator[None]:
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe_stage(stage, time.perf_counter() - started)
+
+    def timed(self, items: Iterable, stage: str) -> Iterator:
+        #Элементы итератора с учётом времени ожидания каждого из них как стадии stage
+        iterator = iter(items)
+        while True:
+            started = time.perf_counter()
+            try:
+                item = next(iterator)
+            except StopIteration:
+                return
+            self.observe_stage(stage, time.perf_counter() - started)
+            yield item
+
+    async def timed_async(self, items: AsyncIterable, stage: str) -> AsyncIterator:
+        iterator = items.__aiter__()
+        while True:
+            started = time.perf_counter()
+            try:
+                item = await iterator.__anext__()
+            except StopAsyncIteration:
+                return
+            self.observe_stage(stage, time.perf_counter() - started)
+            yield item
+
+    #Выгрузка
+    def _snapshot(self) -> Tuple[Dict[Tuple[str, Labels], float], Dict[Tuple[str, Labels], Histogram]]:
+        with self._lock:
+            histograms = {}
+            for key, histogram in self._histograms.items():
+                copy = histograms[key] = Histogram(histogram.bounds)
+                copy.counts, copy.sum, copy.count = list(histogram.counts), histogram.sum, histogram.count
+            return dict(self._counters), histograms
+
+    def to_prometheus(self) -> str:
+        counters, histograms = self._snapshot()
+        lines = []
+        for family, (kind, description) in FAMILIES.items():
+            if kind == "counter":
+                samples = sorted((labels, value) for (name, labels), value in counters.items() if name == family)
+            else:
+                samples = sorted((labels, value) for (name, labels), value in histograms.items() if name == family)
+            if not samples:
+                continue
+            lines.append(f"# HELP {family} {description}")
+            lines.append(f"# TYPE {family} {kind}")
+            for labels, value in samples:
+                if kind == "counter":
+                    lines.append(f"{family}{_format_labels(labels)} {value:g}")
+                    continue
+                cumulative = 0
+                for bound, count in zip(value.bounds + (float("inf"),), value.counts):
+                    cumulative += count
+                    le = "+Inf" if bound == float("inf") else f"{bound:g}"
+                    lines.append(f"{family}_bucket{_format_labels(labels, (('le', le),))} {cumulative}")
+                lines.append(f"{family}_sum{_format_labels(labels)} {value.sum:.6f}")
+                lines.append(f"{family}_count{_format_labels(labels)} {value.count}")
+        return "\n".join(lines) + "\n"
+
+    def summary(self) -> Dict[str, Any]:
+        #Сводка по методам REST и стадиям: сколько вызовов, времени и байт пришлось на каждый
+        counters, histograms = self._snapshot()
+        methods: Dict[str, Dict[str, float]] = defaultdict(lambda: defaultdict(float))
+        for (name, labels), value in counters.items():
+            labels = dict(labels)
+            if "method" not in labels:
+                continue
+            method = methods[labels["method"]]
+            if name == "bitrix_requests_total":
+                method["requests"] += value
+                if labels.get("status") != "200":
+                    method["errors"] += value
+            elif name == "bitrix_response_bytes_total":
+                method["bytes"] += value
+            elif name == "bitrix_commands_total":
+                method["commands"] += value
+            elif name == "bitrix_retries_total":
+                method["retries"] += value
+            elif name == "bitrix_cache_total":
+                method["cache_hits" if labels.get("result") == "hit" else "cache_misses"] += value
+
+        stages = {}
+        for (name, labels), histogram in histograms.items():
+            labels = dict(labels)
+            if name == "dossier_stage_seconds":
+                stages[labels["stage"]] = {
+                    "count": histogram.count,
+                    "seconds": round(histogram.sum, 6),
+                    "p50": round(histogram.quantile(0.5), 6),
+                    "p95": round(histogram.quantile(0.95), 6),
+                }
+                continue
+            prefix = "request" if name == "bitrix_request_seconds" else "command"
+            method = methods[labels["method"]]
+            method[f"{prefix}_seconds"] = round(histogram.sum, 6)
+            method[f"{prefix}_p50"] = round(histogram.quantile(0.5), 6)
+            method[f"{prefix}_p95"] = round(histogram.quantile(0.95), 6)
+
+        return {
+            "methods": {name: dict(values) for name, values in sorted(methods.items())},
+            "stages": dict(sorted(stages.items())),
+            "rate_limit": {
+                "waits": counters.get(("bitrix_rate_limit_waits_total", ()), 0.0),
+                "seconds": round(counters.get(("bitrix_rate_limit_wait_seconds_total", ()), 0.0), 6),
+            },
+        }
+
+    def slowest(self, limit: int = 3) -> List[Tuple[str, float]]:
+        #Методы с наибольшим суммарным временем: прямые запросы плюс команды внутри batch
+        #(сам batch не учитывается, иначе его время было бы посчитано дважды)
+        totals = {
+            name: values.get("request_seconds", 0.0) + values.get("command_seconds", 0.0)
+            for name, values in self.summary()["methods"].items() if name != "batch"
+        }
+        return sorted(totals.items(), key=lambda item: item[1], reverse=True)[:limit]
+
+    def write(self, path: str) -> None:
+        #Атомарная запись: .prom - текстовый формат Prometheus (для textfile collector), иначе JSON
+        if path.endswith(".prom"):
+            text = self.to_prometheus()
+        else:
+            text = json.dumps(self.summary(), ensure_ascii=False, indent=2)
+        write_atomic(Path(path), lambda f: f.write(text))
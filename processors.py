@@ -1,17 +1,121 @@
-from datetime import datetime
-from typing import Dict, List
+import calendar
+import heapq
+from dataclasses import dataclass
+from datetime import datetime, timedelta, timezone
+from functools import lru_cache
+from operator import itemgetter
+from typing import Any, Callable, Dict, Iterable, Iterator, Optional, Tuple
+
+#Коды типов событий: в событии хранится номер, а не отдельная строка на каждое событие
+EVENT_TYPES = ('activity', 'comment', 'message')
+EVENT_CODES = {name: code for code, name in enumerate(EVENT_TYPES)}
+
+#Источники ленты: ключ в данных get_deal_data, тип события, поле с датой и поля,
+#которые переносятся в событие (тема/текст, автор, ID) - остальная часть ответа не хранится
+TIMELINE_SOURCES = (
+    ('activities', 'activity', 'CREATED', ('SUBJECT', 'AUTHOR_ID', 'ID')),  #Задачи, письма, звонки
+    ('timeline', 'comment', 'CREATED', ('COMMENT', 'AUTHOR_ID', 'ID')),  #Комментарии в карточке сделки
+)
+MESSAGE_FIELDS = (('text', 'MESSAGE'), ('author_id', 'AUTHOR'), ('id', 'ID'))  #Поля сообщения диалога
+
+@lru_cache(maxsize=4096)
+def _parse_date(value: str) -> Tuple[int, Optional[int]]:
+    #Дата как (unix-время, смещение часового пояса в минутах или None для наивных дат).
+    #Даты в выгрузке часто повторяются (пакетные активности, сообщения одной минуты),
+    #поэтому разбор кэшируется
+    date = datetime.fromisoformat(value)
+    if date.tzinfo is None:
+        return calendar.timegm(date.timetuple()), None
+    return int(date.timestamp()), int(date.utcoffset().total_seconds() // 60)
+
+@lru_cache(maxsize=64)
+def _tz(offset: int) -> timezone:
+    return timezone(timedelta(minutes=offset))
+
+def _message_date(message: Dict) -> str:
+    #im.dialog.messages.get отдаёт поле date, в старых выгрузках встречается DATE
+    return message.get('date') or message['DATE']
+
+def _first(item: Dict, *names: str) -> Any:
+    for name in names:
+        if item.get(name) is not None:
+            return item[name]
+    return None
+
+@dataclass(frozen=True, slots=True)
+class TimelineEvent:
+    #Компактное событие ленты: код типа, unix-время со смещением пояса и только те поля
+    #исходного ответа, что нужны отчётам
+    type_code: int
+    timestamp: int
+    tz_offset: Optional[int]
+    subject: Optional[str]
+    author: Any
+    source_id: Any
+
+    @property
+    def type(self) -> str:
+        return EVENT_TYPES[self.type_code]
+
+    @property
+    def date(self) -> datetime:
+        #Дата восстанавливается в исходном часовом поясе (наивная - как была)
+        if self.tz_offset is None:
+            return datetime.fromtimestamp(self.timestamp, timezone.utc).replace(tzinfo=None)
+        return datetime.fromtimestamp(self.timestamp, _tz(self.tz_offset))
+
+    def as_dict(self) -> Dict[str, Any]:
+        #Представление для JSON-отчёта
+        return {
+            'type': self.type,
+            'date': self.date,
+            'subject': self.subject,
+            'author': self.author,
+            'id': self.source_id
+        }
 
 class DataProcessor:
     @staticmethod
-    def merge_timeline(data: Dict) -> List[Dict]:
-        #Объединяет данные из разных источников (активности, комментарии, звонки) в единую хронологическую ленту событий.
-        timeline = []
-        #Обработка активностей (задачи, письма, звонки)
-        for event in data.get('activities', []):
-            timeline.append({
-                'type': 'activity', #Тип события для последующей фильтрации
-                'date': datetime.fromisoformat(event['CREATED']), #Парсинг даты
-                'data': event #Сохранение исходных данных
-            })
-        #Аналогично для других источников
-        return sorted(timeline, key=lambda x: x['date']) #Критерий сортировки - дата события
\ No newline at end of file
+    def merge_timeline(data: Dict) -> Iterator[TimelineEvent]:
+        #Объединяет данные из разных источников (активности, комментарии, сообщения) в единую хронологическую ленту событий.
+        #Каждый источник упорядочен по дате, поэтому они сливаются лениво (k-way merge):
+        #в памяти держится по одному событию на источник, а не вся лента
+        sources = [
+            DataProcessor._events(
+                data.get(key) or [], event_type, itemgetter(date_field),
+                lambda item, fields=fields: tuple(_first(item, name, name.lower()) for name in fields)
+            )
+            for key, event_type, date_field, fields in TIMELINE_SOURCES
+        ]
+        dialog = data.get('dialog_messages', {})
+        if isinstance(dialog, dict) and dialog.get('messages'):
+            #Сообщения без даты в ленту не попадают: их невозможно расположить по времени
+            dated = (msg for msg in dialog['messages'] if msg.get('date') or msg.get('DATE'))
+            if isinstance(dialog['messages'], list):
+                dated = list(dated)
+            sources.append(DataProcessor._events(
+                dated, 'message', _message_date,
+                lambda msg: tuple(_first(msg, *names) for names in MESSAGE_FIELDS)
+            ))
+        return heapq.merge(*sources, key=lambda event: event.timestamp) #Критерий сортировки - дата события
+
+    @staticmethod
+    def _events(items: Iterable[Dict], event_type: str, get_date: Callable[[Dict], str],
+                project: Callable[[Dict], Tuple]) -> Iterator[TimelineEvent]:
+        #Список проверяется на упорядоченность одним проходом (ошибки дат всплывают сразу)
+        #и сортируется только при необходимости; ленивые итераторы считаются упорядоченными
+        code = EVENT_CODES[event_type]
+        if not isinstance(items, list):
+            return (
+                TimelineEvent(code, *_parse_date(get_date(item)), *project(item))
+                for item in items
+            )
+
+        dates = [_parse_date(get_date(item)) for item in items]  #Парсинг даты
+        if any(later[0] < earlier[0] for earlier, later in zip(dates, dates[1:])):
+            order = sorted(range(len(items)), key=lambda i: dates[i][0])
+            items, dates = [items[i] for i in order], [dates[i] for i in order]
+        return (
+            TimelineEvent(code, *date, *project(item))  #Тип события и нужные отчёту поля
+            for date, item in zip(dates, items)
+        )
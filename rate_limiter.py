@@ -0,0 +1,103 @@
+import asyncio
+import threading
+import time
+from typing import Any, Callable, Dict, Iterable, Optional
+
+LIMIT_ERRORS = ("QUERY_LIMIT_EXCEEDED", "OPERATION_TIME_LIMIT")  #Коды ошибок превышения лимитов
+
+
+class RateLimiter:
+    #Модель лимитов Битрикс24: "дырявое ведро" на число запросов (rate запросов в секунду,
+    #запас burst) и лимит суммарного времени выполнения метода (operating) за 10 минут.
+    #Один экземпляр разделяется всеми фетчерами процесса, поэтому операции защищены блокировкой
+    def __init__(self, rate: float = 2.0, burst: int = 50, operating_limit: float = 480.0,
+                 operating_threshold: float = 0.9, max_backoff: float = 60.0,
+                 clock: Callable[[], float] = time.monotonic,
+                 sleep: Callable[[float], None] = time.sleep):
+        self.rate = rate
+        self.burst = burst
+        self.operating_limit = operating_limit
+        self.operating_threshold = operating_threshold  #Доля лимита, после которой метод ставится на паузу
+        self.max_backoff = max_backoff
+        self._clock = clock
+        self._sleep = sleep
+        self._lock = threading.Lock()
+        self._tokens = float(burst)  #Свободное место в ведре, отрицательное значение - очередь ожидания
+        self._updated = clock()
+        self._blocked_until = 0.0  #Пауза для всех методов после ответа 503
+        self._method_blocked_until: Dict[str, float] = {}  #Пауза отдельных методов по operating
+        self._penalty = 0  #Число подряд полученных ошибок лимита
+
+    @classmethod
+    def from_config(cls, config: Dict[str, Any]) -> "RateLimiter":
+        #Параметры лимитов из конфигурации (тариф Enterprise допускает rate=5, burst=250)
+        return cls(
+            rate=float(config.get("rate_limit") or 2.0),
+            burst=int(config.get("rate_burst") or 50)
+        )
+
+    def reserve(self, methods: Iterable[str] = ()) -> float:
+        #Занимает место под один запрос и возвращает время, которое нужно подождать перед ним
+        with self._lock:
+            now = self._clock()
+            self._tokens = min(self.burst, self._tokens + (now - self._updated) * self.rate)
+            self._updated = now
+
+            wait = self._blocked_until - now
+            for method in methods:
+                wait = max(wait, self._method_blocked_until.get(method, 0.0) - now)
+
+            self._tokens -= 1
+            if self._tokens < 0:
+                wait = max(wait, -self._tokens / self.rate)
+            return max(0.0, wait)
+
+    def acquire(self, methods: Iterable[str] = ()) -> float:
+        #Блокирующее ожидание своей очереди
+        delay = self.reserve(methods)
+        if delay > 0:
+            self._sleep(delay)
+        return delay
+
+    async def acquire_async(self, methods: Iterable[str] = ()) -> float:
+        #То же для asyncio: ожидание не блокирует event loop
+        delay = self.reserve(methods)
+        if delay > 0:
+            await asyncio.sleep(delay)
+        return delay
+
+    def observe(self, method: str, time_info: Optional[Dict]) -> None:
+        #Учёт блока time из ответа: при приближении к лимиту operating метод ставится
+        #на паузу до operating_reset_at, успешный ответ снимает штраф за 503
+        with self._lock:
+            self._penalty = 0
+            if not isinstance(time_info, dict):
+                return
+            operating = float(time_info.get("operating") or 0)
+            reset_at = time_info.get("operating_reset_at")
+            if reset_at and operating >= self.operating_limit * self.operating_threshold:
+                #operating_reset_at - unix-время, переводим его в шкалу монотонных часов
+                delay = max(0.0, float(reset_at) - time.time())
+                self._method_blocked_until[method] = self._clock() + delay
+
+    def penalize(self, method: Optional[str] = None, retry_after: Optional[float] = None) -> float:
+        #Реакция на 503/QUERY_LIMIT_EXCEEDED: ведро считается полным, а пауза растёт
+        #экспоненциально с каждой ошибкой подряд
+        with self._lock:
+            self._penalty += 1
+            backoff = retry_after if retry_after else min(self.max_backoff, 2 ** (self._penalty - 1) / self.rate)
+            now = self._clock()
+            self._tokens = min(self._tokens, 0.0)
+            self._updated = now
+            if method:
+                self._method_blocked_until[method] = now + backoff
+            else:
+                self._blocked_until = max(self._blocked_until, now + backoff)
+            return backoff
+
+    @staticmethod
+    def is_limit_error(status_code: Any, payload: Any = None) -> bool:
+        #Признак превышения лимита: HTTP 503/429 или соответствующий код ошибки в ответе
+        if status_code in (429, 503):
+            return True
+        return isinstance(payload, dict) and payload.get("error") in LIMIT_ERRORS
@@ -0,0 +1,53 @@
+import asyncio
+from concurrent.futures import FIRST_COMPLETED, Executor, Future, ProcessPoolExecutor, wait
+from typing import Any, Callable, Dict, Iterable, List, Optional, Tuple
+
+#Готовая задача пула: ключ, переданный в submit, и её future (результат или исключение)
+Completed = Tuple[Any, Future]
+
+
+class RenderPool:
+    #Стадия рендеринга отчётов в пуле процессов. Загрузка сделок продолжается в основном
+    #процессе, пока воркеры рендерят уже полученные. Число переданных, но не отрендеренных
+    #сделок ограничено max_in_flight: submit ждёт освобождения места, поэтому память не растёт,
+    #даже если загрузка обгоняет рендеринг
+    def __init__(self, workers: int, max_in_flight: Optional[int] = None, executor: Optional[Executor] = None):
+        self.max_in_flight = max_in_flight or workers * 2
+        self._executor = executor or ProcessPoolExecutor(workers)
+        self._in_flight: Dict[Future, Any] = {}
+
+    def submit(self, key: Any, fn: Callable, *args: Any) -> List[Completed]:
+        #Передача задачи воркерам; возвращаются задачи, завершившиеся к этому моменту
+        completed = []
+        while len(self._in_flight) >= self.max_in_flight:
+            done, _ = wait(self._in_flight, return_when=FIRST_COMPLETED)
+            completed += self._collect(done)
+        self._in_flight[self._executor.submit(fn, *args)] = key
+        return completed + self._collect([future for future in self._in_flight if future.done()])
+
+    async def submit_async(self, key: Any, fn: Callable, *args: Any) -> List[Completed]:
+        #То же для асинхронной загрузки: ожидание места не блокирует цикл событий
+        completed = []
+        while len(self._in_flight) >= self.max_in_flight:
+            await asyncio.wait([asyncio.wrap_future(future) for future in self._in_flight],
+                               return_when=asyncio.FIRST_COMPLETED)
+            completed += self._collect([future for future in self._in_flight if future.done()])
+        self._in_flight[self._executor.submit(fn, *args)] = key
+        return completed + self._collect([future for future in self._in_flight if future.done()])
+
+    def drain(self) -> List[Completed]:
+        #Ожидание всех оставшихся задач
+        done, _ = wait(self._in_flight)
+        return self._collect(done)
+
+    def close(self) -> None:
+        self._executor.shutdown(wait=True, cancel_futures=True)
+
+    def _collect(self, done: Iterable[Future]) -> List[Completed]:
+        return [(self._in_flight.pop(future), future) for future in done]
+
+    def __enter__(self) -> "RenderPool":
+        return self
+
+    def __exit__(self, *exc_info) -> None:
+        self.close()
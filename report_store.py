@@ -0,0 +1,127 @@
+import hashlib
+import json
+import os
+from pathlib import Path
+from typing import Any, Callable, Dict, Optional, TextIO
+
+MANIFEST_NAME = ".manifest.json"  #Манифест отчётов в выходной директории
+
+
+class _HashingWriter:
+    #Текстовый поток-обёртка: передаёт запись в файл и считает SHA-256 записанного текста
+    def __init__(self, fp: TextIO):
+        self._fp = fp
+        self._hash = hashlib.sha256()
+
+    def write(self, text: str) -> int:
+        self._hash.update(text.encode('utf-8'))
+        return self._fp.write(text)
+
+    def writelines(self, lines) -> None:
+        for line in lines:
+            self.write(line)
+
+    def hexdigest(self) -> str:
+        return self._hash.hexdigest()
+
+
+def write_atomic(path: Path, render: Callable[[TextIO], None],
+                 previous_digest: Optional[str] = None) -> Optional[str]:
+    #Отчёт пишется во временный файл рядом с целевым и подменяет его через os.replace,
+    #поэтому сбой не оставляет обрезанный файл. Если хэш содержимого совпал с previous_digest
+    #и файл на месте, он не перезаписывается (возвращается None), иначе возвращается новый хэш
+    tmp_path = path.with_name(path.name + ".tmp")
+    try:
+        with open(tmp_path, 'w', encoding='utf-8') as f:
+            writer = _HashingWriter(f)
+            render(writer)
+        digest = writer.hexdigest()
+        if digest == previous_digest and path.exists():
+            os.remove(tmp_path)
+            return None
+        os.replace(tmp_path, path)
+    except BaseException:
+        if tmp_path.exists():
+            os.remove(tmp_path)
+        raise
+    return digest
+
+
+def report_fingerprint(data: Dict, *options: Any) -> Optional[str]:
+    #Отпечаток входных данных отчёта и параметров вывода. Ленивая история диалога
+    #представлена своим отпечатком (DialogHistory.fingerprint - ID последнего сообщения),
+    #а для прочих итераторов отпечаток не считается (None): их пришлось бы выгрузить ради сравнения
+    def default(value: Any) -> Any:
+        if hasattr(value, 'isoformat'):
+            return value.isoformat()
+        fingerprint = value.fingerprint() if hasattr(value, 'fingerprint') else None
+        if fingerprint is not None:
+            return fingerprint
+        raise TypeError(type(value).__name__)
+
+    try:
+        payload = json.dumps([data, options], sort_keys=True, ensure_ascii=False, default=default)
+    except TypeError:
+        return None
+    return hashlib.sha256(payload.encode('utf-8')).hexdigest()
+
+
+class ReportManifest:
+    #Манифест выходной директории: по имени отчёта - хэш содержимого и отпечаток входных данных.
+    #Читается одним файлом при старте, поэтому до рендеринга известно, какие отчёты актуальны.
+    #Сохраняется атомарно раз в save_every изменений и в конце запуска
+    def __init__(self, directory: str, force: bool = False, save_every: int = 100):
+        self.directory = Path(directory)
+        self.path = self.directory / MANIFEST_NAME
+        self.save_every = save_every
+        self.entries: Dict[str, Dict[str, Optional[str]]] = {} if force else self._load()
+        self.written = 0
+        self.skipped = 0
+        self._dirty = 0
+
+    def _load(self) -> Dict:
+        try:
+            with open(self.path, encoding='utf-8') as f:
+                entries = json.load(f)
+        except (FileNotFoundError, ValueError):
+            return {}
+        return entries if isinstance(entries, dict) else {}
+
+    def is_current(self, name: str, fingerprint: Optional[str]) -> bool:
+        #Отчёт не нужно рендерить, если входные данные не изменились и файл на месте
+        entry = self.entries.get(name)
+        return (fingerprint is not None and entry is not None and entry.get("input") == fingerprint
+                and (self.directory / name).exists())
+
+    def previous(self, name: str) -> Optional[str]:
+        #Хэш содержимого отчёта из прошлых запусков
+        return self.entries.get(name, {}).get("sha256")
+
+    def write(self, name: str, render: Callable[[TextIO], None], fingerprint: Optional[str] = None) -> bool:
+        #Атомарная запись отчёта; False - содержимое не изменилось и файл не трогался
+        digest = write_atomic(self.directory / name, render, self.previous(name))
+        self.record(name, digest, fingerprint)
+        return digest is not None
+
+    def record(self, name: str, digest: Optional[str], fingerprint: Optional[str]) -> None:
+        #Учёт результата write_atomic, выполненной здесь или в процессе-воркере
+        self.entries[name] = {"sha256": digest or self.previous(name), "input": fingerprint}
+        self._dirty += 1
+        if digest is None:
+            self.skipped += 1
+        else:
+            self.written += 1
+        if self._dirty >= self.save_every:
+            self.save()
+
+    def skip(self) -> None:
+        self.skipped += 1
+
+    def save(self) -> None:
+        if not self._dirty:
+            return
+        tmp_path = self.path.with_name(self.path.name + ".tmp")
+        with open(tmp_path, 'w', encoding='utf-8') as f:
+            json.dump(self.entries, f, ensure_ascii=False, separators=(',', ':'))
+        os.replace(tmp_path, self.path)
+        self._dirty = 0
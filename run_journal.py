@@ -0,0 +1,95 @@
+import json
+from datetime import datetime
+from pathlib import Path
+from typing import Any, Iterable, Iterator, Set
+
+#Состояния сделки в журнале в порядке стадий конвейера; failed - ошибка на любой из них
+STATES = ("fetched", "rendered", "written", "failed")
+
+
+class RunJournal:
+    #Журнал пакетного запуска в формате JSON Lines, только дозапись: заголовок с отпечатком
+    #входных данных запуска (ID сделок и параметры отчётов), затем состояние каждой сделки
+    #по мере прохождения стадий и запись о завершении. Прерванный запуск с тем же отпечатком
+    #продолжается: сделки в состоянии written пропускаются без загрузки, остальные
+    #обрабатываются заново. Завершённый журнал или журнал другого запуска начинается сначала
+    def __init__(self, path: str, run_hash: str):
+        self.path = Path(path)
+        self.run_hash = run_hash
+        self.done: Set[int] = set()
+        self.skipped = 0
+        self.resumed = self._load()
+        if self.resumed:
+            self._file = open(self.path, 'a', encoding='utf-8')
+            if self._torn:
+                #Строка, оборванная при аварийном завершении, отделяется от новых записей
+                self._file.write("\n")
+        else:
+            self.done.clear()
+            self.path.parent.mkdir(parents=True, exist_ok=True)
+            self._file = open(self.path, 'w', encoding='utf-8')
+            self._append({"run": run_hash, "started": datetime.now().isoformat(timespec='seconds')})
+
+    def _load(self) -> bool:
+        #Чтение прежнего журнала: True, если это незавершённый запуск с тем же отпечатком
+        self._torn = False
+        try:
+            with open(self.path, encoding='utf-8') as f:
+                lines = f.readlines()
+        except FileNotFoundError:
+            return False
+        if not lines:
+            return False
+        self._torn = not lines[-1].endswith("\n")
+
+        header = _parse(lines[0])
+        if header.get("run") != self.run_hash:
+            return False
+        for line in lines[1:]:
+            entry = _parse(line)
+            if "finished" in entry:
+                return False
+            if "deal" not in entry:
+                continue
+            if entry.get("state") == "written":
+                self.done.add(entry["deal"])
+            else:
+                self.done.discard(entry["deal"])
+        return True
+
+    def _append(self, entry: dict) -> None:
+        #Запись сбрасывается на диск сразу: журнал должен пережить падение процесса
+        self._file.write(json.dumps(entry, ensure_ascii=False) + "\n")
+        self._file.flush()
+
+    def remaining(self, deal_ids: Iterable[int]) -> Iterator[int]:
+        #ID сделок без уже записанных отчётов
+        for deal_id in deal_ids:
+            if deal_id in self.done:
+                self.skipped += 1
+                continue
+            yield deal_id
+
+    def mark(self, deal_id: int, state: str, **fields: Any) -> None:
+        if state not in STATES:
+            raise ValueError(f"Неизвестное состояние сделки в журнале: {state}")
+        self._append({"deal": deal_id, "state": state, **fields})
+        if state == "written":
+            self.done.add(deal_id)
+
+    def finish(self, succeeded: int) -> None:
+        #Вызывается для запуска без ошибок: следующий запуск с этим журналом начнётся сначала.
+        #Без записи о завершении повторный запуск обработает только сделки с ошибками
+        self._append({"finished": datetime.now().isoformat(timespec='seconds'), "succeeded": succeeded})
+
+    def close(self) -> None:
+        self._file.close()
+
+
+def _parse(line: str) -> dict:
+    #Повреждённая (оборванная) строка пропускается
+    try:
+        entry = json.loads(line)
+    except ValueError:
+        return {}
+    return entry if isinstance(entry, dict) else {}
@@ -0,0 +1,137 @@
+import json
+import logging
+import re
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Any, Callable, Dict, Hashable, Optional, Tuple
+from urllib.parse import parse_qs, urlsplit
+
+from data_fetchers import BitrixFetcher
+from dossier_generator import ReportGenerator
+from metrics import PROMETHEUS_CONTENT_TYPE
+
+DOSSIER_PATH = re.compile(r"^/deals/(\d+)/dossier/?$")
+CONTENT_TYPES = {
+    "json": "application/json; charset=utf-8",
+    "md": "text/markdown; charset=utf-8",
+}
+
+
+class _Call:
+    __slots__ = ("done", "result", "error")
+
+    def __init__(self):
+        self.done = threading.Event()
+        self.result: Any = None
+        self.error: Optional[BaseException] = None
+
+
+class SingleFlight:
+    #Объединение одновременных вызовов с одним ключом: пока выполняется первый вызов,
+    #остальные ждут и получают его результат (или его исключение), а не повторяют запрос
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._calls: Dict[Hashable, _Call] = {}
+
+    def do(self, key: Hashable, fn: Callable[[], Any]) -> Any:
+        with self._lock:
+            call = self._calls.get(key)
+            leader = call is None
+            if leader:
+                call = self._calls[key] = _Call()
+
+        if not leader:
+            call.done.wait()
+            if call.error is not None:
+                raise call.error
+            return call.result
+
+        try:
+            call.result = fn()
+            return call.result
+        except BaseException as e:
+            call.error = e
+            raise
+        finally:
+            with self._lock:
+                del self._calls[key]
+            call.done.set()
+
+
+class DossierService:
+    #Досье сделок по запросу: фетчер с сессией, кэшем и лимитером создаётся один раз на всё
+    #время работы сервиса, одновременные запросы одной сделки выполняются одной загрузкой
+    def __init__(self, config: Dict, build_report: Callable[[int, Dict, logging.Logger], Dict],
+                 logger: logging.Logger, fetcher: Optional[BitrixFetcher] = None):
+        self.fetcher = fetcher or BitrixFetcher(config)
+        self.metrics = self.fetcher.metrics
+        self.build_report = build_report
+        self.logger = logger
+        self._flight = SingleFlight()
+
+    def dossier(self, deal_id: int, report_format: str = "json") -> str:
+        if report_format not in CONTENT_TYPES:
+            raise ValueError(f"Неизвестный формат отчёта: {report_format}")
+        with self.metrics.stage("fetch"):
+            data = self._flight.do(deal_id, lambda: self.fetcher.get_deal_data(deal_id))
+        if data.get("error"):
+            raise LookupError(f"Не удалось получить данные сделки {deal_id}: {data['error']}")
+        with self.metrics.stage("render"):
+            report = self.build_report(deal_id, data, self.logger)
+            if report_format == "md":
+                return ReportGenerator.generate_markdown(report)
+            return ReportGenerator.generate_json(report)
+
+
+class DossierRequestHandler(BaseHTTPRequestHandler):
+    #GET /deals/{id}/dossier?format=json|md, GET /metrics - метрики в формате Prometheus
+    server: "DossierServer"
+
+    def do_GET(self) -> None:
+        url = urlsplit(self.path)
+        if url.path == "/metrics":
+            self._send(200, PROMETHEUS_CONTENT_TYPE, self.server.service.metrics.to_prometheus())
+            return
+        match = DOSSIER_PATH.match(url.path)
+        if not match:
+            self._send_error(404, "Не найдено")
+            return
+
+        deal_id = int(match.group(1))
+        report_format = parse_qs(url.query).get("format", ["json"])[0]
+        try:
+            body = self.server.service.dossier(deal_id, report_format)
+        except ValueError as e:
+            self._send_error(400, str(e))
+            return
+        except LookupError as e:
+            self._send_error(502, str(e))
+            return
+        except Exception as e:
+            self.server.service.logger.error(f"Ошибка формирования досье сделки {deal_id}: {str(e)}", exc_info=True)
+            self._send_error(500, "Внутренняя ошибка")
+            return
+        self._send(200, CONTENT_TYPES[report_format], body)
+
+    def _send_error(self, status: int, message: str) -> None:
+        self._send(status, CONTENT_TYPES["json"], json.dumps({"error": message}, ensure_ascii=False))
+
+    def _send(self, status: int, content_type: str, body: str) -> None:
+        payload = body.encode('utf-8')
+        self.send_response(status)
+        self.send_header("Content-Type", content_type)
+        self.send_header("Content-Length", str(len(payload)))
+        self.end_headers()
+        self.wfile.write(payload)
+
+    def log_message(self, format: str, *args: Any) -> None:
+        #Журнал запросов идёт в общий логгер сервиса
+        self.server.service.logger.debug("%s " + format, self.address_string(), *args)
+
+
+class DossierServer(ThreadingHTTPServer):
+    daemon_threads = True
+
+    def __init__(self, address: Tuple[str, int], service: DossierService):
+        super().__init__(address, DossierRequestHandler)
+        self.service = service
@@ -0,0 +1,94 @@
+import json
+import os
+from datetime import datetime
+from pathlib import Path
+from typing import Any, Dict, List, Optional
+
+#Ключи get_deal_data, которые при обновлении просто заменяются свежими данными
+REPLACED_KEYS = ("deal", "contact", "user", "openline_dialog")
+
+
+class DealStateStore:
+    #Хранилище состояния сделок для инкрементальной синхронизации: по JSON-файлу на сделку
+    #с накопленными данными get_deal_data и водяными знаками последней загрузки
+    def __init__(self, directory: str):
+        self.directory = Path(directory)
+        self.directory.mkdir(parents=True, exist_ok=True)
+
+    def path(self, deal_id: int) -> Path:
+        return self.directory / f"deal_{deal_id}.state.json"
+
+    def load(self, deal_id: int) -> Optional[Dict]:
+        try:
+            with open(self.path(deal_id), encoding='utf-8') as f:
+                return json.load(f)
+        except FileNotFoundError:
+            return None
+
+    def save(self, deal_id: int, state: Dict) -> None:
+        #Запись через временный файл, чтобы сбой не оставил обрезанное состояние
+        path = self.path(deal_id)
+        tmp_path = path.with_suffix(".tmp")
+        with open(tmp_path, 'w', encoding='utf-8') as f:
+            json.dump(state, f, ensure_ascii=False, default=str)
+        os.replace(tmp_path, path)
+
+
+def merge_state(deal_id: int, state: Optional[Dict], fresh: Dict) -> Dict:
+    #Слияние свежей (частичной) выборки с сохранённым состоянием. Комментарии и активности
+    #объединяются по ID (изменённые заменяются), новые сообщения дописываются в конец
+    if not state:
+        merged = dict(fresh)
+    else:
+        merged = dict(state["data"])
+        for key in REPLACED_KEYS:
+            if key in fresh:
+                merged[key] = fresh[key]
+        merged["timeline"] = _merge_by_id(merged.get("timeline", []), fresh.get("timeline", []), "ID")
+        merged["activities"] = _merge_by_id(merged.get("activities", []), fresh.get("activities", []), "ID")
+        merged["dialog_messages"] = _merge_dialog(merged.get("dialog_messages", {}), fresh.get("dialog_messages", {}))
+
+    return {"deal_id": deal_id, "data": merged, "watermarks": compute_watermarks(merged)}
+
+
+def compute_watermarks(data: Dict) -> Dict[str, Any]:
+    #Водяные знаки для следующей загрузки: последний ID комментария, время последнего
+    #изменения активности и последний ID сообщения
+    watermarks = {}
+    timeline_ids = [int(item["ID"]) for item in data.get("timeline", []) if str(item.get("ID", "")).isdigit()]
+    if timeline_ids:
+        watermarks["timeline_id"] = max(timeline_ids)
+
+    updated = [item["LAST_UPDATED"] for item in data.get("activities", []) if item.get("LAST_UPDATED")]
+    if updated:
+        watermarks["activity_updated"] = max(updated, key=_parse_date)
+
+    dialog = data.get("dialog_messages", {})
+    messages = dialog.get("messages", []) if isinstance(dialog, dict) else []
+    message_ids = [int(msg["id"]) for msg in messages if str(msg.get("id", "")).isdigit()]
+    if message_ids:
+        watermarks["message_id"] = max(message_ids)
+
+    return watermarks
+
+
+def _merge_by_id(old: List[Dict], new: List[Dict], key: str) -> List[Dict]:
+    #Порядок сохраняется: обновлённые записи остаются на месте, новые добавляются в конец
+    merged = {item.get(key): item for item in old}
+    for item in new:
+        merged[item.get(key)] = item
+    return list(merged.values())
+
+
+def _merge_dialog(old: Any, new: Any) -> Any:
+    #Если в свежей выборке нет сообщений (диалог отсутствует или ошибка), берём её как есть
+    if not isinstance(new, dict) or "messages" not in new:
+        return new
+    if not isinstance(old, dict) or "messages" not in old:
+        return new
+    known = {msg.get("id") for msg in old["messages"]}
+    return {**new, "messages": old["messages"] + [msg for msg in new["messages"] if msg.get("id") not in known]}
+
+
+def _parse_date(value: str) -> datetime:
+    return datetime.fromisoformat(value)
@@ -0,0 +1,83 @@
+import unittest
+from cache import TOUCH_BATCH, ResponseCache
+
+class FakeClock:
+    def __init__(self):
+        self.now = 1000.0
+
+    def __call__(self):
+        return self.now
+
+class TestResponseCache(unittest.TestCase):
+    def setUp(self):
+        self.clock = FakeClock()
+        self.cache = ResponseCache(":memory:", max_entries=2, clock=self.clock)
+
+    def tearDown(self):
+        self.cache.close()
+
+    def test_key_normalization(self):
+        #Порядок ключей и тип значений не влияют на ключ
+        self.cache.set("user.get", {"id": 42, "select": ["ID", "NAME"]}, [{"ID": "42"}])
+        self.assertEqual(self.cache.get("user.get", {"select": ["ID", "NAME"], "id": "42"}), [{"ID": "42"}])
+        self.assertEqual(self.cache.stats(), {"hits": 1, "misses": 0, "hit_rate": 1.0})
+
+    def test_ttl_expiry(self):
+        self.cache.set("crm.deal.get", {"id": 1}, {"ID": "1"})
+        self.clock.now += 901
+        self.assertIsNone(self.cache.get("crm.deal.get", {"id": 1}))
+        self.assertEqual(self.cache.misses, 1)
+
+    def test_uncacheable_method(self):
+        self.cache.set("batch", {}, {"result": {}})
+        self.assertFalse(self.cache.is_cacheable("batch"))
+        self.assertIsNone(self.cache.get("batch", {}))
+
+    def test_date_modify_validation(self):
+        self.cache.set("crm.contact.get", {"id": 7}, {"ID": "7", "DATE_MODIFY": "2025-06-10T10:00:00+03:00"})
+        self.assertIsNotNone(self.cache.get("crm.contact.get", {"id": 7}, date_modify="2025-06-10T10:00:00+03:00"))
+        self.assertIsNone(self.cache.get("crm.contact.get", {"id": 7}, date_modify="2025-06-11T09:00:00+03:00"))
+        #Устаревшая запись удаляется
+        self.assertIsNone(self.cache.get("crm.contact.get", {"id": 7}))
+
+    def test_lru_eviction(self):
+        self.cache.set("user.get", {"id": 1}, [1])
+        self.clock.now += 1
+        self.cache.set("user.get", {"id": 2}, [2])
+        self.clock.now += 1
+        self.cache.get("user.get", {"id": 1})  #Запись 1 становится свежее записи 2
+        self.clock.now += 1
+        self.cache.set("user.get", {"id": 3}, [3])
+
+        self.assertEqual(self.cache.get("user.get", {"id": 1}), [1])
+        self.assertIsNone(self.cache.get("user.get", {"id": 2}))
+        self.assertEqual(self.cache.get("user.get", {"id": 3}), [3])
+
+    def test_batch_eviction(self):
+        #При превышении лимита удаляется сразу 10% записей, следующие записи не вытесняют
+        cache = ResponseCache(":memory:", max_entries=10, clock=self.clock)
+        for user_id in range(11):
+            cache.set("user.get", {"id": user_id}, [user_id])
+            self.clock.now += 1
+        present = [user_id for user_id in range(11) if cache.peek("user.get", {"id": user_id})]
+        self.assertEqual(present, list(range(2, 11)))
+
+        cache.set("user.get", {"id": 11}, [11])
+        self.assertIsNotNone(cache.peek("user.get", {"id": 2}))
+        cache.close()
+
+    def test_hits_not_written_immediately(self):
+        #Время обращения копится в памяти и пишется пачкой, а не при каждом попадании
+        cache = ResponseCache(":memory:", clock=self.clock)
+        for user_id in range(TOUCH_BATCH):
+            cache.set("user.get", {"id": user_id}, [user_id])
+        changes = cache._db.total_changes
+        for user_id in range(TOUCH_BATCH - 1):
+            self.assertEqual(cache.get("user.get", {"id": user_id}), [user_id])
+        self.assertEqual(cache._db.total_changes, changes)
+        cache.get("user.get", {"id": TOUCH_BATCH - 1})
+        self.assertEqual(cache._db.total_changes, changes + TOUCH_BATCH)
+        cache.close()
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,96 @@
+import gzip
+import json
+import logging
+import shutil
+import tempfile
+import time
+import unittest
+from pathlib import Path
+from cassette import INDEX_NAME, OBJECTS_DIR, CassetteMiss, CassetteStore
+from data_fetchers import BitrixFetcher
+from fake_bitrix import FakeBitrixServer, FakePortal
+
+class TestCassette(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.server = FakeBitrixServer(FakePortal(deals=3, comments=60, activities=2, messages=10)).start()
+
+    def tearDown(self):
+        self.server.stop()
+        shutil.rmtree(self.directory)
+
+    def config(self, **extra):
+        return {
+            "bitrix_url": self.server.url,
+            "bitrix_token": "secret-token",
+            "rate_limit": 1000,
+            "rate_burst": 1000,
+            "logger": logging.getLogger("test"),
+            **extra
+        }
+
+    def record(self, deal_ids):
+        store = CassetteStore(self.directory, mode="record")
+        results = dict(BitrixFetcher(self.config(cassette=store)).get_deals_data(deal_ids))
+        store.close()
+        return results, store
+
+    def test_replay_without_portal(self):
+        recorded, store = self.record([1, 2, 3])
+        requests_made = self.server.snapshot()["requests"]
+        self.assertEqual(store.stats["recorded"], requests_made)
+        self.server.stop()
+        self.server = FakeBitrixServer(FakePortal(deals=0)).start()
+
+        replay = CassetteStore(self.directory)
+        config = self.config(cassette=replay, bitrix_url="http://bitrix.invalid", bitrix_token="other")
+        replayed = dict(BitrixFetcher(config).get_deals_data([1, 2, 3]))
+
+        self.assertEqual(replayed, recorded)
+        self.assertEqual(replay.stats["requests"], requests_made)
+        self.assertEqual(replay.stats["misses"], 0)
+
+    def test_store_is_compressed_content_addressed_and_tokenless(self):
+        self.record([1])
+        self.record([1])  #Повторная запись тех же ответов не добавляет тел
+
+        index = Path(self.directory, INDEX_NAME).read_text(encoding='utf-8')
+        self.assertNotIn("secret-token", index)
+        entries = [json.loads(line) for line in index.splitlines()]
+        objects = list(Path(self.directory, OBJECTS_DIR).glob("*/*.gz"))
+        self.assertEqual(len(objects), len({entry["body"] for entry in entries}))
+        self.assertLess(len(objects), len(entries))
+        body = gzip.decompress(objects[0].read_bytes())
+        self.assertIn("result", json.loads(body))
+
+    def test_miss_raises(self):
+        self.record([1])
+        fetcher = BitrixFetcher(self.config(cassette=CassetteStore(self.directory)))
+
+        with self.assertRaises(CassetteMiss):
+            fetcher.call_batch({"deal": ("crm.deal.get", {"id": 2})})
+        data = fetcher.get_deal_data(2)
+        self.assertIn("error", data)
+
+    def test_recorded_latency(self):
+        self.server.latency = 0.05
+        self.record([1])
+
+        fetcher = BitrixFetcher(self.config(cassette=CassetteStore(self.directory, latency="recorded")))
+        started = time.perf_counter()
+        fetcher.get_deals_data([1]).__next__()
+        self.assertGreaterEqual(time.perf_counter() - started, 0.05)
+
+        fetcher = BitrixFetcher(self.config(cassette=CassetteStore(self.directory)))
+        started = time.perf_counter()
+        fetcher.get_deals_data([1]).__next__()
+        self.assertLess(time.perf_counter() - started, 0.05)
+
+    def test_invalid_mode(self):
+        with self.assertRaises(ValueError):
+            CassetteStore(self.directory, mode="rewind")
+        with self.assertRaises(FileNotFoundError):
+            CassetteStore(str(Path(self.directory, "missing")))
+
+if __name__ == '__main__':
+    unittest.main()
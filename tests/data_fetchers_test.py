@@ -1,9 +1,16 @@
+import os
 import unittest
 from unittest.mock import MagicMock, call, patch
-from data_fetchers import BaseFetcher, BitrixFetcher
+import asyncio
+import requests
+from data_fetchers import AsyncBitrixFetcher, BaseFetcher, BitrixFetcher
+from rate_limiter import RateLimiter
+from cache import ResponseCache
+from fake_bitrix import DEAL_STAGES, FakeBitrixServer, FakePortal
 
 class TestBaseFetcherConfig(unittest.TestCase):
     def setUp(self):
+        self.bitrix_url = "https://test.bitrix24.ru"
         self.test_config = {
             "log_level": "DEBUG",
             "logger": MagicMock()
@@ -24,7 +31,7 @@ class TestBaseFetcherConfig(unittest.TestCase):
 
     def test_pagination_with_real_config(self):
         #тест пагинации, используем URL для теста
-        mock_response = MagicMock()
+        mock_response = MagicMock(status_code=200, content=b"")
         mock_response.json.side_effect = [
             {"result": [1,2], "total": 4},
             {"result": [3,4], "total": 4}
@@ -38,10 +45,42 @@ class TestBaseFetcherConfig(unittest.TestCase):
         
         self.assertEqual(results, [1,2,3,4])
         self.fetcher.logger.debug.assert_has_calls([
-            call("Пагинация: start=0, получено 2 элементов"),
-            call("Пагинация: start=2, получено 2 элементов")
+            call("Пагинация: start=%d, получено %d элементов", 0, 2),
+            call("Пагинация: start=%d, получено %d элементов", 2, 2)
         ])
 
+    def test_iter_items_keyset_mode(self):
+        #В режиме keyset вместо смещения передаётся filter[>ID] последнего элемента и start=-1
+        first_page = [{"ID": i} for i in range(1, 51)]
+        responses = [{"result": first_page}, {"result": [{"ID": 51}, {"ID": 52}]}]
+        sent = []
+
+        def request(http_method, url, methods, params):
+            sent.append(dict(params))
+            return responses[len(sent) - 1]
+        self.fetcher._request = request
+
+        items = self.fetcher.iter_items("https://test/rest/crm.activity.list",
+                                        {"filter": {"OWNER_ID": 5}}, keyset=True)
+
+        self.assertEqual(next(items), {"ID": 1})
+        self.assertEqual(len(sent), 1)  #Вторая страница запрашивается только по мере чтения
+        self.assertEqual([item["ID"] for item in items][-2:], [51, 52])
+        self.assertEqual(sent[0]["start"], -1)
+        self.assertEqual(sent[0]["order[ID]"], "ASC")
+        self.assertEqual(sent[0]["filter[OWNER_ID]"], "5")
+        self.assertNotIn("filter[>ID]", sent[0])
+        self.assertEqual(sent[1]["filter[>ID]"], 50)
+
+    def test_handle_pagination_offset_mode(self):
+        self.fetcher._request = MagicMock(side_effect=[
+            {"result": [1, 2], "total": 3},
+            {"result": [3], "total": 3}
+        ])
+
+        self.assertEqual(self.fetcher._handle_pagination("https://test/rest/crm.deal.list", {}), [1, 2, 3])
+        self.assertEqual(self.fetcher._request.call_args.kwargs["params"]["start"], 2)
+
 class TestBitrixFetcherConfig(unittest.TestCase):
     def setUp(self):
         # Мокаем переменные окружения
@@ -50,9 +89,13 @@ class TestBitrixFetcherConfig(unittest.TestCase):
             'BITRIX_TOKEN': 'test_token'
         })
         self.patcher.start()
-        
-        self.fetcher = BitrixFetcher()
-        self.fetcher.logger = MagicMock()
+
+        self.test_config = {
+            "bitrix_url": os.environ["BITRIX_URL"],
+            "bitrix_token": os.environ["BITRIX_TOKEN"],
+            "logger": MagicMock()
+        }
+        self.fetcher = BitrixFetcher(self.test_config)
         self.fetcher.session = MagicMock()
 
     def tearDown(self):
@@ -63,32 +106,248 @@ class TestBitrixFetcherConfig(unittest.TestCase):
         self.assertEqual(self.fetcher.base_url, expected_url)
 
     def test_full_workflow_with_config(self):
-        self.fetcher.session.get.side_effect = [
-            self._mock_response({"ASSIGNED_BY_ID": 42}),
-            self._mock_response({"PHONE": "123456"}),
-            self._mock_response({"NAME": "John"}),
-            self._mock_response([]),
-            self._mock_response([{"id": 1}]),
-            self._mock_response({"messages": []}),
-            self._mock_response({"dialog": "info"})
-        ]
-        self.fetcher._get_dialog_id = MagicMock(return_value="123")
+        #Все данные сделки приходят одним запросом batch
+        self.fetcher.session.post.return_value = self._mock_response({
+            "result": {
+                "deal": {"ASSIGNED_BY_ID": 42, "CONTACT_ID": 7},
+                "contact": {"PHONE": "123456"},
+                "user": [{"NAME": "John"}],
+                "timeline": [],
+                "activities": [{"id": 1}],
+                "dialog_activity": [{"ASSOCIATED_ENTITY_ID": "123"}],
+                "dialog_messages": {"messages": []},
+                "openline_dialog": {"dialog": "info"}
+            },
+            "result_error": []
+        })
 
         data = self.fetcher.get_deal_data(123)
 
         self.assertEqual(data["deal"]["ASSIGNED_BY_ID"], 42)
         self.assertEqual(data["contact"]["PHONE"], "123456")
         self.assertEqual(data["user"]["NAME"], "John")
+        self.assertEqual(data["openline_dialog"], {"dialog": "info"})
+
+        self.fetcher.session.post.assert_called_once()
+        self.fetcher.session.get.assert_not_called()
+        args, kwargs = self.fetcher.session.post.call_args
+        self.assertEqual(args[0], f"{self.fetcher.base_url}batch")
+        cmd = kwargs["json"]["cmd"]
+        self.assertEqual(cmd["deal"], "crm.deal.get?id=123")
+        self.assertEqual(
+            cmd["user"],
+            "user.get?id=$result[deal][ASSIGNED_BY_ID]&select[0]=ID&select[1]=NAME"
+            "&select[2]=LAST_NAME&select[3]=EMAIL&select[4]=WORK_POSITION"
+        )
+        self.assertIn("$result[dialog_activity][0][ASSOCIATED_ENTITY_ID]", cmd["dialog_messages"])
+
+    def test_batch_without_dialog_and_user(self):
+        self.fetcher.session.post.return_value = self._mock_response({
+            "result": {"deal": {"ID": 5}, "dialog_activity": []},
+            "result_error": {"user": {"error": "ERROR"}, "dialog_messages": {"error": "ERROR"}}
+        })
+
+        data = self.fetcher.get_deal_data(5)
+
+        self.assertEqual(data["user"], {"error": "Ответственный не указан"})
+        self.assertEqual(data["contact"], {})
+        self.assertEqual(data["dialog_messages"], {"info": "Диалог отсутствует"})
+        self.assertEqual(data["openline_dialog"], {"info": "Диалог отсутствует"})
 
-        expected_calls = [
-            call(f"{self.fetcher.base_url}crm.deal.get", params={"id": 123}),
-            call(f"{self.fetcher.base_url}crm.contact.get", params={"id": 123}),
-            call(f"{self.fetcher.base_url}user.get", params={
-                "id": 42,
-                "select": ["ID", "NAME", "LAST_NAME", "EMAIL", "WORK_POSITION"]
+    def test_batch_deal_error(self):
+        self.fetcher.session.post.return_value = self._mock_response({
+            "result": [],
+            "result_error": {"deal": {"error": "NOT_FOUND", "error_description": "Not found"}}
+        })
+
+        data = self.fetcher.get_deal_data(404)
+
+        self.assertEqual(data, {"error": "Not found"})
+
+    def test_batch_retries_after_limit_error(self):
+        #Ответ 503 не прерывает досье: лимитер делает паузу и запрос повторяется
+        self.fetcher.rate_limiter = RateLimiter(sleep=MagicMock())
+        limited = MagicMock(status_code=503, headers={})
+        limited.json.return_value = {"error": "QUERY_LIMIT_EXCEEDED"}
+        self.fetcher.session.post.side_effect = [
+            limited,
+            self._mock_response({"result": {"deal": {"ID": 1}}})
+        ]
+
+        data = self.fetcher.get_deal_data(1)
+
+        self.assertEqual(data["deal"], {"ID": 1})
+        self.assertEqual(self.fetcher.session.post.call_count, 2)
+        self.fetcher.rate_limiter._sleep.assert_called()
+
+    def test_limit_error_in_payload_retried(self):
+        #OPERATION_TIME_LIMIT может прийти в теле ответа без кода 503: запрос тоже повторяется
+        self.fetcher.rate_limiter = RateLimiter(sleep=MagicMock())
+        limited = MagicMock(status_code=400, headers={})
+        limited.json.return_value = {"error": "OPERATION_TIME_LIMIT", "error_description": "Method is blocked"}
+        self.fetcher.session.post.side_effect = [
+            limited,
+            self._mock_response({"result": {"deal": {"ID": 1}}})
+        ]
+
+        data = self.fetcher.get_deal_data(1)
+
+        self.assertEqual(data["deal"], {"ID": 1})
+        self.assertEqual(self.fetcher.session.post.call_count, 2)
+        self.fetcher.rate_limiter._sleep.assert_called()
+
+    def test_long_activity_list_continues_with_keyset(self):
+        #Полная первая страница из batch дочитывается постранично после последнего ID
+        first_page = [{"ID": i, "CREATED": "2025-06-10T10:00:00"} for i in range(1, 51)]
+        self.fetcher.session.post.return_value = self._mock_response({
+            "result": {"deal": {"ID": 1}, "activities": first_page}
+        })
+        self.fetcher.iter_items = MagicMock(return_value=iter([{"ID": 51}]))
+
+        data = self.fetcher.get_deal_data(1)
+
+        self.assertEqual(len(data["activities"]), 51)
+        args, kwargs = self.fetcher.iter_items.call_args
+        self.assertEqual(args[0], f"{self.fetcher.base_url}crm.activity.list")
+        self.assertTrue(kwargs["keyset"])
+        self.assertEqual(kwargs["after"], 50)
+
+    def test_repeated_deal_served_from_cache(self):
+        #Повторный запрос той же сделки сверяет только DATE_MODIFY сделки и контакта,
+        #зависимые команды находятся в кэше по конкретным параметрам после подстановки $result
+        self.fetcher.cache = ResponseCache(":memory:")
+        self.fetcher.session.post.side_effect = [
+            self._mock_response({
+                "result": {
+                    "deal": {"ID": 1, "ASSIGNED_BY_ID": 42, "CONTACT_ID": 7, "DATE_MODIFY": "2025-06-10T10:00:00"},
+                    "contact": {"ID": 7, "DATE_MODIFY": "2025-06-01T10:00:00"},
+                    "user": [{"ID": 42, "NAME": "John"}],
+                    "timeline": [],
+                    "activities": [],
+                    "dialog_activity": []
+                }
+            }),
+            self._mock_response({
+                "result": {
+                    "crm.deal.get_0": [{"ID": "1", "DATE_MODIFY": "2025-06-10T10:00:00"}],
+                    "crm.contact.get_0": [{"ID": "7", "DATE_MODIFY": "2025-06-01T10:00:00"}]
+                }
             })
         ]
-        self.fetcher.session.get.assert_has_calls(expected_calls[:3])
+
+        first = self.fetcher.get_deal_data(1)
+        second = self.fetcher.get_deal_data(1)
+
+        self.assertEqual(first, second)
+        self.assertEqual(self.fetcher.session.post.call_count, 2)
+        check = self.fetcher.session.post.call_args.kwargs["json"]["cmd"]
+        self.assertEqual(sorted(check), ["crm.contact.get_0", "crm.deal.get_0"])
+        self.assertTrue(check["crm.deal.get_0"].startswith("crm.deal.list?filter[ID][0]=1&select[0]=ID"))
+        self.assertEqual(self.fetcher.cache.get("user.get", {
+            "id": 42, "select": ["ID", "NAME", "LAST_NAME", "EMAIL", "WORK_POSITION"]
+        }), [{"ID": 42, "NAME": "John"}])
+
+    def test_invalidate_deal_forces_refetch(self):
+        #После события по сделке её данные запрашиваются заново, а не берутся из кэша
+        self.fetcher.cache = ResponseCache(":memory:")
+        self.fetcher.session.post.return_value = self._mock_response({
+            "result": {"deal": {"ID": 1, "ASSIGNED_BY_ID": 42}, "user": [{"ID": 42}], "timeline": [], "activities": []}
+        })
+        self.fetcher.get_deal_data(1)
+        self.fetcher.invalidate_deal(1)
+        self.fetcher.get_deal_data(1)
+
+        self.assertEqual(self.fetcher.session.post.call_count, 2)
+        second_batch = self.fetcher.session.post.call_args.kwargs["json"]["cmd"]
+        self.assertIn("deal", second_batch)
+        self.assertIn("timeline", second_batch)
+
+    def test_incremental_requests_only_changes(self):
+        #С водяными знаками запрашиваются только новые комментарии, сообщения и изменённые активности
+        self.fetcher.session.post.return_value = self._mock_response({
+            "result": {"deal": {"ID": 1}, "timeline": [{"ID": "12"}], "activities": []}
+        })
+        state = {
+            "deal_id": 1,
+            "data": {"deal": {"ID": 1}, "timeline": [{"ID": "11"}], "activities": []},
+            "watermarks": {"timeline_id": 11, "activity_updated": "2025-06-11T09:00:00+03:00", "message_id": 101}
+        }
+
+        new_state = self.fetcher.get_deal_data_incremental(1, state)
+
+        cmd = self.fetcher.session.post.call_args.kwargs["json"]["cmd"]
+        self.assertIn("filter[%3EID]=11", cmd["timeline"])
+        self.assertIn("filter[%3ELAST_UPDATED]=2025-06-11T09%3A00%3A00%2B03%3A00", cmd["activities"])
+        self.assertIn("FIRST_ID=101", cmd["dialog_messages"])
+        self.assertEqual([item["ID"] for item in new_state["data"]["timeline"]], ["11", "12"])
+        self.assertEqual(new_state["watermarks"]["timeline_id"], 12)
+
+    def test_bulk_deduplicates_users_and_contacts(self):
+        #Три сделки с одним ответственным: справочники запрашиваются одним batch без повторов,
+        #а для следующей группы берутся из памяти фетчера
+        deals = {1: 42, 2: 42, 3: 43}
+        deal_batch = self._mock_response({"result": {
+            f"deal_{deal_id}": {"ID": deal_id, "ASSIGNED_BY_ID": user_id, "CONTACT_ID": 7}
+            for deal_id, user_id in deals.items()
+        }})
+        lookup_batch = self._mock_response({"result": {
+            "users_0": [{"ID": "42", "NAME": "John"}, {"ID": "43", "NAME": "Jane"}],
+            "contacts_0": [{"ID": "7", "NAME": "Клиент"}]
+        }})
+        next_deal_batch = self._mock_response({"result": {"deal_4": {"ID": 4, "ASSIGNED_BY_ID": 43}}})
+        self.fetcher.session.post.side_effect = [deal_batch, lookup_batch, next_deal_batch]
+
+        results = dict(self.fetcher.get_deals_data([1, 2, 3, 4], chunk_size=3))
+
+        self.assertEqual(results[2]["user"]["NAME"], "John")
+        self.assertEqual(results[3]["user"]["NAME"], "Jane")
+        self.assertEqual(results[1]["contact"]["NAME"], "Клиент")
+        self.assertEqual(results[4]["user"]["NAME"], "Jane")
+        self.assertEqual(self.fetcher.session.post.call_count, 3)
+
+        deal_cmd = self.fetcher.session.post.call_args_list[0].kwargs["json"]["cmd"]
+        self.assertNotIn("user_1", deal_cmd)
+        lookup_cmd = self.fetcher.session.post.call_args_list[1].kwargs["json"]["cmd"]
+        self.assertEqual(lookup_cmd["users_0"], "user.get?FILTER[ID][0]=42&FILTER[ID][1]=43")
+        self.assertTrue(lookup_cmd["contacts_0"].startswith("crm.contact.list?filter[ID][0]=7&"))
+
+    def test_dialog_id_is_memoized(self):
+        self.fetcher.session.post.return_value = self._mock_response({"result": {
+            "deal": {"ID": 1}, "dialog_activity": [{"ASSOCIATED_ENTITY_ID": "55"}],
+            "dialog_messages": {"messages": []}
+        }})
+
+        self.fetcher.get_deal_data(1)
+        data = self.fetcher.get_deal_data(1)
+
+        cmd = self.fetcher.session.post.call_args.kwargs["json"]["cmd"]
+        self.assertNotIn("dialog_activity", cmd)
+        self.assertEqual(cmd["openline_dialog"], "imopenlines.dialog.get?DIALOG_ID=55")
+        self.assertEqual(data["dialog_messages"], {"messages": []})
+        self.assertEqual(self.fetcher._get_dialog_id(1), "55")
+
+    def test_iter_dialog_messages_pages_by_cursor(self):
+        #Сообщения отдаются по возрастанию ID, следующая страница запрашивается с FIRST_ID
+        pages = [
+            {"result": {"messages": [{"id": i} for i in range(50, 0, -1)]}},
+            {"result": {"messages": [{"id": 52}, {"id": 51}]}}
+        ]
+        self.fetcher._request = MagicMock(side_effect=pages)
+
+        messages = list(self.fetcher.iter_dialog_messages("chat5"))
+
+        self.assertEqual([msg["id"] for msg in messages], list(range(1, 53)))
+        first_ids = [c.kwargs["params"]["FIRST_ID"] for c in self.fetcher._request.call_args_list]
+        self.assertEqual(first_ids, [0, 50])
+
+    def test_iter_dialog_messages_with_limit(self):
+        self.fetcher._request = MagicMock(return_value={"result": {"messages": [{"id": 2}, {"id": 1}]}})
+
+        messages = list(self.fetcher.iter_dialog_messages("chat5", limit=2))
+
+        self.assertEqual([msg["id"] for msg in messages], [1, 2])
+        self.assertEqual(self.fetcher._request.call_args.kwargs["params"]["LIMIT"], 2)
+        self.fetcher._request.assert_called_once()
 
     def _mock_response(self, data):
         response = MagicMock()
@@ -103,5 +362,83 @@ class TestBitrixFetcherConfig(unittest.TestCase):
         self.test_config["logger"].debug.assert_called_with("Test debug")
         self.test_config["logger"].error.assert_called_with("Test error")
 
+class TestAsyncBitrixFetcher(unittest.IsolatedAsyncioTestCase):
+    def setUp(self):
+        self.fetcher = AsyncBitrixFetcher({
+            "bitrix_url": "https://test.bitrix24.ru",
+            "bitrix_token": "test_token",
+            "logger": MagicMock()
+        }, concurrency=2)
+
+    async def test_get_deal_data_uses_batch(self):
+        async def post_batch(cmd, halt):
+            self.assertEqual(cmd["deal"], "crm.deal.get?id=7")
+            return {"result": {"deal": {"ID": 7, "ASSIGNED_BY_ID": 1}, "user": [{"NAME": "John"}]}}
+        self.fetcher._post_batch = post_batch
+
+        data = await self.fetcher.get_deal_data(7)
+
+        self.assertEqual(data["deal"]["ID"], 7)
+        self.assertEqual(data["user"]["NAME"], "John")
+        self.assertEqual(data["dialog_messages"], {"info": "Диалог отсутствует"})
+
+    async def test_get_deals_data_respects_concurrency(self):
+        in_flight, peak = 0, 0
+
+        async def get_deal_data(deal_id):
+            nonlocal in_flight, peak
+            in_flight += 1
+            peak = max(peak, in_flight)
+            await asyncio.sleep(0.01)
+            in_flight -= 1
+            return {"deal": {"ID": deal_id}}
+        self.fetcher.get_deal_data = get_deal_data
+
+        results = {deal_id: data async for deal_id, data in self.fetcher.get_deals_data(range(1, 6))}
+
+        self.assertEqual(sorted(results), [1, 2, 3, 4, 5])
+        self.assertEqual(results[4]["deal"]["ID"], 4)
+        self.assertEqual(peak, 2)
+
+class TestDealCrawler(unittest.TestCase):
+    def setUp(self):
+        self.server = FakeBitrixServer(FakePortal(deals=130, users=4)).start()
+        self.fetcher = BitrixFetcher({
+            "bitrix_url": self.server.url,
+            "bitrix_token": "test",
+            "rate_limit": 1000,
+            "rate_burst": 1000,
+            "logger": MagicMock()
+        })
+
+    def tearDown(self):
+        self.server.stop()
+
+    def test_streams_all_deals_by_keyset(self):
+        deal_ids = self.fetcher.iter_deal_ids()
+        #Первый ID доступен после первой страницы, до получения всего списка
+        self.assertEqual(next(deal_ids), 1)
+        self.assertEqual(self.server.snapshot()["method:crm.deal.list"], 1)
+        self.assertEqual([1, *deal_ids], list(range(1, 131)))
+        self.assertEqual(self.server.snapshot()["method:crm.deal.list"], 3)
+
+    def test_filters(self):
+        portal = self.server.portal
+        stage = DEAL_STAGES[1]
+        filters = {"STAGE_ID": [stage], "ASSIGNED_BY_ID": "2", ">=DATE_MODIFY": portal.deal(40)["DATE_MODIFY"]}
+        expected = [deal_id for deal_id in range(40, 131)
+                    if portal.deal(deal_id)["STAGE_ID"] == stage and portal.deal(deal_id)["ASSIGNED_BY_ID"] == "2"]
+        self.assertTrue(expected)
+        self.assertEqual(list(self.fetcher.iter_deal_ids(filters)), expected)
+        self.assertEqual(list(self.fetcher.iter_deal_ids({"CATEGORY_ID": "1"}, after=120)), [121, 123, 125, 127, 129])
+
+    def test_error_interrupts_crawl(self):
+        self.fetcher.transport.retries = 0
+        self.server.fail_every = 2
+        deal_ids = self.fetcher.iter_deal_ids()
+        self.assertEqual(next(deal_ids), 1)
+        with self.assertRaises(requests.HTTPError):
+            list(deal_ids)
+
 if __name__ == "__main__":
     unittest.main()
@@ -1,6 +1,11 @@
+import io
+import json
 import unittest
+import unittest.mock
 from datetime import datetime
+import dossier_generator
 from dossier_generator import ReportGenerator
+from processors import DataProcessor
 
 class TestReportGenerator(unittest.TestCase):
 
@@ -10,15 +15,14 @@ class TestReportGenerator(unittest.TestCase):
         self.assertIn('"key": "value"', json_str)
         self.assertIn('"number": 123', json_str)
         #проверяем, что json_str — корректная строка JSON
-        import json
         parsed = json.loads(json_str)
         self.assertEqual(parsed, data)
 
     def test_generate_json_with_non_serializable(self):
-        #Проверяем, что default=str корректно обрабатывает нестандартные типы
+        #Даты выводятся в ISO 8601
         data = {"date": datetime(2025, 6, 10, 15, 0)}
         json_str = ReportGenerator.generate_json(data)
-        self.assertIn("2025-06-10 15:00:00", json_str)
+        self.assertIn("2025-06-10T15:00:00", json_str)
 
     def test_generate_markdown_basic(self):
         data = {
@@ -45,14 +49,16 @@ class TestReportGenerator(unittest.TestCase):
             "dialog_messages": {
                 "messages": [
                     {
-                        "DATE": "2025-06-10 12:31",
-                        "AUTHOR": "Иван",
-                        "MESSAGE": "Здравствуйте!"
+                        "id": 5000001,
+                        "author_id": 1,
+                        "date": "2025-06-10T12:31:00+03:00",
+                        "text": "Здравствуйте!"
                     },
                     {
-                        "DATE": "2025-06-10 12:32",
-                        "AUTHOR": "Клиент",
-                        "MESSAGE": "Добрый день!"
+                        "id": 5000002,
+                        "author_id": 7,
+                        "date": "2025-06-10T12:32:00+03:00",
+                        "text": "Добрый день!"
                     }
                 ]
             }
@@ -68,8 +74,8 @@ class TestReportGenerator(unittest.TestCase):
         self.assertIn("## Ответственный", md)
         self.assertIn("- Имя: Иван", md)
         self.assertIn("## История переписки", md)
-        self.assertIn("**2025-06-10 12:31 Иван**: Здравствуйте!", md)
-        self.assertIn("**2025-06-10 12:32 Клиент**: Добрый день!", md)
+        self.assertIn("**2025-06-10T12:31:00+03:00 1**: Здравствуйте!", md)
+        self.assertIn("**2025-06-10T12:32:00+03:00 7**: Добрый день!", md)
 
     def test_generate_markdown_user_error(self):
         data = {
@@ -130,14 +136,142 @@ class TestReportGenerator(unittest.TestCase):
             "dialog_messages": {
                 "messages": [
                     {},  #пустое сообщение
-                    {"DATE": "2025-06-10", "AUTHOR": "Автор"}  #без MESSAGE
+                    {"id": 1, "date": "2025-06-10T12:31:00+03:00", "author_id": 7}  #без text
                 ]
             }
         }
         md = ReportGenerator.generate_markdown(data)
-        self.assertIn("Дата неизвестна", md)
-        self.assertIn("Текст отсутствует", md)
-        self.assertIn("Автор", md)
+        self.assertIn("**Дата неизвестна Неизвестный автор**: Текст отсутствует", md)
+        self.assertIn("**2025-06-10T12:31:00+03:00 7**: Текст отсутствует", md)
+
+    def test_generate_markdown_dialog_legacy_fields(self):
+        #Старые выгрузки с полями DATE, AUTHOR и MESSAGE выводятся так же
+        data = {
+            "deal_id": 107,
+            "timeline": [],
+            "user": {},
+            "dialog_messages": {"messages": [{"DATE": "2025-06-10 12:31", "AUTHOR": "Иван", "MESSAGE": "Здравствуйте!"}]}
+        }
+        md = ReportGenerator.generate_markdown(data)
+        self.assertIn("**2025-06-10 12:31 Иван**: Здравствуйте!", md)
+
+    def test_generate_markdown_streams_message_iterator(self):
+        #История переписки может быть итератором, сообщения выводятся по мере чтения
+        messages = ({"id": i, "author_id": 7, "date": f"2025-06-10T12:{i:02d}:00+03:00", "text": f"Сообщение {i}"}
+                    for i in range(3))
+        data = {
+            "deal_id": 108,
+            "timeline": [],
+            "user": {},
+            "dialog_messages": {"messages": messages}
+        }
+        md = ReportGenerator.generate_markdown(data)
+        self.assertIn("**2025-06-10T12:02:00+03:00 7**: Сообщение 2", md)
+
+    def test_generate_json_expands_lazy_messages(self):
+        data = {"dialog": {"messages": (msg for msg in [{"id": 1}])}}
+        self.assertEqual(json.loads(ReportGenerator.generate_json(data)), {"dialog": {"messages": [{"id": 1}]}})
+
+    def test_reports_accept_timeline_events(self):
+        #Отчёты строятся по событиям merge_timeline
+        timeline = list(DataProcessor.merge_timeline({"activities": [
+            {"CREATED": "2025-06-10T12:30:00", "ID": "1", "SUBJECT": "Первый звонок"}
+        ]}))
+        data = {"deal_id": 109, "timeline": timeline, "user": {}, "dialog_messages": {}}
+
+        md = ReportGenerator.generate_markdown(data)
+        self.assertIn("## 2025-06-10 12:30", md)
+        self.assertIn("- Детали: Первый звонок", md)
+
+        event = json.loads(ReportGenerator.generate_json(data))["timeline"][0]
+        self.assertEqual(event["subject"], "Первый звонок")
+        self.assertEqual(event["type"], "activity")
+
+    def test_render_markdown_streams_to_file(self):
+        #render_markdown пишет в поток по частям, generate_markdown возвращает тот же текст
+        data = {
+            "deal_id": 110,
+            "timeline": iter([{"date": datetime(2025, 6, 10, 12, 30), "type": "call", "data": {"SUBJECT": "Звонок"}}]),
+            "user": {"error": "Ответственный не указан"},
+            "dialog_messages": {"info": "Диалог отсутствует"}
+        }
+        stream = io.StringIO()
+        stream.write = unittest.mock.MagicMock(wraps=stream.write)
+
+        ReportGenerator.render_markdown(data, stream)
+
+        self.assertGreater(stream.write.call_count, 2)
+        data["timeline"] = [{"date": datetime(2025, 6, 10, 12, 30), "type": "call", "data": {"SUBJECT": "Звонок"}}]
+        self.assertEqual(stream.getvalue(), ReportGenerator.generate_markdown(data))
+
+    def test_render_json_without_orjson_streams_same_output(self):
+        #Без orjson отчёт пишется по частям стандартным json и совпадает с json.dumps
+        def make_data():
+            timeline = DataProcessor.merge_timeline({"activities": [
+                {"CREATED": "2025-06-10T12:30:00+03:00", "ID": "1", "SUBJECT": "Звонок"}
+            ]})
+            return {"deal_id": 111, "timeline": timeline, "dialog": {"messages": iter([{"id": 1}])}}
+
+        stream = io.StringIO()
+        stream.write = unittest.mock.MagicMock(wraps=stream.write)
+        with unittest.mock.patch.object(dossier_generator, "orjson", None):
+            ReportGenerator.render_json(make_data(), stream)
+            for compact, separators in ((False, None), (True, (',', ':'))):
+                self.assertEqual(
+                    ReportGenerator.generate_json(make_data(), compact),
+                    json.dumps(make_data(), indent=None if compact else 2, separators=separators,
+                               ensure_ascii=False, default=dossier_generator._json_default)
+                )
+
+        self.assertGreater(stream.write.call_count, 1)
+        self.assertIn('"date": "2025-06-10T12:30:00+03:00"', stream.getvalue())
+
+    def test_render_json_streams_messages_one_by_one(self):
+        #Сообщения пишутся в поток по мере чтения, а не собираются в список перед кодированием
+        stream = io.StringIO()
+        written = []
+        def messages():
+            for number in range(3):
+                written.append(stream.getvalue().count('"text"'))
+                yield {"id": number, "text": f"Сообщение {number}"}
+
+        for encoder in (dossier_generator.orjson, None):
+            with self.subTest(orjson=encoder is not None), \
+                    unittest.mock.patch.object(dossier_generator, "orjson", encoder):
+                stream.seek(0)
+                stream.truncate()
+                written.clear()
+                ReportGenerator.render_json({"deal_id": 114, "dialog": {"messages": messages()}}, stream)
+                self.assertEqual(written, [0, 1, 2])
+
+    def test_render_json_with_orjson_streams_events(self):
+        #orjson кодирует отчёт по событиям и сообщениям, а не одним вызовом, с тем же выводом
+        if dossier_generator.orjson is None:
+            self.skipTest("orjson не установлен")
+        def make_data():
+            timeline = DataProcessor.merge_timeline({"activities": [
+                {"CREATED": f"2025-06-10T12:3{i}:00+03:00", "ID": str(i), "SUBJECT": "Звонок"} for i in range(3)
+            ]})
+            return {"deal_id": 113, "deal": {"ID": "113", "PHONE": [{"VALUE": "+7900"}]}, "timeline": timeline,
+                    "dialog_messages": {"messages": iter([{"id": 1, "params": {"a": [1]}}, {"id": 2}])},
+                    "contact": {}, "activities": []}
+
+        for compact in (False, True):
+            with unittest.mock.patch.object(dossier_generator, "orjson", None):
+                expected = ReportGenerator.generate_json(make_data(), compact)
+            stream = io.StringIO()
+            stream.write = unittest.mock.MagicMock(wraps=stream.write)
+            ReportGenerator.render_json(make_data(), stream, compact)
+
+            self.assertEqual(stream.getvalue(), expected)
+            self.assertGreater(stream.write.call_count, 5)
+
+    def test_generate_json_compact(self):
+        data = {"deal_id": 112, "timeline": [], "user": {"ID": 1}}
+        for encoder in (dossier_generator.orjson, None):
+            with unittest.mock.patch.object(dossier_generator, "orjson", encoder):
+                self.assertEqual(ReportGenerator.generate_json(data, compact=True),
+                                 '{"deal_id":112,"timeline":[],"user":{"ID":1}}')
 
 if __name__ == "__main__":
     unittest.main()
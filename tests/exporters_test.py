@@ -0,0 +1,78 @@
+import json
+import shutil
+import tempfile
+import unittest
+from pathlib import Path
+from unittest.mock import patch
+import exporters
+from exporters import NdjsonExporter, ParquetExporter, open_exporter
+from processors import DataProcessor
+
+DEAL_DATA = {
+    "activities": [
+        {"CREATED": "2025-06-10T12:30:00+03:00", "ID": "1", "SUBJECT": "Звонок", "AUTHOR_ID": "7"},
+        {"CREATED": "2025-06-11T09:00:00+03:00", "ID": "2", "SUBJECT": "Письмо"}
+    ],
+    "timeline": [{"CREATED": "2025-06-10T15:00:00+03:00", "ID": "10", "COMMENT": "Комментарий"}]
+}
+
+class TestNdjsonExporter(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.path = Path(self.directory) / "export" / "timeline.ndjson"
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def read_rows(self):
+        with open(self.path, encoding='utf-8') as f:
+            return [json.loads(line) for line in f]
+
+    def test_events_of_all_deals_in_one_file(self):
+        with open_exporter(self.path) as exporter:
+            self.assertIsInstance(exporter, NdjsonExporter)
+            self.assertEqual(exporter.write_deal(1, DataProcessor.merge_timeline(DEAL_DATA)), 3)
+            exporter.write_deal(2, DataProcessor.merge_timeline({"activities": DEAL_DATA["activities"][:1]}))
+
+        rows = self.read_rows()
+        self.assertEqual(exporter.rows, 4)
+        self.assertEqual([(row["deal_id"], row["id"]) for row in rows], [(1, "1"), (1, "10"), (1, "2"), (2, "1")])
+        self.assertEqual(rows[0], {
+            "deal_id": 1, "type": "activity", "date": "2025-06-10T12:30:00+03:00",
+            "subject": "Звонок", "author": "7", "id": "1"
+        })
+        self.assertEqual(rows[1]["type"], "comment")
+
+    def test_without_orjson_same_lines(self):
+        with open_exporter(self.path) as exporter:
+            exporter.write_deal(1, DataProcessor.merge_timeline(DEAL_DATA))
+        expected = self.read_rows()
+
+        with patch.object(exporters, "orjson", None), open_exporter(self.path) as exporter:
+            exporter.write_deal(1, DataProcessor.merge_timeline(DEAL_DATA))
+        self.assertEqual(self.read_rows(), expected)
+
+class TestParquetExporter(unittest.TestCase):
+    @unittest.skipIf(exporters.pa is None, "pyarrow не установлен")
+    def test_row_groups(self):
+        directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, directory)
+        path = Path(directory) / "timeline.parquet"
+        with ParquetExporter(path, row_group_size=2) as exporter:
+            exporter.write_deal(1, DataProcessor.merge_timeline(DEAL_DATA))
+            exporter.write_deal(2, DataProcessor.merge_timeline({"activities": DEAL_DATA["activities"][:1]}))
+
+        parquet_file = exporters.pq.ParquetFile(str(path))
+        self.assertEqual(parquet_file.metadata.num_rows, 4)
+        self.assertEqual(parquet_file.metadata.num_row_groups, 2)
+        table = parquet_file.read()
+        self.assertEqual(table.column("deal_id").to_pylist(), [1, 1, 1, 2])
+        self.assertEqual(table.column("tz_offset").to_pylist(), [180, 180, 180, 180])
+
+    def test_requires_pyarrow(self):
+        with patch.object(exporters, "pa", None):
+            with self.assertRaises(ImportError):
+                open_exporter("timeline.parquet")
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,155 @@
+import asyncio
+import json
+import logging
+import unittest
+from urllib.request import urlopen
+from benchmark import find_regressions, format_reports, run_scenario
+from cache import ResponseCache
+from data_fetchers import AsyncBitrixFetcher, BitrixFetcher, DialogHistory
+from fake_bitrix import FakeBitrixServer, FakePortal, LeakyBucket
+
+class TestFakeBitrix(unittest.TestCase):
+    def setUp(self):
+        self.server = FakeBitrixServer(FakePortal(deals=5, comments=120, activities=3, messages=130)).start()
+        self.config = {
+            "bitrix_url": self.server.url,
+            "bitrix_token": "test",
+            "rate_limit": 1000,
+            "rate_burst": 1000,
+            "logger": logging.getLogger("test")
+        }
+
+    def tearDown(self):
+        self.server.stop()
+
+    def test_deal_data_with_paged_timeline(self):
+        data = BitrixFetcher(self.config).get_deal_data(1)
+
+        self.assertNotIn("error", data)
+        self.assertEqual(data["deal"]["ID"], "1")
+        self.assertEqual(len(data["timeline"]), 120)
+        #Комментарии дозагружены постранично, поэтому ID не повторяются
+        self.assertEqual(len({comment["ID"] for comment in data["timeline"]}), 120)
+        self.assertTrue(data["contact"])
+        self.assertTrue(data["user"])
+        self.assertGreaterEqual(self.server.snapshot()["batches"], 1)
+
+    def test_missing_deal(self):
+        data = BitrixFetcher(self.config).get_deal_data(999)
+        self.assertIn("error", data)
+
+    def test_deals_data_batched(self):
+        results = dict(BitrixFetcher(self.config).get_deals_data(range(1, 6)))
+
+        self.assertEqual(sorted(results), [1, 2, 3, 4, 5])
+        self.assertTrue(all("error" not in data for data in results.values()))
+        #Сделки одного чанка загружаются общими batch, а не запросом на каждую
+        self.assertLess(self.server.snapshot()["requests"], 5 * 3)
+
+    def test_deals_data_match_single_fetch(self):
+        #Ссылки $result внутри общего batch указывают на команды своей сделки
+        results = dict(BitrixFetcher(self.config).get_deals_data(range(1, 6)))
+
+        for deal_id, data in results.items():
+            self.assertEqual(data, BitrixFetcher(self.config).get_deal_data(deal_id))
+            self.assertNotIn("error", data["dialog_messages"])
+            self.assertTrue(data["dialog_messages"]["messages"])
+            self.assertTrue(data["openline_dialog"])
+
+    def test_cache_checks_date_modify(self):
+        #Из кэша выдаются только сделки и контакты с прежним DATE_MODIFY, изменённая сделка
+        #загружается заново вместе со списками
+        self.config["cache"] = ResponseCache(":memory:")
+        first = dict(BitrixFetcher(self.config).get_deals_data(range(1, 4)))
+        self.server.reset()
+        self.server.portal.touch(2)
+        second = dict(BitrixFetcher(self.config).get_deals_data(range(1, 4)))
+        stats = self.server.snapshot()
+
+        self.assertEqual(second[1], first[1])
+        self.assertEqual(second[3], first[3])
+        self.assertNotEqual(second[2]["deal"]["DATE_MODIFY"], first[2]["deal"]["DATE_MODIFY"])
+        self.assertEqual(stats["method:crm.deal.list"], 1)
+        self.assertEqual(stats["method:crm.contact.list"], 1)
+        self.assertEqual(stats["method:crm.deal.get"], 1)
+        #Активности и поиск диалога, сообщения - только для изменённой сделки
+        self.assertEqual(stats["method:crm.activity.list"], 2)
+        self.assertEqual(stats["method:im.dialog.messages.get"], 1)
+
+    def test_dialog_history_cursor(self):
+        messages = list(BitrixFetcher(self.config).iter_dialog_messages("chat1"))
+
+        self.assertEqual(len(messages), 130)
+        self.assertEqual(len({message["id"] for message in messages}), 130)
+
+    def test_dialog_history_read_once(self):
+        #Все проходы по истории, в том числе одновременные, читают API один раз
+        history = DialogHistory(BitrixFetcher(self.config), "chat1")
+        first, second = iter(history), iter(history)
+        pairs = list(zip(first, second))
+        again = list(history)
+
+        self.assertEqual(len(pairs), 130)
+        self.assertTrue(all(a == b for a, b in pairs))
+        self.assertEqual(again, [a for a, _ in pairs])
+        self.assertEqual(self.server.snapshot()["method:im.dialog.messages.get"], 3)
+
+    def test_rate_limit_retried(self):
+        self.server.bucket = LeakyBucket(rate=50, burst=2)
+        results = dict(BitrixFetcher(self.config).get_deals_data(range(1, 6), chunk_size=1))
+
+        self.assertTrue(all("error" not in data for data in results.values()))
+        self.assertGreater(self.server.snapshot().get("limited", 0), 0)
+
+    def test_limited_commands_retried(self):
+        #Команды, отклонённые по лимиту внутри batch, повторяются, а не попадают в досье ошибкой
+        expected = dict(BitrixFetcher(self.config).get_deals_data(range(1, 6)))
+        self.server.limit_every = 7
+        data = dict(BitrixFetcher(self.config).get_deals_data(range(1, 6)))
+
+        self.assertEqual(data, expected)
+        self.assertGreater(self.server.snapshot()["limited_commands"], 0)
+
+    def test_limited_commands_retried_async(self):
+        async def fetch():
+            async with AsyncBitrixFetcher(self.config, 4) as fetcher:
+                return dict([item async for item in fetcher.get_deals_data(range(1, 6))])
+
+        expected = asyncio.run(fetch())
+        self.server.limit_every = 7
+        data = asyncio.run(fetch())
+
+        self.assertEqual(data, expected)
+        self.assertGreater(self.server.snapshot()["limited_commands"], 0)
+
+    def test_stats_endpoint(self):
+        BitrixFetcher(self.config).get_deal_data(1)
+        with urlopen(f"{self.server.url}/_stats") as response:
+            stats = json.loads(response.read().decode('utf-8'))
+        self.assertGreater(stats["requests"], 0)
+
+        self.server.reset()
+        self.assertEqual(self.server.snapshot(), {})
+
+    def test_benchmark_scenario(self):
+        report = run_scenario("bulk", self.config, [1, 2, 3])
+
+        self.assertEqual(report["deals"], 3)
+        self.assertEqual(report["errors"], 0)
+        self.assertGreater(report["deals_per_sec"], 0)
+        self.assertLessEqual(report["p50_ms"], report["p99_ms"])
+        self.assertIn("bulk", format_reports([report]))
+
+class TestRegressions(unittest.TestCase):
+    def test_find_regressions(self):
+        baseline = [{"mode": "bulk", "errors": 0, "deals_per_sec": 100.0, "p99_ms": 10.0, "requests_per_deal": 1.0}]
+        same = [{"mode": "bulk", "errors": 0, "deals_per_sec": 95.0, "p99_ms": 10.5, "requests_per_deal": 1.0}]
+        worse = [{"mode": "bulk", "errors": 1, "deals_per_sec": 50.0, "p99_ms": 10.0, "requests_per_deal": 2.0}]
+
+        self.assertEqual(find_regressions(same, baseline), [])
+        regressions = find_regressions(worse, baseline)
+        self.assertEqual(len(regressions), 3)
+        self.assertTrue(all(regression.startswith("bulk") for regression in regressions))
+
+if __name__ == '__main__':
+    unittest.main()
@@ -1,24 +1,36 @@
 import unittest
+import json
 import logging
+import logging.handlers
 import sys
+import tempfile
 from unittest.mock import patch, MagicMock
 from pathlib import Path
 import os
-from logger import setup_logger
+from logger import setup_logger, stop_logging
 
 class TestSetupLogger(unittest.TestCase):
 
+    def tearDown(self):
+        stop_logging()
+        logger = logging.getLogger("deal_dossier")
+        for handler in logger.handlers[:]:
+            logger.removeHandler(handler)
+
+    @patch("logger.os.access", return_value=True)
+    @patch("logger_test.Path.is_dir", return_value=True)
     @patch("logger_test.logging.getLogger")
     @patch("logger_test.Path.mkdir")
     @patch("logger_test.logging.StreamHandler")
     @patch("logger_test.logging.FileHandler")
-    def test_logger_with_log_path(self, mock_file_handler_cls, mock_stream_handler_cls, mock_mkdir, mock_get_logger):
+    def test_logger_with_log_path(self, mock_file_handler_cls, mock_stream_handler_cls, mock_mkdir, mock_get_logger,
+                                  mock_is_dir, mock_access):
         #моки для логгера и хендлеров
         mock_logger = MagicMock()
         mock_get_logger.return_value = mock_logger
 
-        mock_stream_handler = MagicMock()
-        mock_file_handler = MagicMock()
+        mock_stream_handler = MagicMock(level=logging.NOTSET)
+        mock_file_handler = MagicMock(level=logging.NOTSET)
         mock_stream_handler_cls.return_value = mock_stream_handler
         mock_file_handler_cls.return_value = mock_file_handler
 
@@ -38,13 +50,13 @@ class TestSetupLogger(unittest.TestCase):
         #проверяем создание директории для логов
         mock_mkdir.assert_called_once_with(parents=True, exist_ok=True)
 
-        #проверяем создание и добавление StreamHandler
+        #консоль и файл обслуживает слушатель очереди, к логгеру подключена только очередь
         mock_stream_handler_cls.assert_called_once_with(sys.stdout)
-        mock_logger.addHandler.assert_any_call(mock_stream_handler)
-
-        #проверяем создание и добавление FileHandler
-        mock_file_handler_cls.assert_called_once_with(Path(config["log_path"]) / "app.log")
-        mock_logger.addHandler.assert_any_call(mock_file_handler)
+        mock_file_handler_cls.assert_called_once_with(Path(config["log_path"]) / "app.log", encoding='utf-8')
+        mock_logger.addHandler.assert_called_once()
+        self.assertIsInstance(mock_logger.addHandler.call_args[0][0], logging.handlers.QueueHandler)
+        mock_stream_handler.setFormatter.assert_called_once()
+        mock_file_handler.setFormatter.assert_called_once()
 
         #проверяем, что возвращается объект логгера
         self.assertEqual(logger, mock_logger)
@@ -55,7 +67,7 @@ class TestSetupLogger(unittest.TestCase):
         mock_logger = MagicMock()
         mock_get_logger.return_value = mock_logger
 
-        mock_stream_handler = MagicMock()
+        mock_stream_handler = MagicMock(level=logging.NOTSET)
         mock_stream_handler_cls.return_value = mock_stream_handler
 
         config = {
@@ -69,10 +81,7 @@ class TestSetupLogger(unittest.TestCase):
         self.assertEqual(mock_logger.setLevel.call_args[0][0], "WARNING")
 
         mock_stream_handler_cls.assert_called_once_with(sys.stdout)
-        mock_logger.addHandler.assert_called_once_with(mock_stream_handler)
-
-        #убедимся, что mkdir и FileHandler не вызываются
-        self.assertEqual(mock_logger.addHandler.call_count, 1)
+        mock_logger.addHandler.assert_called_once()
 
         self.assertEqual(logger, mock_logger)
 
@@ -82,6 +91,43 @@ class TestSetupLogger(unittest.TestCase):
         logger = setup_logger(config)
         self.assertEqual(logger.level, logging.INFO)
 
+    def test_setup_is_idempotent(self):
+        logger = logging.getLogger("deal_dossier")
+        logger.addHandler(logging.StreamHandler(sys.stdout))  #Начальный обработчик, как в main
+        setup_logger({})
+        setup_logger({})
+
+        self.assertEqual(len(logger.handlers), 1)
+        self.assertIsInstance(logger.handlers[0], logging.handlers.QueueHandler)
+
+    def test_records_written_by_listener(self):
+        with tempfile.TemporaryDirectory() as directory:
+            logger = setup_logger({"log_path": directory, "log_level": "INFO"})
+            logger.info("Обработка сделки ID=%s", 15)
+            logger.debug("Пагинация: start=%d", 0)
+            stop_logging()
+
+            lines = (Path(directory) / "app.log").read_text(encoding='utf-8').splitlines()
+            self.assertEqual(len(lines), 1)
+            self.assertTrue(lines[0].endswith("INFO - Обработка сделки ID=15"))
+
+    def test_json_lines_format(self):
+        with tempfile.TemporaryDirectory() as directory:
+            logger = setup_logger({"log_path": directory, "log_format": "json"})
+            logger.warning("Превышен лимит запросов Битрикс24, повтор через %.1f с", 1.5)
+            try:
+                raise ValueError("сбой")
+            except ValueError:
+                logger.error("Ошибка", exc_info=True)
+            stop_logging()
+
+            lines = (Path(directory) / "app.jsonl").read_text(encoding='utf-8').splitlines()
+            records = [json.loads(line) for line in lines]
+            self.assertEqual(records[0]["message"], "Превышен лимит запросов Битрикс24, повтор через 1.5 с")
+            self.assertEqual(records[0]["level"], "WARNING")
+            self.assertEqual(records[0]["logger"], "deal_dossier")
+            self.assertIn("ValueError: сбой", records[1]["exc_info"])
+
     def test_logger_creates_log_directory(self):
         test_dir = "test_logs_dir"
         if os.path.exists(test_dir):
@@ -89,14 +135,12 @@ class TestSetupLogger(unittest.TestCase):
             shutil.rmtree(test_dir, ignore_errors=True)  #игнорировать ошибки при удалении
 
         config = {"log_path": test_dir}
-        logger = setup_logger(config)
+        setup_logger(config)
 
         self.assertTrue(os.path.isdir(test_dir))
 
-        #закрываем все хендлеры логгера
-        for handler in logger.handlers[:]:
-            handler.close()
-            logger.removeHandler(handler)
+        #останавливаем слушатель, он закрывает файл лога
+        stop_logging()
 
         #очистка после теста
         import shutil
@@ -1,7 +1,8 @@
 import unittest
 from unittest.mock import patch, MagicMock, mock_open
 import sys
-from main import main
+from pathlib import Path
+from main import crawl_deal_ids, crawl_filter, iter_in_thread, main, parse_deal_ids, process_deals, process_deals_async
 
 class TestMainFunction(unittest.TestCase):
     
@@ -15,17 +16,18 @@ class TestMainFunction(unittest.TestCase):
         }
     
     @patch("sys.exit")
+    @patch("report_store.os.replace")
     @patch("builtins.open", new_callable=mock_open)
     @patch("os.makedirs")
     @patch("main.load_config")
     @patch("main.BitrixFetcher")
     @patch("main.DataProcessor.merge_timeline", return_value=[{"date": "2025-06-10"}])
-    @patch("main.ReportGenerator.generate_json", return_value='{"json": "report"}')
-    @patch("main.ReportGenerator.generate_markdown", return_value="md_report")
-    def test_main_all_formats(self, mock_generate_markdown, mock_generate_json,
+    @patch("main.ReportGenerator.render_json")
+    @patch("main.ReportGenerator.render_markdown")
+    def test_main_all_formats(self, mock_render_markdown, mock_render_json,
                             mock_merge_timeline, mock_bitrix_fetcher_cls,
                             mock_load_config, mock_makedirs, mock_open_file,
-                            mock_exit):
+                            mock_replace, mock_exit):
         #Тест генерации отчетов во всех форматах
         
         #настройка мока для load_config
@@ -33,10 +35,9 @@ class TestMainFunction(unittest.TestCase):
         
         #подготовка мока для BitrixFetcher
         mock_bitrix_instance = MagicMock()
-        mock_bitrix_instance.get_deal_data.return_value = {
-            "user": {"ID": 1},
-            "dialog_messages": {"messages": []}
-        }
+        mock_bitrix_instance.get_deals_data.side_effect = lambda deal_ids: (
+            (deal_id, {"user": {"ID": 1}, "dialog_messages": {"messages": []}}) for deal_id in deal_ids
+        )
         mock_bitrix_fetcher_cls.return_value = mock_bitrix_instance
         
         #тестовые аргументы командной строки
@@ -51,14 +52,16 @@ class TestMainFunction(unittest.TestCase):
         mock_bitrix_fetcher_cls.assert_called_once_with(self.default_config)
         
         #проверяем вызовы генерации отчетов
-        mock_generate_json.assert_called_once()
-        mock_generate_markdown.assert_called_once()
+        mock_render_json.assert_called_once()
+        mock_render_markdown.assert_called_once()
         
-        #проверяем, что файлы открываются для записи
+        #проверяем, что отчёты пишутся во временные файлы и подменяют целевые
         expected_json_path = "outdir/deal_123.json"
         expected_md_path = "outdir/deal_123.md"
-        mock_open_file.assert_any_call(expected_json_path, 'w', encoding='utf-8')
-        mock_open_file.assert_any_call(expected_md_path, 'w', encoding='utf-8')
+        mock_open_file.assert_any_call(Path(expected_json_path + ".tmp"), 'w', encoding='utf-8')
+        mock_open_file.assert_any_call(Path(expected_md_path + ".tmp"), 'w', encoding='utf-8')
+        mock_replace.assert_any_call(Path(expected_json_path + ".tmp"), Path(expected_json_path))
+        mock_replace.assert_any_call(Path(expected_md_path + ".tmp"), Path(expected_md_path))
         
         #убедимся, что sys.exit не вызван (успешное завершение)
         mock_exit.assert_not_called()
@@ -84,34 +87,38 @@ class TestMainFunction(unittest.TestCase):
         mock_base_logger.error.assert_called_once()
         mock_exit.assert_called_once_with(1)
 
+    @patch("report_store.os.replace")
     @patch("builtins.open", new_callable=mock_open)
     @patch("os.makedirs")
-    @patch("main.ReportGenerator.generate_markdown", return_value="md_report")
-    @patch("main.ReportGenerator.generate_json", return_value='{"json": "report"}')
+    @patch("main.ReportGenerator.render_markdown")
+    @patch("main.ReportGenerator.render_json")
     @patch("main.DataProcessor.merge_timeline", return_value=[])
     @patch("main.BitrixFetcher")
+    @patch("main.setup_logger")
     @patch("main.load_config")
-    def test_main_verbose_sets_debug_level(self, mock_load_config, mock_bitrix_fetcher_cls,
-                                         mock_merge_timeline, mock_generate_json,
-                                         mock_generate_markdown, mock_makedirs, mock_open_file):
+    def test_main_verbose_sets_debug_level(self, mock_load_config, mock_setup_logger, mock_bitrix_fetcher_cls,
+                                         mock_merge_timeline, mock_render_json,
+                                         mock_render_markdown, mock_makedirs, mock_open_file, mock_replace):
         #тест установки уровня DEBUG при verbose режиме
         
-        #создаем мок логгера из конфига
+        #создаем мок логгера, который настраивает setup_logger по конфигу
         mock_config_logger = MagicMock()
         mock_config = self.default_config.copy()
         mock_config["logger"] = mock_config_logger
         mock_load_config.return_value = mock_config
+        mock_setup_logger.return_value = mock_config_logger
         
         #настройка BitrixFetcher
         mock_bitrix_instance = MagicMock()
-        mock_bitrix_instance.get_deal_data.return_value = {}
+        mock_bitrix_instance.get_deals_data.side_effect = lambda deal_ids: ((deal_id, {}) for deal_id in deal_ids)
         mock_bitrix_fetcher_cls.return_value = mock_bitrix_instance
         
         test_args = ["main.py", "123", "-v"]
         with patch.object(sys, 'argv', test_args):
             main()
         
-        #проверяем установку уровня DEBUG для логгера из конфига
+        #проверяем установку уровня DEBUG для логгера запуска
+        mock_setup_logger.assert_called_once_with(mock_config)
         mock_config_logger.setLevel.assert_called_once_with('DEBUG')
 
     @patch("main.load_config")
@@ -148,5 +155,226 @@ class TestMainFunction(unittest.TestCase):
         self.assertEqual(config["log_level"], "INFO")
         self.assertIsNotNone(config["logger"])
 
+    @patch("sys.exit")
+    @patch("report_store.os.replace")
+    @patch("builtins.open", new_callable=mock_open)
+    @patch("os.makedirs")
+    @patch("main.load_config")
+    @patch("main.BitrixFetcher")
+    @patch("main.DataProcessor.merge_timeline", return_value=[])
+    @patch("main.ReportGenerator.render_json")
+    def test_main_bulk_uses_single_fetcher(self, mock_render_json, mock_merge_timeline,
+                                           mock_bitrix_fetcher_cls, mock_load_config,
+                                           mock_makedirs, mock_open_file, mock_replace, mock_exit):
+        #Тест пакетного режима: один фетчер на все сделки, ошибка одной сделки не прерывает запуск
+        mock_load_config.return_value = self.default_config
+        mock_bitrix_instance = MagicMock()
+        fetched = []
+
+        def get_deals_data(deal_ids):
+            for deal_id in deal_ids:
+                fetched.append(deal_id)
+                yield deal_id, {"error": "Not found"} if deal_id == 3 else {"user": {}}
+        mock_bitrix_instance.get_deals_data.side_effect = get_deals_data
+        mock_bitrix_fetcher_cls.return_value = mock_bitrix_instance
+
+        test_args = ["main.py", "1,2", "3-4", "2", "-f", "json"]
+        with patch.object(sys, 'argv', test_args):
+            main()
+
+        mock_bitrix_fetcher_cls.assert_called_once_with(self.default_config)
+        mock_bitrix_instance.get_deals_data.assert_called_once()
+        self.assertEqual(fetched, [1, 2, 3, 4])
+        self.assertEqual(mock_render_json.call_count, 3)
+        mock_exit.assert_called_once_with(1)
+
+    @patch("sys.exit")
+    @patch("os.makedirs")
+    @patch("main.open_exporter")
+    @patch("main.load_config")
+    @patch("main.BitrixFetcher")
+    @patch("main.DataProcessor.merge_timeline", return_value=[])
+    @patch("main.ReportGenerator.render_json")
+    def test_main_export_only(self, mock_render_json, mock_merge_timeline, mock_bitrix_fetcher_cls,
+                              mock_load_config, mock_open_exporter, mock_makedirs, mock_exit):
+        #Тест общей выгрузки: ленты всех сделок попадают в один экспортёр, отчёты не пишутся
+        mock_load_config.return_value = self.default_config
+        mock_bitrix_instance = MagicMock()
+        mock_bitrix_instance.get_deals_data.side_effect = lambda deal_ids: ((deal_id, {}) for deal_id in deal_ids)
+        mock_bitrix_fetcher_cls.return_value = mock_bitrix_instance
+        exporter = mock_open_exporter.return_value
+
+        test_args = ["main.py", "1-3", "-f", "none", "--export", "out/timeline.ndjson"]
+        with patch.object(sys, 'argv', test_args):
+            main()
+
+        mock_open_exporter.assert_called_once_with("out/timeline.ndjson")
+        self.assertEqual([c.args[0] for c in exporter.write_deal.call_args_list], [1, 2, 3])
+        exporter.close.assert_called_once()
+        mock_render_json.assert_not_called()
+        mock_exit.assert_not_called()
+
+    @patch("sys.exit")
+    @patch("os.makedirs")
+    @patch("main.open_exporter")
+    @patch("main.CassetteStore")
+    @patch("main.load_config")
+    @patch("main.BitrixFetcher")
+    def test_main_replay_lifts_rate_limit(self, mock_bitrix_fetcher_cls, mock_load_config, mock_cassette_cls,
+                                          mock_open_exporter, mock_makedirs, mock_exit):
+        #При проигрывании кассеты лимит портала не действует, лимитер не задерживает запросы
+        mock_load_config.return_value = self.default_config
+        mock_bitrix_fetcher_cls.return_value.get_deals_data.side_effect = lambda deal_ids: (
+            (deal_id, {}) for deal_id in deal_ids
+        )
+
+        test_args = ["main.py", "1", "-f", "none", "--export", "out/timeline.ndjson", "--replay", "cassette"]
+        with patch.object(sys, 'argv', test_args):
+            main()
+
+        config = mock_bitrix_fetcher_cls.call_args.args[0]
+        self.assertEqual(config["cassette_mode"], "replay")
+        self.assertGreaterEqual(config["rate_limiter"].rate, 1000)
+        self.assertGreaterEqual(config["rate_limiter"].burst, 1000)
+        mock_exit.assert_not_called()
+
+    def test_report_stage_with_render_pool(self):
+        #Отчёты рендерятся в пуле, результаты учитываются в манифесте и счётчиках
+        import argparse
+        import os
+        import tempfile
+        from concurrent.futures import ThreadPoolExecutor
+        from main import ReportStage
+        from render_pool import RenderPool
+        from report_store import ReportManifest
+
+        with tempfile.TemporaryDirectory() as output:
+            args = argparse.Namespace(output=output, format='all', compact_json=False,
+                                      full_dialog=False, verbose=False)
+            manifest = ReportManifest(output)
+            with RenderPool(2, executor=ThreadPoolExecutor(2)) as pool:
+                stage = ReportStage(args, MagicMock(), None, manifest, pool)
+                for deal_id in range(1, 5):
+                    stage.add(deal_id, {"error": "Not found"} if deal_id == 2 else {"user": {}})
+                succeeded, failed = stage.finish()
+
+            self.assertEqual((succeeded, failed), (3, [2]))
+            self.assertEqual(manifest.written, 6)
+            self.assertEqual(set(stage.metrics.summary()["stages"]), {"prepare", "render", "write"})
+            self.assertTrue(os.path.exists(os.path.join(output, "deal_4.md")))
+
+    def test_report_stage_async_does_not_block_loop(self):
+        #Подготовка и рендеринг отчёта в параллельном режиме не останавливают event loop
+        import argparse
+        import asyncio
+        import os
+        import tempfile
+        import time
+        from main import ReportStage
+
+        async def add(stage):
+            ticks = 0
+            async def tick():
+                nonlocal ticks
+                while True:
+                    await asyncio.sleep(0.01)
+                    ticks += 1
+            ticker = asyncio.ensure_future(tick())
+            await stage.add_async(1, {"user": {}})
+            ticker.cancel()
+            return ticks
+
+        def slow_render(data, fp, compact=False):
+            time.sleep(0.2)
+            fp.write("{}")
+
+        with tempfile.TemporaryDirectory() as output, \
+                patch("main.ReportGenerator.render_json", side_effect=slow_render):
+            args = argparse.Namespace(output=output, format='json', compact_json=False,
+                                      full_dialog=False, verbose=False)
+            stage = ReportStage(args, MagicMock())
+            ticks = asyncio.run(add(stage))
+
+            self.assertGreater(ticks, 5)
+            self.assertEqual(stage.finish(), (1, []))
+            self.assertTrue(os.path.exists(os.path.join(output, "deal_1.json")))
+
+    def test_crawl_filter(self):
+        import argparse
+        args = argparse.Namespace(stage=["NEW", "WON"], category="1", responsible=None,
+                                  modified_since="2025-01-01", modified_until=None)
+        self.assertEqual(crawl_filter(args), {"STAGE_ID": ["NEW", "WON"], "CATEGORY_ID": "1",
+                                              ">=DATE_MODIFY": "2025-01-01"})
+
+    def test_crawl_feeds_pipeline(self):
+        #Сделки, найденные обходом по фильтру, сразу обрабатываются конвейером
+        import argparse
+        import logging
+        import os
+        import tempfile
+        from fake_bitrix import FakeBitrixServer, FakePortal
+
+        with tempfile.TemporaryDirectory() as output, FakeBitrixServer(FakePortal(deals=20)) as server:
+            config = {"bitrix_url": server.url, "bitrix_token": "test", "rate_limit": 1000, "rate_burst": 1000,
+                      "logger": logging.getLogger("test")}
+            args = argparse.Namespace(stage=["WON"], category=None, responsible=None, modified_since=None,
+                                      modified_until=None, output=output, format='json', compact_json=False,
+                                      incremental=False, full_dialog=False, render_workers=1, verbose=False)
+            succeeded, failed = process_deals(config, crawl_deal_ids(config, args, MagicMock()), args, MagicMock())
+
+            self.assertEqual((succeeded, failed), (4, []))
+            self.assertEqual(sorted(os.listdir(output)), [f"deal_{deal_id}.json" for deal_id in (13, 18, 3, 8)])
+
+    def test_crawl_feeds_async_pipeline(self):
+        #В параллельном режиме обход идёт в потоке: пока ждётся страница crm.deal.list,
+        #event loop продолжает работу
+        import argparse
+        import asyncio
+        import logging
+        import os
+        import tempfile
+        import time
+        from fake_bitrix import FakeBitrixServer, FakePortal
+
+        def slow_ids():
+            for deal_id in (1, 2):
+                time.sleep(0.1)
+                yield deal_id
+
+        async def collect():
+            ticks = 0
+            async def tick():
+                nonlocal ticks
+                while True:
+                    await asyncio.sleep(0.01)
+                    ticks += 1
+            ticker = asyncio.ensure_future(tick())
+            deal_ids = [deal_id async for deal_id in iter_in_thread(slow_ids())]
+            ticker.cancel()
+            return deal_ids, ticks
+
+        deal_ids, ticks = asyncio.run(collect())
+        self.assertEqual(deal_ids, [1, 2])
+        self.assertGreater(ticks, 5)
+
+        with tempfile.TemporaryDirectory() as output, FakeBitrixServer(FakePortal(deals=20)) as server:
+            config = {"bitrix_url": server.url, "bitrix_token": "test", "rate_limit": 1000, "rate_burst": 1000,
+                      "logger": logging.getLogger("test")}
+            args = argparse.Namespace(stage=["WON"], category=None, responsible=None, modified_since=None,
+                                      modified_until=None, output=output, format='json', compact_json=False,
+                                      incremental=False, full_dialog=False, render_workers=1, verbose=False,
+                                      concurrency=4)
+            succeeded, failed = asyncio.run(process_deals_async(
+                config, crawl_deal_ids(config, args, MagicMock()), args, MagicMock()
+            ))
+
+            self.assertEqual((succeeded, failed), (4, []))
+            self.assertEqual(sorted(os.listdir(output)), [f"deal_{deal_id}.json" for deal_id in (13, 18, 3, 8)])
+
+    def test_parse_deal_ids(self):
+        self.assertEqual(list(parse_deal_ids(["5", "1,2", "10-12"])), [5, 1, 2, 10, 11, 12])
+        with self.assertRaises(ValueError):
+            list(parse_deal_ids(["5-1"]))
+
 if __name__ == "__main__":
     unittest.main()
@@ -0,0 +1,144 @@
+import asyncio
+import json
+import logging
+import shutil
+import tempfile
+import unittest
+from pathlib import Path
+from cache import ResponseCache
+from data_fetchers import BitrixFetcher
+from fake_bitrix import FakeBitrixServer, FakePortal, LeakyBucket
+from metrics import Histogram, Metrics
+
+class TestHistogram(unittest.TestCase):
+    def test_buckets_and_quantile(self):
+        histogram = Histogram((0.1, 1.0))
+        for value in (0.05, 0.1, 0.5, 0.5, 5.0):
+            histogram.observe(value)
+
+        self.assertEqual(histogram.counts, [2, 2, 1])
+        self.assertEqual(histogram.count, 5)
+        self.assertAlmostEqual(histogram.sum, 6.15)
+        self.assertAlmostEqual(histogram.quantile(0.5), 0.325)
+        #Значения за последней границей оцениваются этой границей
+        self.assertEqual(histogram.quantile(1.0), 1.0)
+        self.assertEqual(Histogram((1.0,)).quantile(0.5), 0.0)
+
+class TestMetrics(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def test_prometheus_format(self):
+        metrics = Metrics(buckets=(0.1, 1.0))
+        metrics.request("crm.activity.list", 0.5, 100, 200)
+        metrics.request("crm.activity.list", 0.05, 50, 503)
+        metrics.retry("crm.activity.list")
+        metrics.rate_limit_wait(0.25)
+        metrics.rate_limit_wait(0.0)
+
+        text = metrics.to_prometheus()
+        self.assertIn("# TYPE bitrix_request_seconds histogram", text)
+        self.assertIn('bitrix_requests_total{method="crm.activity.list",status="503"} 1', text)
+        self.assertIn('bitrix_request_seconds_bucket{method="crm.activity.list",le="0.1"} 1', text)
+        self.assertIn('bitrix_request_seconds_bucket{method="crm.activity.list",le="+Inf"} 2', text)
+        self.assertIn('bitrix_request_seconds_count{method="crm.activity.list"} 2', text)
+        self.assertIn('bitrix_response_bytes_total{method="crm.activity.list"} 150', text)
+        self.assertIn("bitrix_rate_limit_waits_total 1", text)
+        self.assertNotIn("bitrix_cache_total", text)
+
+    def test_summary_and_slowest(self):
+        metrics = Metrics()
+        metrics.request("batch", 2.0, 10, 200)
+        metrics.command("crm.activity.list", 1.5)
+        metrics.command("im.dialog.messages.get", 0.2)
+        metrics.request("im.dialog.messages.get", 0.1, 10, 200)
+        metrics.cache("user.get", True)
+        metrics.cache("user.get", False)
+        metrics.observe_stage("render", 0.3)
+
+        summary = metrics.summary()
+        self.assertEqual(summary["methods"]["crm.activity.list"]["commands"], 1)
+        self.assertEqual(summary["methods"]["user.get"]["cache_hits"], 1)
+        self.assertEqual(summary["methods"]["user.get"]["cache_misses"], 1)
+        self.assertEqual(summary["stages"]["render"]["count"], 1)
+        #batch не попадает в рейтинг: его время уже учтено в командах
+        self.assertEqual([method for method, _ in metrics.slowest(2)],
+                         ["crm.activity.list", "im.dialog.messages.get"])
+
+    def test_stage_timing(self):
+        metrics = Metrics()
+        self.assertEqual(list(metrics.timed(iter([1, 2, 3]), "fetch")), [1, 2, 3])
+        with metrics.stage("write"):
+            pass
+
+        async def produce():
+            for item in (1, 2):
+                yield item
+
+        async def consume():
+            return [item async for item in metrics.timed_async(produce(), "fetch")]
+
+        self.assertEqual(asyncio.run(consume()), [1, 2])
+        stages = metrics.summary()["stages"]
+        self.assertEqual(stages["fetch"]["count"], 5)
+        self.assertEqual(stages["write"]["count"], 1)
+
+    def test_write_formats(self):
+        metrics = Metrics()
+        metrics.request("user.get", 0.1, 10, 200)
+
+        metrics.write(str(Path(self.directory, "run.prom")))
+        metrics.write(str(Path(self.directory, "run.json")))
+
+        self.assertIn("# TYPE", Path(self.directory, "run.prom").read_text(encoding='utf-8'))
+        summary = json.loads(Path(self.directory, "run.json").read_text(encoding='utf-8'))
+        self.assertEqual(summary["methods"]["user.get"]["requests"], 1)
+        self.assertFalse(list(Path(self.directory).glob("*.tmp")))
+
+class TestFetcherMetrics(unittest.TestCase):
+    def setUp(self):
+        self.server = FakeBitrixServer(FakePortal(deals=3, comments=70, activities=2, messages=10)).start()
+        self.metrics = Metrics()
+        self.config = {
+            "bitrix_url": self.server.url,
+            "bitrix_token": "test",
+            "rate_limit": 1000,
+            "rate_burst": 1000,
+            "metrics": self.metrics,
+            "logger": logging.getLogger("test")
+        }
+
+    def tearDown(self):
+        self.server.stop()
+
+    def test_requests_commands_and_cache(self):
+        self.config["cache"] = ResponseCache(":memory:")
+        fetcher = BitrixFetcher(self.config)
+        fetcher.get_deal_data(1)
+        fetcher.get_deal_data(1)
+
+        methods = self.metrics.summary()["methods"]
+        stats = self.server.snapshot()
+        self.assertEqual(sum(values.get("requests", 0) for values in methods.values()), stats["requests"])
+        self.assertEqual(methods["crm.activity.list"]["commands"], stats["method:crm.activity.list"])
+        #Вторая загрузка сделки берётся из кэша
+        self.assertGreater(methods["crm.deal.get"]["cache_hits"], 0)
+        self.assertGreater(methods["batch"]["bytes"], 0)
+        self.assertIn("command_seconds", methods["crm.deal.get"])
+
+    def test_retries_counted(self):
+        self.server.bucket = LeakyBucket(rate=50, burst=1)
+        fetcher = BitrixFetcher(self.config)
+        for deal_id in (1, 2, 3):
+            fetcher.get_deal_data(deal_id)
+
+        methods = self.metrics.summary()["methods"]
+        retries = sum(values.get("retries", 0) for values in methods.values())
+        self.assertEqual(retries, self.server.snapshot()["limited"])
+        self.assertGreater(retries, 0)
+
+if __name__ == '__main__':
+    unittest.main()
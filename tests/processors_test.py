@@ -1,4 +1,5 @@
 import unittest
+from datetime import datetime, timedelta, timezone
 from processors import DataProcessor
 
 class TestDataProcessor(unittest.TestCase):
@@ -6,7 +7,7 @@ class TestDataProcessor(unittest.TestCase):
     def test_merge_timeline_empty_input(self):
         data = {}
         result = DataProcessor.merge_timeline(data)
-        self.assertEqual(result, [])
+        self.assertEqual(list(result), [])
 
     def test_merge_timeline_with_activities(self):
         data = {
@@ -16,19 +17,20 @@ class TestDataProcessor(unittest.TestCase):
                 {"CREATED": "2025-06-10T12:00:00", "id": 3, "subject": "Meeting"},
             ]
         }
-        result = DataProcessor.merge_timeline(data)
+        result = list(DataProcessor.merge_timeline(data))
 
         #Проверяем, что события отсортированы по дате
-        dates = [event['date'] for event in result]
+        dates = [event.date for event in result]
         self.assertEqual(dates, sorted(dates))
 
         #Проверяем, что тип события установлен правильно
         for event in result:
-            self.assertEqual(event['type'], 'activity')
+            self.assertEqual(event.type, 'activity')
 
-        #Проверяем, что исходные данные сохранены
-        self.assertEqual(result[0]['data']['id'], 2)  #Самое раннее событие
-        self.assertEqual(result[-1]['data']['id'], 3)  #Самое позднее событие
+        #Проверяем, что нужные отчёту поля сохранены
+        self.assertEqual(result[0].source_id, 2)  #Самое раннее событие
+        self.assertEqual(result[0].subject, "Email")
+        self.assertEqual(result[-1].source_id, 3)  #Самое позднее событие
 
     def test_merge_timeline_invalid_date_format(self):
         data = {
@@ -48,5 +50,55 @@ class TestDataProcessor(unittest.TestCase):
         with self.assertRaises(KeyError):
             DataProcessor.merge_timeline(data)
 
+    def test_merge_timeline_all_sources(self):
+        #Активности, комментарии и сообщения сливаются в одну ленту по дате
+        data = {
+            "activities": [
+                {"CREATED": "2025-06-10T10:00:00", "ID": "1"},
+                {"CREATED": "2025-06-12T10:00:00", "ID": "2"}
+            ],
+            "timeline": [
+                {"CREATED": "2025-06-11T10:00:00", "ID": "7", "COMMENT": "Комментарий"}
+            ],
+            "dialog_messages": {"messages": [
+                {"id": 2, "date": "2025-06-13T08:00:00"},
+                {"id": 1, "date": "2025-06-09T08:00:00"},
+                {"id": 3}  #Сообщение без даты пропускается
+            ]}
+        }
+        result = list(DataProcessor.merge_timeline(data))
+
+        self.assertEqual([event.type for event in result],
+                         ['message', 'activity', 'comment', 'activity', 'message'])
+        self.assertEqual(result[2].subject, "Комментарий")
+        dates = [event.date for event in result]
+        self.assertEqual(dates, sorted(dates))
+
+    def test_merge_timeline_is_lazy(self):
+        #Ленивый источник сообщений читается по мере обхода ленты
+        consumed = []
+
+        def messages():
+            for i in range(1, 4):
+                consumed.append(i)
+                yield {"id": i, "date": f"2025-06-1{i}T08:00:00"}
+
+        result = DataProcessor.merge_timeline({"dialog_messages": {"messages": messages()}})
+
+        self.assertEqual(next(result).source_id, 1)
+        self.assertLess(len(consumed), 3)
+
+    def test_timeline_event_is_compact(self):
+        #Событие не хранит исходный ответ и не имеет __dict__
+        event = next(DataProcessor.merge_timeline({"activities": [
+            {"CREATED": "2025-06-10T10:00:00+03:00", "ID": "5", "SUBJECT": "Звонок", "DESCRIPTION": "x" * 1000}
+        ]}))
+
+        self.assertFalse(hasattr(event, '__dict__'))
+        self.assertEqual(event.date, datetime(2025, 6, 10, 10, 0, tzinfo=timezone(timedelta(hours=3))))
+        self.assertEqual(event.as_dict(), {
+            'type': 'activity', 'date': event.date, 'subject': 'Звонок', 'author': None, 'id': '5'
+        })
+
 if __name__ == "__main__":
     unittest.main()
@@ -0,0 +1,58 @@
+import time
+import unittest
+from rate_limiter import RateLimiter
+
+class FakeClock:
+    def __init__(self):
+        self.now = 100.0
+
+    def __call__(self):
+        return self.now
+
+    def sleep(self, seconds):
+        self.now += seconds
+
+class TestRateLimiter(unittest.TestCase):
+    def setUp(self):
+        self.clock = FakeClock()
+        self.limiter = RateLimiter(rate=2.0, burst=3, clock=self.clock, sleep=self.clock.sleep)
+
+    def test_burst_then_steady_rate(self):
+        #Первые burst запросов проходят без ожидания, дальше - по 1/rate секунды
+        delays = [self.limiter.acquire() for _ in range(5)]
+        self.assertEqual(delays[:3], [0.0, 0.0, 0.0])
+        self.assertAlmostEqual(delays[3], 0.5)
+        self.assertAlmostEqual(delays[4], 0.5)
+
+    def test_bucket_refills_when_idle(self):
+        for _ in range(3):
+            self.limiter.acquire()
+        self.clock.now += 10
+        self.assertEqual(self.limiter.reserve(), 0.0)
+
+    def test_penalize_backs_off_exponentially(self):
+        first = self.limiter.penalize()
+        second = self.limiter.penalize()
+        self.assertAlmostEqual(first, 0.5)
+        self.assertAlmostEqual(second, 1.0)
+        self.assertAlmostEqual(self.limiter.reserve(), 1.0)
+
+        #Успешный ответ сбрасывает штраф
+        self.limiter.observe("crm.deal.get", {})
+        self.assertAlmostEqual(self.limiter.penalize(), 0.5)
+
+    def test_operating_limit_blocks_only_method(self):
+        self.limiter.observe("crm.activity.list", {
+            "operating": 470,
+            "operating_reset_at": time.time() + 30
+        })
+        self.assertGreater(self.limiter.reserve(["crm.activity.list"]), 25)
+        self.assertEqual(self.limiter.reserve(["crm.deal.get"]), 0.0)
+
+    def test_is_limit_error(self):
+        self.assertTrue(RateLimiter.is_limit_error(503))
+        self.assertTrue(RateLimiter.is_limit_error(200, {"error": "QUERY_LIMIT_EXCEEDED"}))
+        self.assertFalse(RateLimiter.is_limit_error(200, {"result": []}))
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,57 @@
+import asyncio
+import threading
+import unittest
+from concurrent.futures import ThreadPoolExecutor
+from render_pool import RenderPool
+
+class TestRenderPool(unittest.TestCase):
+    def test_in_flight_is_bounded(self):
+        #Пока воркер занят, submit ждёт: в пуле не больше max_in_flight задач
+        release = threading.Event()
+        running = []
+
+        def task(value):
+            running.append(value)
+            release.wait(5)
+            return value * 2
+
+        pool = RenderPool(1, max_in_flight=2, executor=ThreadPoolExecutor(1))
+        self.assertEqual(pool.submit("a", task, 1), [])
+        self.assertEqual(pool.submit("b", task, 2), [])
+
+        blocked = threading.Thread(target=lambda: pool.submit("c", task, 3))
+        blocked.start()
+        blocked.join(0.2)
+        self.assertTrue(blocked.is_alive())
+
+        release.set()
+        blocked.join(5)
+        results = {key: future.result() for key, future in pool.drain()}
+        pool.close()
+        self.assertEqual(running, [1, 2, 3])
+        self.assertTrue(set(results) <= {"a", "b", "c"})
+
+    def test_process_pool(self):
+        with RenderPool(2) as pool:
+            completed = []
+            for value in range(6):
+                completed += pool.submit(value, pow, value, 2)
+            completed += pool.drain()
+        results = {key: future.result() for key, future in completed}
+        self.assertEqual(results, {value: value ** 2 for value in range(6)})
+
+    def test_submit_async_errors_returned(self):
+        async def run():
+            pool = RenderPool(1, max_in_flight=1, executor=ThreadPoolExecutor(1))
+            completed = await pool.submit_async("bad", int, "x")
+            completed += await pool.submit_async("ok", int, "7")
+            completed += pool.drain()
+            pool.close()
+            return dict(completed)
+
+        completed = asyncio.run(run())
+        self.assertIsInstance(completed["bad"].exception(), ValueError)
+        self.assertEqual(completed["ok"].result(), 7)
+
+if __name__ == "__main__":
+    unittest.main()
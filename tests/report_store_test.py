@@ -0,0 +1,94 @@
+import os
+import shutil
+import tempfile
+import unittest
+from datetime import datetime
+from pathlib import Path
+from unittest.mock import MagicMock
+from report_store import MANIFEST_NAME, ReportManifest, report_fingerprint, write_atomic
+
+def render_text(text):
+    return lambda f: f.write(text)
+
+class TestWriteAtomic(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.path = Path(self.directory) / "deal_1.md"
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def test_failed_render_keeps_previous_file(self):
+        write_atomic(self.path, render_text("старый отчёт"))
+
+        def broken(f):
+            f.write("обрезанный")
+            raise RuntimeError("сбой")
+        with self.assertRaises(RuntimeError):
+            write_atomic(self.path, broken)
+
+        self.assertEqual(self.path.read_text(encoding='utf-8'), "старый отчёт")
+        self.assertEqual(os.listdir(self.directory), ["deal_1.md"])
+
+    def test_unchanged_content_not_replaced(self):
+        digest = write_atomic(self.path, render_text("отчёт"))
+        mtime = self.path.stat().st_mtime_ns
+        os.utime(self.path, ns=(mtime - 10**9, mtime - 10**9))
+
+        self.assertIsNone(write_atomic(self.path, render_text("отчёт"), digest))
+        self.assertEqual(self.path.stat().st_mtime_ns, mtime - 10**9)
+        self.assertNotEqual(write_atomic(self.path, render_text("новый отчёт"), digest), digest)
+
+class TestReportManifest(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def test_skips_by_input_and_content(self):
+        manifest = ReportManifest(self.directory)
+        self.assertTrue(manifest.write("deal_1.json", render_text("{}"), "input-1"))
+        manifest.save()
+
+        #Новый запуск читает манифест одним файлом
+        manifest = ReportManifest(self.directory)
+        self.assertTrue(manifest.is_current("deal_1.json", "input-1"))
+        self.assertFalse(manifest.is_current("deal_1.json", "input-2"))
+        self.assertFalse(manifest.is_current("deal_1.json", None))
+        #Входные данные изменились, а содержимое отчёта - нет
+        self.assertFalse(manifest.write("deal_1.json", render_text("{}"), "input-2"))
+        self.assertEqual((manifest.written, manifest.skipped), (0, 1))
+
+        self.assertFalse(ReportManifest(self.directory, force=True).is_current("deal_1.json", "input-1"))
+        os.remove(Path(self.directory) / "deal_1.json")
+        self.assertFalse(manifest.is_current("deal_1.json", "input-2"))
+
+    def test_saves_periodically(self):
+        manifest = ReportManifest(self.directory, save_every=2)
+        manifest.write("deal_1.md", render_text("1"))
+        self.assertFalse((Path(self.directory) / MANIFEST_NAME).exists())
+        manifest.write("deal_2.md", render_text("2"))
+        self.assertEqual(set(ReportManifest(self.directory).entries), {"deal_1.md", "deal_2.md"})
+
+class TestReportFingerprint(unittest.TestCase):
+    def test_fingerprint(self):
+        data = {"deal": {"ID": 1}, "date": datetime(2025, 6, 10)}
+        self.assertEqual(report_fingerprint(data, False), report_fingerprint(dict(data), False))
+        self.assertNotEqual(report_fingerprint(data, False), report_fingerprint(data, True))
+        #Ленивую историю диалога не выгружаем ради отпечатка
+        self.assertIsNone(report_fingerprint({"dialog_messages": {"messages": iter([])}}))
+
+    def test_fingerprint_of_dialog_history(self):
+        #История диалога с известным последним сообщением сравнивается по нему, без выгрузки
+        from data_fetchers import DialogHistory
+        fetcher = MagicMock()
+        first = report_fingerprint({"dialog_messages": {"messages": DialogHistory(fetcher, "chat1", None, 10)}})
+        self.assertIsNotNone(first)
+        self.assertEqual(first, report_fingerprint({"dialog_messages": {"messages": DialogHistory(fetcher, "chat1", None, 10)}}))
+        self.assertNotEqual(first, report_fingerprint({"dialog_messages": {"messages": DialogHistory(fetcher, "chat1", None, 11)}}))
+        self.assertIsNone(report_fingerprint({"dialog_messages": {"messages": DialogHistory(fetcher, "chat1")}}))
+        fetcher.iter_dialog_messages.assert_not_called()
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,120 @@
+import argparse
+import json
+import logging
+import shutil
+import tempfile
+import unittest
+from pathlib import Path
+from fake_bitrix import FakeBitrixServer, FakePortal
+from main import journal_fingerprint, process_deals
+from report_store import ReportManifest
+from run_journal import RunJournal
+
+class TestRunJournal(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.path = str(Path(self.directory, "run.jsonl"))
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def entries(self):
+        return [json.loads(line) for line in Path(self.path).read_text(encoding='utf-8').splitlines()]
+
+    def test_resume_skips_written(self):
+        journal = RunJournal(self.path, "run-a")
+        self.assertFalse(journal.resumed)
+        for deal_id in (1, 2):
+            journal.mark(deal_id, "fetched")
+            journal.mark(deal_id, "rendered")
+            journal.mark(deal_id, "written", input="hash")
+        journal.mark(3, "fetched")
+        journal.mark(4, "failed", error="Ошибка")
+        journal.close()
+
+        journal = RunJournal(self.path, "run-a")
+        self.assertTrue(journal.resumed)
+        self.assertEqual(list(journal.remaining([1, 2, 3, 4, 5])), [3, 4, 5])
+        self.assertEqual(journal.skipped, 2)
+        journal.close()
+        #Продолженный запуск дописывает тот же журнал
+        self.assertEqual(self.entries()[0]["run"], "run-a")
+        self.assertEqual(len(self.entries()), 9)
+
+    def test_restart_after_finish_or_other_run(self):
+        journal = RunJournal(self.path, "run-a")
+        journal.mark(1, "written")
+        journal.close()
+
+        journal = RunJournal(self.path, "run-b")
+        self.assertFalse(journal.resumed)
+        self.assertEqual(list(journal.remaining([1])), [1])
+        journal.mark(1, "written")
+        journal.finish(1)
+        journal.close()
+
+        journal = RunJournal(self.path, "run-b")
+        self.assertFalse(journal.resumed)
+        journal.close()
+        self.assertEqual(self.entries(), [self.entries()[0]])
+
+    def test_torn_last_line(self):
+        journal = RunJournal(self.path, "run-a")
+        journal.mark(1, "written")
+        journal.close()
+        with open(self.path, 'a', encoding='utf-8') as f:
+            f.write('{"deal": 2, "sta')
+
+        journal = RunJournal(self.path, "run-a")
+        self.assertEqual(journal.done, {1})
+        journal.mark(2, "written")
+        journal.close()
+        self.assertEqual(RunJournal(self.path, "run-a").done, {1, 2})
+
+class TestResumedRun(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.server = FakeBitrixServer(FakePortal(deals=6, comments=5, activities=2, messages=5)).start()
+        self.config = {
+            "bitrix_url": self.server.url,
+            "bitrix_token": "test",
+            "rate_limit": 1000,
+            "rate_burst": 1000,
+            "logger": logging.getLogger("test")
+        }
+        self.args = argparse.Namespace(deal_ids=["1-6"], ids_file=None, output=self.directory, format='json',
+                                       compact_json=False, incremental=False, full_dialog=False,
+                                       dialog_limit=None, render_workers=1, verbose=False,
+                                       crawl=False)
+
+    def tearDown(self):
+        self.server.stop()
+        shutil.rmtree(self.directory)
+
+    def test_resume_fetches_only_unfinished(self):
+        path = str(Path(self.directory, ".journal.jsonl"))
+        run_hash = journal_fingerprint(self.args)
+        journal = RunJournal(path, run_hash)
+        #Запуск прерван после третьей сделки
+        process_deals(self.config, [1, 2, 3], self.args, logging.getLogger("test"),
+                      manifest=ReportManifest(self.directory), journal=journal)
+        journal.close()
+        self.server.reset()
+
+        journal = RunJournal(path, run_hash)
+        succeeded, failed = process_deals(self.config, journal.remaining(range(1, 7)), self.args,
+                                          logging.getLogger("test"), journal=journal)
+        journal.close()
+
+        self.assertEqual((succeeded, failed), (3, []))
+        self.assertEqual(journal.skipped, 3)
+        self.assertEqual(self.server.snapshot()["method:crm.deal.get"], 3)
+        self.assertTrue(all(Path(self.directory, f"deal_{deal_id}.json").exists() for deal_id in range(1, 7)))
+
+    def test_fingerprint_depends_on_inputs(self):
+        other = argparse.Namespace(**{**vars(self.args), "deal_ids": ["1-7"]})
+        self.assertEqual(journal_fingerprint(self.args), journal_fingerprint(argparse.Namespace(**vars(self.args))))
+        self.assertNotEqual(journal_fingerprint(self.args), journal_fingerprint(other))
+
+if __name__ == '__main__':
+    unittest.main()
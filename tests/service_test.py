@@ -0,0 +1,104 @@
+import json
+import threading
+import time
+import unittest
+from unittest.mock import MagicMock
+from urllib.error import HTTPError
+from urllib.request import urlopen
+from main import build_report_data
+from metrics import Metrics
+from service import DossierServer, DossierService, SingleFlight
+
+DEAL_DATA = {
+    "activities": [{"CREATED": "2025-06-10T12:30:00", "ID": "1", "SUBJECT": "Звонок"}],
+    "user": {"ID": 1, "NAME": "Иван"},
+    "dialog_messages": {"info": "Диалог отсутствует"}
+}
+
+class TestSingleFlight(unittest.TestCase):
+    def test_concurrent_calls_coalesced(self):
+        flight = SingleFlight()
+        calls = []
+
+        def slow():
+            calls.append(1)
+            time.sleep(0.2)
+            return "данные"
+
+        results = []
+        threads = [threading.Thread(target=lambda: results.append(flight.do(1, slow))) for _ in range(5)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        self.assertEqual(len(calls), 1)
+        self.assertEqual(results, ["данные"] * 5)
+        #После завершения следующий вызов выполняется заново
+        flight.do(1, slow)
+        self.assertEqual(len(calls), 2)
+
+    def test_error_shared_and_not_cached(self):
+        flight = SingleFlight()
+        with self.assertRaises(RuntimeError):
+            flight.do("key", MagicMock(side_effect=RuntimeError("сбой")))
+        self.assertEqual(flight.do("key", lambda: 5), 5)
+
+class TestDossierServer(unittest.TestCase):
+    def setUp(self):
+        self.fetcher = MagicMock()
+
+        def get_deal_data(deal_id):
+            time.sleep(0.1)
+            return {"error": "Not found"} if deal_id == 404 else DEAL_DATA
+        self.fetcher.get_deal_data.side_effect = get_deal_data
+        self.fetcher.metrics = Metrics()
+        service = DossierService({}, build_report_data, MagicMock(), fetcher=self.fetcher)
+        self.server = DossierServer(("127.0.0.1", 0), service)
+        self.thread = threading.Thread(target=self.server.serve_forever, daemon=True)
+        self.thread.start()
+        self.base_url = f"http://127.0.0.1:{self.server.server_port}"
+
+    def tearDown(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+    def get(self, path):
+        with urlopen(self.base_url + path, timeout=5) as response:
+            return response.headers["Content-Type"], response.read().decode('utf-8')
+
+    def test_json_and_markdown(self):
+        content_type, body = self.get("/deals/7/dossier")
+        self.assertTrue(content_type.startswith("application/json"))
+        report = json.loads(body)
+        self.assertEqual(report["deal_id"], 7)
+        self.assertEqual(report["timeline"][0]["subject"], "Звонок")
+
+        content_type, body = self.get("/deals/7/dossier?format=md")
+        self.assertTrue(content_type.startswith("text/markdown"))
+        self.assertIn("# Отчёт по сделке 7", body)
+
+    def test_concurrent_requests_single_fetch(self):
+        threads = [threading.Thread(target=self.get, args=("/deals/9/dossier",)) for _ in range(4)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(self.fetcher.get_deal_data.call_count, 1)
+
+    def test_metrics_endpoint(self):
+        self.get("/deals/7/dossier")
+        content_type, body = self.get("/metrics")
+        self.assertTrue(content_type.startswith("text/plain"))
+        self.assertIn('dossier_stage_seconds_count{stage="fetch"} 1', body)
+        self.assertIn('dossier_stage_seconds_count{stage="render"} 1', body)
+
+    def test_errors(self):
+        for path, status in (("/deals/1/dossier?format=pdf", 400), ("/deals/404/dossier", 502), ("/other", 404)):
+            with self.assertRaises(HTTPError) as context:
+                self.get(path)
+            self.assertEqual(context.exception.code, status)
+            self.assertIn("error", json.loads(context.exception.read().decode('utf-8')))
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,57 @@
+import shutil
+import tempfile
+import unittest
+from sync_state import DealStateStore, compute_watermarks, merge_state
+
+class TestMergeState(unittest.TestCase):
+    def setUp(self):
+        self.state = merge_state(1, None, {
+            "deal": {"ID": 1, "TITLE": "Старое название"},
+            "timeline": [{"ID": "10"}, {"ID": "11"}],
+            "activities": [
+                {"ID": "5", "LAST_UPDATED": "2025-06-10T10:00:00+03:00", "SUBJECT": "Звонок"},
+                {"ID": "6", "LAST_UPDATED": "2025-06-11T09:00:00+03:00", "SUBJECT": "Письмо"}
+            ],
+            "dialog_messages": {"messages": [{"id": 100}, {"id": 101}]}
+        })
+
+    def test_watermarks(self):
+        self.assertEqual(self.state["watermarks"], {
+            "timeline_id": 11,
+            "activity_updated": "2025-06-11T09:00:00+03:00",
+            "message_id": 101
+        })
+
+    def test_merge_increment(self):
+        merged = merge_state(1, self.state, {
+            "deal": {"ID": 1, "TITLE": "Новое название"},
+            "timeline": [{"ID": "12"}],
+            "activities": [{"ID": "5", "LAST_UPDATED": "2025-06-12T08:00:00+03:00", "SUBJECT": "Звонок завершён"}],
+            "dialog_messages": {"messages": [{"id": 101}, {"id": 102}]}
+        })
+        data = merged["data"]
+
+        self.assertEqual(data["deal"]["TITLE"], "Новое название")
+        self.assertEqual([item["ID"] for item in data["timeline"]], ["10", "11", "12"])
+        self.assertEqual([item["SUBJECT"] for item in data["activities"]], ["Звонок завершён", "Письмо"])
+        self.assertEqual([msg["id"] for msg in data["dialog_messages"]["messages"]], [100, 101, 102])
+        self.assertEqual(merged["watermarks"]["activity_updated"], "2025-06-12T08:00:00+03:00")
+
+    def test_empty_data_has_no_watermarks(self):
+        self.assertEqual(compute_watermarks({"dialog_messages": {"info": "Диалог отсутствует"}}), {})
+
+class TestDealStateStore(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.directory, ignore_errors=True)
+
+    def test_save_and_load(self):
+        store = DealStateStore(self.directory)
+        self.assertIsNone(store.load(1))
+        store.save(1, {"deal_id": 1, "data": {}, "watermarks": {"timeline_id": 3}})
+        self.assertEqual(store.load(1)["watermarks"], {"timeline_id": 3})
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,125 @@
+import asyncio
+import logging
+import random
+import time
+import unittest
+import requests
+from cassette import CassetteMiss
+from data_fetchers import AsyncBitrixFetcher, BitrixFetcher
+from fake_bitrix import FakeBitrixServer, FakePortal
+from metrics import Metrics
+from transport import ACCEPT_ENCODING, DEFAULT_POOL_SIZE, Transport
+
+class TestTransport(unittest.TestCase):
+    def test_delay_full_jitter(self):
+        transport = Transport(backoff=0.5, max_backoff=4.0, rng=random.Random(1))
+        for attempt in range(1, 10):
+            ceiling = min(4.0, 0.5 * 2 ** (attempt - 1))
+            delays = [transport.delay(attempt) for _ in range(50)]
+            self.assertTrue(all(0 <= delay <= ceiling for delay in delays))
+        #Разброс случайный, а не одна и та же пауза у всех клиентов
+        self.assertGreater(len({round(transport.delay(3), 6) for _ in range(10)}), 1)
+
+    def test_from_config(self):
+        transport = Transport.from_config({"timeout": "2", "retries": "0", "pool_size": 32})
+        self.assertEqual(transport.timeout, (2.0, 2.0))
+        self.assertEqual(transport.retries, 0)
+        self.assertEqual(transport.pool_size, 32)
+        self.assertEqual(Transport.from_config({}).pool_size, DEFAULT_POOL_SIZE)
+
+    def test_transient_errors(self):
+        self.assertTrue(Transport.is_transient(requests.ConnectionError()))
+        self.assertTrue(Transport.is_transient(requests.ReadTimeout()))
+        self.assertFalse(Transport.is_transient(CassetteMiss("нет записи")))
+        self.assertFalse(Transport.is_transient(requests.HTTPError()))
+        self.assertTrue(Transport.is_retry_status(502))
+        #Превышение лимита повторяет лимитер, а не транспорт
+        self.assertFalse(Transport.is_retry_status(503))
+
+    def test_mount(self):
+        session = requests.Session()
+        Transport(pool_size=24).mount(session)
+        adapter = session.get_adapter("https://portal.bitrix24.ru/rest/")
+        self.assertEqual(adapter._pool_maxsize, 24)
+        self.assertEqual(adapter._pool_connections, 24)
+        self.assertEqual(session.headers["Accept-Encoding"], ACCEPT_ENCODING)
+
+class TestFetcherRetries(unittest.TestCase):
+    def setUp(self):
+        self.sleeps = []
+        self.metrics = Metrics()
+        self.config = {
+            "bitrix_token": "test",
+            "rate_limit": 1000,
+            "rate_burst": 1000,
+            "metrics": self.metrics,
+            "transport": Transport(sleep=self.sleeps.append, backoff=0.001),
+            "logger": logging.getLogger("test")
+        }
+
+    def test_retries_bad_gateway(self):
+        with FakeBitrixServer(FakePortal(deals=2, comments=60, activities=2, messages=10)) as server:
+            expected = BitrixFetcher({**self.config, "bitrix_url": server.url}).get_deal_data(1)
+            server.fail_every = 3
+            data = BitrixFetcher({**self.config, "bitrix_url": server.url}).get_deal_data(1)
+            failed = server.snapshot()["failed"]
+
+        self.assertEqual(data, expected)
+        self.assertGreater(failed, 0)
+        self.assertEqual(len(self.sleeps), failed)
+        retries = sum(values.get("retries", 0) for values in self.metrics.summary()["methods"].values())
+        self.assertEqual(retries, failed)
+
+    def test_read_timeout(self):
+        self.config["transport"] = Transport(timeout=(1.0, 0.1), retries=1, sleep=self.sleeps.append)
+        with FakeBitrixServer(FakePortal(deals=1), latency=0.5) as server:
+            fetcher = BitrixFetcher({**self.config, "bitrix_url": server.url})
+            started = time.monotonic()
+            with self.assertRaises(requests.Timeout):
+                fetcher.call_batch({"deal": ("crm.deal.get", {"id": 1})})
+            elapsed = time.monotonic() - started
+            requests_made = server.snapshot()["requests"]
+
+        #Одна попытка и один повтор, каждая обрывается по таймауту чтения
+        self.assertEqual(requests_made, 2)
+        self.assertEqual(len(self.sleeps), 1)
+        self.assertLess(elapsed, 1.0)
+
+    def test_connection_error_gives_up(self):
+        self.config["transport"] = Transport(retries=2, sleep=self.sleeps.append)
+        with FakeBitrixServer(FakePortal(deals=1)) as server:
+            url = server.url
+        #Сервер остановлен: соединение отклоняется
+        fetcher = BitrixFetcher({**self.config, "bitrix_url": url})
+        with self.assertRaises(requests.ConnectionError):
+            fetcher.call_batch({"deal": ("crm.deal.get", {"id": 1})})
+        self.assertEqual(len(self.sleeps), 2)
+
+class TestAsyncFetcherRetries(unittest.TestCase):
+    def test_retries_bad_gateway(self):
+        metrics = Metrics()
+        config = {
+            "bitrix_token": "test",
+            "rate_limit": 1000,
+            "rate_burst": 1000,
+            "metrics": metrics,
+            "transport": Transport(backoff=0.001),
+            "logger": logging.getLogger("test")
+        }
+
+        async def fetch(url):
+            async with AsyncBitrixFetcher({**config, "bitrix_url": url}, 4) as fetcher:
+                return dict([item async for item in fetcher.get_deals_data([1, 2, 3])])
+
+        with FakeBitrixServer(FakePortal(deals=3, comments=60, activities=2, messages=10)) as server:
+            expected = asyncio.run(fetch(server.url))
+            server.fail_every = 4
+            data = asyncio.run(fetch(server.url))
+            failed = server.snapshot()["failed"]
+
+        self.assertEqual(data, expected)
+        self.assertGreater(failed, 0)
+        self.assertEqual(metrics.summary()["methods"]["batch"]["retries"], failed)
+
+if __name__ == '__main__':
+    unittest.main()
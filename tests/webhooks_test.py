@@ -0,0 +1,134 @@
+import json
+import logging
+import threading
+import time
+import unittest
+from unittest.mock import MagicMock
+from urllib.error import HTTPError
+from urllib.parse import urlencode
+from urllib.request import urlopen
+from data_fetchers import BitrixFetcher
+from fake_bitrix import FakeBitrixServer, FakePortal
+from metrics import Metrics
+from webhooks import DealRefresher, DebouncedQueue, WebhookServer, parse_event
+
+class FakeClock:
+    def __init__(self):
+        self.now = 0.0
+
+    def __call__(self):
+        return self.now
+
+class TestParseEvent(unittest.TestCase):
+    def test_events(self):
+        self.assertEqual(parse_event({"event": "ONCRMDEALUPDATE", "data[FIELDS][ID]": "15"}), ("deal", "15"))
+        self.assertEqual(parse_event({"event": "OnCrmActivityAdd", "data[FIELDS][ID]": "7"}), ("activity", "7"))
+        self.assertEqual(parse_event({"event": "ONOPENLINEMESSAGEADD", "data[PARAMS][CHAT_ID]": "42"}), ("chat", "42"))
+        self.assertIsNone(parse_event({"event": "ONCRMLEADADD", "data[FIELDS][ID]": "1"}))
+        self.assertIsNone(parse_event({"event": "ONCRMDEALUPDATE"}))
+
+class TestDebouncedQueue(unittest.TestCase):
+    def test_burst_collapses(self):
+        clock = FakeClock()
+        deals = DebouncedQueue(delay=5, max_delay=60, clock=clock)
+        for _ in range(3):
+            deals.put(1)
+            clock.now += 2
+        deals.put(2)
+        self.assertEqual(deals.pop_due(), [])
+        self.assertAlmostEqual(deals.next_due(), 3)
+
+        clock.now += 5
+        self.assertEqual(sorted(deals.pop_due()), [1, 2])
+        self.assertIsNone(deals.next_due())
+
+    def test_max_delay(self):
+        #Непрерывный поток событий не откладывает обновление дольше max_delay
+        clock = FakeClock()
+        deals = DebouncedQueue(delay=5, max_delay=12, clock=clock)
+        due = []
+        for _ in range(10):
+            deals.put(1)
+            clock.now += 3
+            due += deals.pop_due()
+        self.assertEqual(due, [1, 1])
+
+class TestDealRefresher(unittest.TestCase):
+    def test_resolve(self):
+        fetcher = MagicMock()
+        fetcher.call_batch.return_value = ({
+            "activity_7": {"OWNER_TYPE_ID": "2", "OWNER_ID": "15"},
+            "activity_8": {"OWNER_TYPE_ID": "1", "OWNER_ID": "3"},  #Активность лида
+            "comment_9": {"ENTITY_TYPE": "deal", "ENTITY_ID": 16},
+            "chat_43": [{"OWNER_TYPE_ID": "2", "OWNER_ID": "18"}],
+            "chat_44": []
+        }, {})
+        fetcher.find_deal_by_dialog.side_effect = lambda dialog_id: 17 if dialog_id == "chat42" else None
+        refresher = DealRefresher(fetcher, MagicMock(), MagicMock())
+
+        deal_ids = refresher.resolve([("deal", "15"), ("activity", "7"), ("activity", "8"), ("comment", "9"),
+                                      ("chat", "42"), ("chat", "43"), ("chat", "44")])
+
+        self.assertEqual(deal_ids, {15, 16, 17, 18})
+        commands = fetcher.call_batch.call_args.args[0]
+        self.assertEqual(commands["activity_7"], ("crm.activity.get", {"id": "7"}))
+        self.assertEqual(commands["comment_9"], ("crm.timeline.comment.get", {"id": "9"}))
+        #Чат, неизвестный фетчеру, ищется в том же batch по активности открытой линии
+        self.assertNotIn("chat_42", commands)
+        self.assertEqual(commands["chat_43"][1]["filter"]["ASSOCIATED_ENTITY_ID"], ["43", "chat43"])
+
+    def test_resolve_chat_after_restart(self):
+        #Новый фетчер ещё не загружал сделок, но чат всё равно сводится к сделке через API
+        with FakeBitrixServer(FakePortal(deals=5, messages=3)) as server:
+            fetcher = BitrixFetcher({"bitrix_url": server.url, "bitrix_token": "test", "rate_limit": 1000,
+                                     "rate_burst": 1000, "logger": logging.getLogger("test")})
+            refresher = DealRefresher(fetcher, MagicMock(), MagicMock())
+
+            self.assertEqual(refresher.resolve([("chat", "3"), ("chat", "chat4"), ("chat", "99")]), {3, 4})
+            self.assertEqual(server.snapshot()["batches"], 1)
+
+class TestWebhookServer(unittest.TestCase):
+    def setUp(self):
+        self.refreshed = []
+        self.done = threading.Event()
+
+        def refresh(deal_ids):
+            self.refreshed.append(sorted(deal_ids))
+            self.done.set()
+        self.refresher = DealRefresher(MagicMock(metrics=Metrics()), refresh, MagicMock(), delay=0.3)
+        self.server = WebhookServer(("127.0.0.1", 0), self.refresher, "secret")
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+        self.refresher.start()
+        self.url = f"http://127.0.0.1:{self.server.server_port}/events"
+
+    def tearDown(self):
+        self.server.shutdown()
+        self.server.server_close()
+        self.refresher.stop()
+
+    def post(self, form):
+        with urlopen(self.url, data=urlencode(form).encode('utf-8'), timeout=5) as response:
+            return json.loads(response.read().decode('utf-8'))
+
+    def test_burst_gives_single_refresh(self):
+        for _ in range(5):
+            reply = self.post({"event": "ONCRMDEALUPDATE", "data[FIELDS][ID]": "15",
+                               "auth[application_token]": "secret"})
+            self.assertEqual(reply, {"accepted": True})
+        self.assertTrue(self.done.wait(5))
+        time.sleep(0.5)
+        self.assertEqual(self.refreshed, [[15]])
+
+    def test_wrong_token_rejected(self):
+        with self.assertRaises(HTTPError) as context:
+            self.post({"event": "ONCRMDEALUPDATE", "data[FIELDS][ID]": "15", "auth[application_token]": "x"})
+        self.assertEqual(context.exception.code, 403)
+
+    def test_metrics_endpoint(self):
+        self.refresher.fetcher.metrics.request("batch", 0.1, 10, 200)
+        with urlopen(self.url.replace("/events", "/metrics"), timeout=5) as response:
+            self.assertTrue(response.headers["Content-Type"].startswith("text/plain"))
+            self.assertIn('bitrix_requests_total{method="batch",status="200"} 1', response.read().decode('utf-8'))
+
+if __name__ == "__main__":
+    unittest.main()
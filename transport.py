@@ -0,0 +1,65 @@
+import random
+import time
+from typing import Any, Callable, Dict, Optional, Tuple
+
+import requests
+from requests.adapters import HTTPAdapter
+
+from cassette import CassetteAdapter, CassetteMiss, CassetteStore
+
+DEFAULT_TIMEOUT = (5.0, 60.0)  #Таймауты соединения и чтения ответа, с
+DEFAULT_RETRIES = 3  #Повторы после сбоя соединения или ответа 5xx
+DEFAULT_POOL_SIZE = 10  #Соединений в пуле на хост (как у requests по умолчанию)
+#Временные ошибки сервера. 503 и 429 означают превышение лимита и обрабатываются лимитером
+RETRY_STATUSES = (500, 502, 504)
+ACCEPT_ENCODING = "gzip, deflate"
+
+
+class Transport:
+    #Параметры HTTP-транспорта фетчеров: пул соединений, таймауты и повторы с
+    #экспоненциальной задержкой и случайным разбросом (full jitter). Все запросы фетчеров -
+    #чтение (get/list и batch из них), поэтому повтор POST batch безопасен
+    def __init__(self, timeout: Tuple[float, float] = DEFAULT_TIMEOUT, retries: int = DEFAULT_RETRIES,
+                 backoff: float = 0.5, max_backoff: float = 30.0, pool_size: int = DEFAULT_POOL_SIZE,
+                 sleep: Callable[[float], None] = time.sleep, rng: Optional[random.Random] = None):
+        self.timeout = timeout
+        self.retries = retries
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+        self.pool_size = pool_size
+        self.sleep = sleep
+        self._random = rng or random.Random()
+
+    @classmethod
+    def from_config(cls, config: Dict[str, Any]) -> "Transport":
+        #Таймаут чтения и число повторов из конфигурации, размер пула - по параллельности запуска
+        read_timeout = float(config.get("timeout") or DEFAULT_TIMEOUT[1])
+        retries = config.get("retries")
+        return cls(
+            timeout=(min(DEFAULT_TIMEOUT[0], read_timeout), read_timeout),
+            retries=DEFAULT_RETRIES if retries in (None, "") else int(retries),
+            pool_size=max(DEFAULT_POOL_SIZE, int(config.get("pool_size") or 0)),
+        )
+
+    def delay(self, attempt: int) -> float:
+        #Пауза перед повтором номер attempt (с 1): случайная от 0 до backoff * 2^(attempt-1)
+        return self._random.uniform(0, min(self.max_backoff, self.backoff * 2 ** (attempt - 1)))
+
+    @staticmethod
+    def is_transient(error: BaseException) -> bool:
+        #Сбой соединения или таймаут; промах кассеты - не сбой сети, его повторять бесполезно
+        return isinstance(error, (requests.ConnectionError, requests.Timeout)) and not isinstance(error, CassetteMiss)
+
+    @staticmethod
+    def is_retry_status(status_code: Any) -> bool:
+        return status_code in RETRY_STATUSES
+
+    def mount(self, session: requests.Session, cassette: Optional[CassetteStore] = None) -> None:
+        #Адаптеры с пулом нужного размера (или кассета поверх такого же адаптера)
+        if cassette is not None:
+            adapter = CassetteAdapter(cassette, pool_connections=self.pool_size, pool_maxsize=self.pool_size)
+        else:
+            adapter = HTTPAdapter(pool_connections=self.pool_size, pool_maxsize=self.pool_size)
+        session.mount("http://", adapter)
+        session.mount("https://", adapter)
+        session.headers["Accept-Encoding"] = ACCEPT_ENCODING
@@ -0,0 +1,227 @@
+import json
+import logging
+import queue
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Any, Callable, Dict, Hashable, Iterable, List, Optional, Set, Tuple
+from urllib.parse import parse_qsl, urlsplit
+
+from data_fetchers import DEAL_OWNER_TYPE_ID, BitrixFetcher
+from metrics import PROMETHEUS_CONTENT_TYPE
+
+#Исходящие события Битрикс24 и сущность, ID которой приходит в data[FIELDS][ID]
+#(для сообщений открытых линий - ID чата)
+EVENT_ENTITIES = {
+    "ONCRMDEALADD": "deal",
+    "ONCRMDEALUPDATE": "deal",
+    "ONCRMACTIVITYADD": "activity",
+    "ONCRMACTIVITYUPDATE": "activity",
+    "ONCRMTIMELINECOMMENTADD": "comment",
+    "ONCRMTIMELINECOMMENTUPDATE": "comment",
+    "ONIMCONNECTORMESSAGEADD": "chat",
+    "ONOPENLINEMESSAGEADD": "chat",
+}
+#Поля события, в которых может прийти ID чата открытой линии
+CHAT_FIELDS = ("data[PARAMS][CHAT_ID]", "data[chat][id]", "data[CHAT_ID]", "data[PARAMS][DIALOG_ID]")
+
+Reference = Tuple[str, str]  #(сущность, ID) из события
+
+
+def parse_event(form: Dict[str, str]) -> Optional[Reference]:
+    #Сущность, затронутая событием, или None для неизвестных событий
+    entity = EVENT_ENTITIES.get(form.get("event", "").upper())
+    if entity is None:
+        return None
+    if entity == "chat":
+        chat_id = next((form[field] for field in CHAT_FIELDS if form.get(field)), None)
+        return (entity, chat_id) if chat_id else None
+    entity_id = form.get("data[FIELDS][ID]", "")
+    return (entity, entity_id) if entity_id.isdigit() else None
+
+
+class DebouncedQueue:
+    #Очередь с дедупликацией и задержкой: ключ выдаётся через delay секунд после последнего
+    #добавления, поэтому серия событий по одной сделке схлопывается в одну выдачу.
+    #При непрерывном потоке событий ключ всё равно выдаётся не позже max_delay от первого
+    def __init__(self, delay: float = 5.0, max_delay: float = 60.0, clock: Callable[[], float] = time.monotonic):
+        self.delay = delay
+        self.max_delay = max_delay
+        self._clock = clock
+        self._lock = threading.Lock()
+        self._pending: Dict[Hashable, Tuple[float, float]] = {}  #ключ -> (первое добавление, срок выдачи)
+
+    def put(self, key: Hashable) -> None:
+        now = self._clock()
+        with self._lock:
+            first = self._pending[key][0] if key in self._pending else now
+            self._pending[key] = (first, min(now + self.delay, first + self.max_delay))
+
+    def pop_due(self) -> List[Hashable]:
+        now = self._clock()
+        with self._lock:
+            due = [key for key, (_, deadline) in self._pending.items() if deadline <= now]
+            for key in due:
+                del self._pending[key]
+        return due
+
+    def next_due(self) -> Optional[float]:
+        #Секунд до ближайшей выдачи (None - очередь пуста)
+        with self._lock:
+            if not self._pending:
+                return None
+            return max(0.0, min(deadline for _, deadline in self._pending.values()) - self._clock())
+
+    def __len__(self) -> int:
+        return len(self._pending)
+
+
+class DealRefresher:
+    #Обработка событий: ссылки из событий пачками сводятся к ID сделок, сделки попадают
+    #в очередь с задержкой, а по её истечении refresh вызывается один раз для всех готовых сделок
+    def __init__(self, fetcher: BitrixFetcher, refresh: Callable[[List[int]], None], logger: logging.Logger,
+                 delay: float = 5.0, max_delay: float = 60.0):
+        self.fetcher = fetcher
+        self.refresh = refresh
+        self.logger = logger
+        self.deals = DebouncedQueue(delay, max_delay)
+        self._events: "queue.Queue[Reference]" = queue.Queue()
+        self._stopped = threading.Event()
+        self._thread = threading.Thread(target=self._run, name="deal-refresher", daemon=True)
+
+    def start(self) -> None:
+        self._thread.start()
+
+    def stop(self) -> None:
+        self._stopped.set()
+        self._thread.join()
+
+    def submit(self, reference: Reference) -> None:
+        self._events.put(reference)
+
+    def _run(self) -> None:
+        while not self._stopped.is_set():
+            wait = self.deals.next_due()
+            references = self._drain(0.5 if wait is None else min(wait, 0.5))
+            try:
+                for deal_id in self.resolve(references):
+                    self.deals.put(deal_id)
+                due = self.deals.pop_due()
+                if due:
+                    self.logger.info(f"Обновление досье по событиям: {', '.join(map(str, due))}")
+                    self.refresh(due)
+            except Exception as e:
+                self.logger.error(f"Ошибка обработки событий Битрикс24: {str(e)}", exc_info=True)
+
+    def _drain(self, timeout: float) -> List[Reference]:
+        try:
+            references = [self._events.get(timeout=timeout)]
+        except queue.Empty:
+            return []
+        while True:
+            try:
+                references.append(self._events.get_nowait())
+            except queue.Empty:
+                return references
+
+    def resolve(self, references: Iterable[Reference]) -> Set[int]:
+        #ID сделок по ссылкам событий: владельцы активностей и комментариев запрашиваются
+        #одним batch. Чаты сопоставляются с уже загруженными диалогами сделок, а неизвестные
+        #(например, после перезапуска) ищутся в том же batch по активности открытой линии
+        deal_ids, commands = set(), {}
+        for entity, entity_id in set(references):
+            if entity == "deal":
+                deal_ids.add(int(entity_id))
+            elif entity == "activity":
+                commands[f"activity_{entity_id}"] = ("crm.activity.get", {"id": entity_id})
+            elif entity == "comment":
+                commands[f"comment_{entity_id}"] = ("crm.timeline.comment.get", {"id": entity_id})
+            else:
+                deal_id = (self.fetcher.find_deal_by_dialog(entity_id)
+                           or self.fetcher.find_deal_by_dialog(f"chat{entity_id}"))
+                if deal_id is None:
+                    #В событии приходит ID чата (42) или ID диалога (chat42)
+                    dialog_ids = [entity_id, f"chat{entity_id}"] if entity_id.isdigit() else [entity_id]
+                    commands[f"chat_{entity_id}"] = ("crm.activity.list", {
+                        "filter": {
+                            "OWNER_TYPE_ID": DEAL_OWNER_TYPE_ID,
+                            "PROVIDER_ID": "IMOPENLINES_SESSION",
+                            "ASSOCIATED_ENTITY_ID": dialog_ids
+                        },
+                        "select": ["OWNER_ID", "OWNER_TYPE_ID"]
+                    })
+                else:
+                    deal_ids.add(deal_id)
+
+        if commands:
+            results, errors = self.fetcher.call_batch(commands)
+            for key, error in errors.items():
+                self.logger.warning(f"Не удалось определить сделку события {key}: {error}")
+            for key, result in results.items():
+                if key.startswith("chat_"):
+                    owners = [item for item in result or []
+                              if str(item.get("OWNER_TYPE_ID")) == str(DEAL_OWNER_TYPE_ID)]
+                    if not owners:
+                        self.logger.debug("Чат %s не связан со сделками", key[len("chat_"):])
+                    deal_ids.update(int(item["OWNER_ID"]) for item in owners)
+                elif not isinstance(result, dict):
+                    continue
+                elif key.startswith("activity_") and str(result.get("OWNER_TYPE_ID")) == str(DEAL_OWNER_TYPE_ID):
+                    deal_ids.add(int(result["OWNER_ID"]))
+                elif key.startswith("comment_") and str(result.get("ENTITY_TYPE", "")).lower() == "deal":
+                    deal_ids.add(int(result["ENTITY_ID"]))
+        return deal_ids
+
+
+class WebhookRequestHandler(BaseHTTPRequestHandler):
+    #POST /events - приём исходящих событий Битрикс24 (application/x-www-form-urlencoded),
+    #GET /metrics - метрики фетчера в формате Prometheus
+    server: "WebhookServer"
+
+    def do_GET(self) -> None:
+        if urlsplit(self.path).path != "/metrics":
+            self._reply(404, {"error": "Не найдено"})
+            return
+        payload = self.server.refresher.fetcher.metrics.to_prometheus().encode('utf-8')
+        self.send_response(200)
+        self.send_header("Content-Type", PROMETHEUS_CONTENT_TYPE)
+        self.send_header("Content-Length", str(len(payload)))
+        self.end_headers()
+        self.wfile.write(payload)
+
+    def do_POST(self) -> None:
+        if urlsplit(self.path).path.rstrip("/") != "/events":
+            self._reply(404, {"error": "Не найдено"})
+            return
+        length = int(self.headers.get("Content-Length") or 0)
+        form = dict(parse_qsl(self.rfile.read(length).decode('utf-8'), keep_blank_values=True))
+
+        token = self.server.application_token
+        if token and form.get("auth[application_token]") != token:
+            self._reply(403, {"error": "Неверный токен приложения"})
+            return
+
+        reference = parse_event(form)
+        if reference is not None:
+            self.server.refresher.submit(reference)
+        self._reply(200, {"accepted": reference is not None})
+
+    def _reply(self, status: int, body: Dict[str, Any]) -> None:
+        payload = json.dumps(body, ensure_ascii=False).encode('utf-8')
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json; charset=utf-8")
+        self.send_header("Content-Length", str(len(payload)))
+        self.end_headers()
+        self.wfile.write(payload)
+
+    def log_message(self, format: str, *args: Any) -> None:
+        self.server.refresher.logger.debug("%s " + format, self.address_string(), *args)
+
+
+class WebhookServer(ThreadingHTTPServer):
+    daemon_threads = True
+
+    def __init__(self, address: Tuple[str, int], refresher: DealRefresher, application_token: Optional[str] = None):
+        super().__init__(address, WebhookRequestHandler)
+        self.refresher = refresher
+        self.application_token = application_token